@@ -0,0 +1,249 @@
+"""
+End-to-end scaling benchmark of tta.pipeline on the Synthetic dataset.
+
+For every source domain size and batch size, the benchmark runs the stages of
+a tta.cli run on Gaussian-mixture data: tta.pipeline.prepare_dataset, then
+train_fn (training, calibration and inducing the source prior), then adapt_fn
+with EM on the evaluated domains.  It records the wall time of every stage,
+the training throughput, and the memory high-water marks of the phases (see
+tta.memory), so that the curves show how the pipeline scales with the data
+and the batch size.
+
+Every point runs in a fresh process, so that its memory is not the
+high-water mark of the points before it.  Checkpoints are written to a
+temporary cache, so every point trains from scratch, and the times include
+the compilations, which are also reported on their own.  Everything runs
+offline, on CPU with `--host_device_count`.
+
+Usage:
+    python -m benchmarks.scaling --source_domain_count 1024 \
+        --source_domain_count 8192 --batch_size 64 --batch_size 512 \
+        --output benchmarks/results/scaling.json
+"""
+
+from typing import Any, Dict, Optional, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import json
+import multiprocessing
+import tempfile
+import time
+
+import click
+import numpy as np
+
+
+TRAIN_DOMAIN = 1
+EM = ("EM", 1.0, False, False)
+
+
+def init_worker(host_device_count: Optional[int], cache_root: str) -> None:
+    if host_device_count is not None:
+        from tta.mesh import set_host_device_count
+
+        set_host_device_count(host_device_count)
+
+    from tta.cache import cache
+
+    # train every point from scratch instead of restoring its checkpoints
+    cache.root = Path(cache_root)
+
+
+def run(
+    source_domain_count: int,
+    batch_size: int,
+    target_domain_count: int,
+    use_embedding: bool,
+    dim: Optional[int],
+    feature_noise: float,
+    eval_domains_set: set,
+    train_model: str,
+    train_epochs: int,
+    train_engine: str,
+    calibration_epochs: int,
+    seed_count: int,
+    num_workers: int,
+) -> Dict[str, Any]:
+    """Run one point of the sweep, and return its times and memory."""
+    import jax
+    import jax.numpy as jnp
+    import torch
+
+    from tta import compilation, memory, pipeline, timing
+    from benchmarks.steps import results_meta
+
+    if batch_size % jax.device_count():
+        raise ValueError(f"Batch size {batch_size} is not divisible by {jax.device_count()} devices")
+
+    compilation.reset()
+    timing.reset()
+    memory.reset()
+
+    generator = torch.Generator().manual_seed(0)
+    keys = jnp.stack([jax.random.PRNGKey(i) for i in range(seed_count)])
+    train_domains_set = {TRAIN_DOMAIN}
+    calibration_domains_set = set()
+
+    times = {}
+    start = time.perf_counter()
+    dataset, (train, joint_train), (calibration, joint_calibration), eval_splits = pipeline.prepare_dataset(
+        "Synthetic",
+        None,
+        None,
+        target_domain_count,
+        source_domain_count,
+        "none",
+        use_embedding,
+        None,
+        feature_noise,
+        0.0,
+        dim,
+        train_domains_set,
+        0.9,
+        0.1,
+        calibration_domains_set,
+        1.0,
+        eval_domains_set,
+        generator,
+    )
+    times["prepare_dataset"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    state = pipeline.train_fn(
+        dataset,
+        train,
+        joint_train,
+        calibration,
+        joint_calibration,
+        True,
+        train_model,
+        None,
+        batch_size,
+        train_epochs,
+        0.1,
+        train_epochs,
+        0.0,
+        1e-3,
+        1,
+        train_engine,
+        "adamw",
+        0.0,
+        batch_size,
+        calibration_epochs,
+        0.1,
+        calibration_epochs,
+        0.0,
+        1e-3,
+        "sgd",
+        keys,
+        generator,
+        jax.device_count(),
+        num_workers,
+    )
+    jax.block_until_ready(state)
+    times["train_fn"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pipeline.adapt_fn(
+        state,
+        dataset.C,
+        dataset.K,
+        0.0,
+        train_domains_set,
+        calibration_domains_set,
+        eval_splits,
+        EM,
+        False,
+        batch_size,
+        False,
+        generator,
+        num_workers,
+    )
+    times["adapt_fn"] = time.perf_counter() - start
+
+    spans = timing.summary()
+    train_time = spans.get("train", {}).get("total", np.nan)
+    return {
+        "source_domain_count": source_domain_count,
+        "batch_size": batch_size,
+        "train_size": len(train),
+        "times_s": times,
+        "compile_s": sum(t for ts in compilation.events.values() for t in ts),
+        "train_samples_per_s": len(train) * train_epochs / train_time,
+        "test_samples": sum(len(eval_) for eval_, _ in eval_splits),
+        "spans": {path: stats["total"] for path, stats in spans.items() if path.count("/") <= 1},
+        "memory": dict(memory.phases),
+        "meta": results_meta(),
+    }
+
+
+@click.command()
+@click.option("--source_domain_count", type=int, required=False, multiple=True, default=[1024, 4096, 16384])
+@click.option("--batch_size", type=int, required=False, multiple=True, default=[64, 512], help="for training, calibration and adaptation")
+@click.option("--target_domain_count", type=int, required=False, default=512)
+@click.option("--use_embedding", type=bool, required=False, default=True)
+@click.option("--dim", type=int, required=False, help="like --dataset_dim of tta.cli")
+@click.option("--feature_noise", type=float, required=False, default=1.0)
+@click.option("--eval_domains", type=str, required=False, default="0,10,20")
+@click.option("--train_model", type=str, required=False, default="Linear")
+@click.option("--train_epochs", type=int, required=False, default=2)
+@click.option("--train_engine", type=click.Choice(["loader", "memory"]), required=False, default="loader")
+@click.option("--calibration_epochs", type=int, required=False, default=1)
+@click.option("--seed_count", type=int, required=False, default=1, help="members stacked like --train_seed_count")
+@click.option("--num_workers", type=int, required=False, default=0)
+@click.option("--output", type=click.Path(path_type=Path), required=False)
+@click.option("--host_device_count", type=int, required=False)
+def main(
+    source_domain_count: Sequence[int],
+    batch_size: Sequence[int],
+    target_domain_count: int,
+    use_embedding: bool,
+    dim: Optional[int],
+    feature_noise: float,
+    eval_domains: str,
+    train_model: str,
+    train_epochs: int,
+    train_engine: str,
+    calibration_epochs: int,
+    seed_count: int,
+    num_workers: int,
+    output: Optional[Path],
+    host_device_count: Optional[int],
+) -> None:
+    from tta.cache import format_size
+
+    eval_domains_set = set(int(env) for env in eval_domains.split(","))
+    results = []
+    meta = {}
+    # spawn, as JAX is not initialized in this process: the devices of a TPU
+    # host can only be opened by one process at a time
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as cache_root:
+        for size in batch_size:
+            for count in sorted(source_domain_count):
+                print(f"===> source_domain_count = {count}, batch_size = {size}")
+                with ProcessPoolExecutor(
+                    1, mp_context=context, initializer=init_worker, initargs=(host_device_count, cache_root)
+                ) as executor:
+                    result = executor.submit(
+                        run, count, size, target_domain_count, use_embedding, dim, feature_noise, eval_domains_set,
+                        train_model, train_epochs, train_engine, calibration_epochs, seed_count, num_workers,
+                    ).result()
+                meta = result.pop("meta")
+                results.append(result)
+                times = ", ".join(f"{stage} {t:.2f}s" for stage, t in result["times_s"].items())
+                peaks = ", ".join(f"{phase} {format_size(peaks['live'])}" for phase, peaks in result["memory"].items())
+                print(
+                    f"source_domain_count = {count}, batch_size = {size}: {times}, "
+                    f"{result['train_samples_per_s']:.0f} train samples/s, live {peaks}"
+                )
+
+    if output is not None:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        meta = dict(meta, train_model=train_model, use_embedding=use_embedding, dim=dim)
+        output.write_text(json.dumps({"meta": meta, "results": results}, indent=2))
+        print(f"Wrote results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Microbenchmarks of the step functions of tta.train on synthetic inputs.
+
+Every model is built with random parameters, and every step function is
+called on random batches of the input shape the model is used with, padded
+and sharded across the devices like in tta.pipeline.  For each model, step
+function and batch size, the benchmark reports the compile time recorded by
+tta.compilation, the time of the first call, which includes it, the
+percentiles of the latency of the following calls, and the samples per second
+at the median latency.
+
+The results are written as JSON.  With `--baseline`, they are compared with
+earlier results, e.g. of the last release on the same machine, and the run
+fails if a median latency regressed by more than `--tolerance`.  Everything
+runs offline, on CPU with `--host_device_count`.
+
+Usage:
+    python -m benchmarks.steps --model Linear --model LeNet --batch_size 64 \
+        --batch_size 512 --output benchmarks/results/steps.json
+    python -m benchmarks.steps --model LeNet --batch_size 64 \
+        --baseline benchmarks/results/steps.json
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from pathlib import Path
+import json
+import platform
+import time
+
+import click
+import numpy as np
+
+
+# the models and the shapes of the inputs they are used with
+MODELS = {
+    "Linear": (1376,),         # CheXpert and MIMIC embeddings
+    "LeNet": (28, 28, 3),      # MNIST
+    "ResNet18": (224, 224, 3),
+    "ResNet50": (224, 224, 3),  # CheXpert pixels and Waterbirds
+}
+
+FUNCTIONS = ("train_step", "calibration_step", "induce_step", "adapt_step", "test_step")
+
+
+def step_arguments(function: str, state: Any, batch_size: int, sample_shape: Tuple[int, ...], seed_count: int,
+        rng: np.random.Generator) -> Tuple[Callable, List[Any]]:
+    """The step function and its arguments, built like in tta.pipeline."""
+    import jax
+    import jax.numpy as jnp
+
+    from tta import train
+    from tta.mesh import replicate, pad_batch
+
+    C, K = 2, 2
+    X = rng.normal(size=(batch_size, *sample_shape)).astype(np.float32)
+    Y = rng.integers(0, C, size=batch_size)
+    Z = rng.integers(0, K, size=batch_size)
+    (X, M, Y, Z), mask = pad_batch((X, Y * K + Z, Y, Z), batch_size)
+
+    tau = replicate(jnp.float32(1))
+    joint = replicate(jnp.asarray(np.full(C * K, 1 / (C * K))))
+    active = replicate(np.ones(seed_count, dtype=bool))
+    if function == "train_step":
+        keys = jnp.stack([jax.random.PRNGKey(i) for i in range(seed_count)])
+        key_augment = replicate(jax.vmap(jax.random.split, out_axes=1)(keys)[0])
+        return train.train_step, [state, X, M, mask, K, True, tau, joint, key_augment, False, active]
+    elif function == "calibration_step":
+        return train.calibration_step, [state, X, M, mask, K, True, tau, replicate(jnp.float32(1e-3)), joint, active]
+    elif function == "induce_step":
+        return train.induce_step, [state, X, mask]
+    elif function == "adapt_step":
+        return train.adapt_step, [state, X, mask, replicate(1.0), False, False, C, K]
+    elif function == "test_step":
+        return train.test_step, [state, X, Y, Z, mask, False]
+    else:
+        raise ValueError(f"Unknown step function {function}")
+
+
+def measure(step: Callable, args: List[Any], warmup: int, repeats: int) -> Tuple[float, float, np.ndarray]:
+    """
+    The compile time, the time of the first call and the latencies of
+    `repeats` calls after `warmup` calls, in seconds.  The compile time is 0
+    if the step was already compiled for these arguments.
+    """
+    import jax
+
+    from tta import compilation
+    from tta.train import TrainState
+
+    def call() -> float:
+        start = time.perf_counter()
+        outputs = jax.block_until_ready(step(*args))
+        elapsed = time.perf_counter() - start
+        # the training steps donate their state
+        if isinstance(outputs, tuple) and isinstance(outputs[0], TrainState):
+            args[0] = outputs[0]
+        return elapsed
+
+    compilation.reset()
+    first = call()
+    compile_time = sum(t for ts in compilation.events.values() for t in ts)
+
+    for _ in range(warmup):
+        call()
+
+    return compile_time, first, np.array([call() for _ in range(repeats)])
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Print the change of the median latencies from the baseline, and return the regressions."""
+    def key(result: Dict[str, Any]) -> Tuple[str, str, int]:
+        return result["model"], result["function"], result["batch_size"]
+
+    if baseline["meta"] != results_meta():
+        print(f"Warning: the baseline was measured on {baseline['meta']}")
+
+    baseline_results = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = baseline_results.get(key(result))
+        if base is None:
+            continue
+
+        change = result["p50_ms"] / base["p50_ms"] - 1
+        line = f"{result['model']} {result['function']} (batch_size = {result['batch_size']}): p50 {base['p50_ms']:.2f}ms -> {result['p50_ms']:.2f}ms ({change:+.1%})"
+        print(line)
+        if change > tolerance:
+            regressions.append(line)
+
+    return regressions
+
+
+def results_meta() -> Dict[str, Any]:
+    import jax
+
+    return {
+        "jax": jax.__version__,
+        "backend": jax.default_backend(),
+        "device_count": jax.device_count(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+@click.command()
+@click.option("--model", type=click.Choice(list(MODELS)), required=False, multiple=True, default=["Linear", "LeNet"])
+@click.option("--function", type=click.Choice(FUNCTIONS), required=False, multiple=True, default=FUNCTIONS)
+@click.option("--batch_size", type=int, required=False, multiple=True, default=[64, 512])
+@click.option("--seed_count", type=int, required=False, default=1, help="members stacked like --train_seed_count")
+@click.option("--warmup", type=int, required=False, default=3)
+@click.option("--repeats", type=int, required=False, default=20)
+@click.option("--output", type=click.Path(path_type=Path), required=False)
+@click.option("--baseline", type=click.Path(exists=True, path_type=Path), required=False)
+@click.option("--tolerance", type=float, required=False, default=0.1, help="largest relative increase of a median latency")
+@click.option("--host_device_count", type=int, required=False)
+def main(
+    model: Sequence[str],
+    function: Sequence[str],
+    batch_size: Sequence[int],
+    seed_count: int,
+    warmup: int,
+    repeats: int,
+    output: Optional[Path],
+    baseline: Optional[Path],
+    tolerance: float,
+    host_device_count: Optional[int],
+) -> None:
+    if host_device_count is not None:
+        from tta.mesh import set_host_device_count
+
+        set_host_device_count(host_device_count)
+
+    import jax
+    import jax.numpy as jnp
+
+    from tta.mesh import replicate
+    from tta.train import create_train_state, stack_members
+
+    device_count = jax.device_count()
+    for size in batch_size:
+        if size % device_count:
+            raise click.BadParameter(f"Batch size {size} is not divisible by {device_count} devices")
+
+    rng = np.random.default_rng(0)
+    results = []
+    for model_name in model:
+        sample_shape = MODELS[model_name]
+        model_state = replicate(stack_members([
+            create_train_state(jax.random.PRNGKey(i), 2, 2, model_name, 1e-3, jnp.empty((1, *sample_shape)), device_count)
+            for i in range(seed_count)
+        ]))
+        for size in batch_size:
+            for function_name in function:
+                # a copy per function, as the training steps donate it
+                state = jax.tree_util.tree_map(jnp.copy, model_state)
+                step, args = step_arguments(function_name, state, size, sample_shape, seed_count, rng)
+                compile_time, first_call_time, latencies = measure(step, args, warmup, repeats)
+                p50, p90, p99 = np.percentile(latencies, (50, 90, 99)) * 1000
+                result = {
+                    "model": model_name,
+                    "function": function_name,
+                    "batch_size": size,
+                    "compile_s": compile_time,
+                    "first_call_s": first_call_time,
+                    "p50_ms": p50,
+                    "p90_ms": p90,
+                    "p99_ms": p99,
+                    "samples_per_s": size / (p50 / 1000),
+                }
+                results.append(result)
+                print(
+                    f"{model_name} {function_name} (batch_size = {size}): compile {compile_time:.2f}s, first call {first_call_time:.2f}s, "
+                    f"p50 {p50:.2f}ms, p90 {p90:.2f}ms, p99 {p99:.2f}ms, {result['samples_per_s']:.0f} samples/s"
+                )
+
+    if output is not None:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps({"meta": results_meta(), "results": results}, indent=2))
+        print(f"Wrote results to {output}")
+
+    if baseline is not None:
+        regressions = compare(results, json.loads(baseline.read_text()), tolerance)
+        if regressions:
+            raise click.ClickException(f"{len(regressions)} step functions regressed by more than {tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
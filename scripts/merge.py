@@ -5,7 +5,6 @@ import re
 
 import click
 import numpy as np
-import jax.numpy as jnp
 import matplotlib.pyplot as plt
 
 from tta.common import Adaptation, Curves
@@ -62,12 +61,13 @@ def key(path: Path) -> Tuple[bool, Dataset, int, int, float, int]:
 
 
 def collect(npz_dict: Dict[str, Dict[str, Tuple[Curves, str]]]) -> Tuple[
-        Dict[str, str], Dict[str, Dict[ConfigKey, Dict[AdaptKey, List[jnp.ndarray]]]],
+        Dict[str, str], Dict[str, Dict[ConfigKey, Dict[AdaptKey, List[np.ndarray]]]],
     ]:
     example = next(iter(npz_dict.values()))
-    ylabels = {k: v.replace("Average AUC", "AUC") for k, (_, v) in example.items()}
+    # the EM telemetry is only plotted per run by tta.visualize
+    ylabels = {k: v.replace("Average AUC", "AUC") for k, (_, v) in example.items() if not k.startswith("em_")}
 
-    type2config2adapt2sweeps: Dict[str, Dict[ConfigKey, Dict[AdaptKey, List[jnp.ndarray]]]] \
+    type2config2adapt2sweeps: Dict[str, Dict[ConfigKey, Dict[AdaptKey, List[np.ndarray]]]] \
             = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
     for sweep_type in ylabels.keys():
         for config, type2adapt2sweeps in npz_dict.items():
@@ -158,7 +158,7 @@ def parse(config: str) -> ConfigKey:
 
 def plot(
         ylabels: Dict[str, str],
-        type2config2adapt2sweeps: Dict[str, Dict[ConfigKey, Dict[AdaptKey, List[jnp.ndarray]]]],
+        type2config2adapt2sweeps: Dict[str, Dict[ConfigKey, Dict[AdaptKey, List[np.ndarray]]]],
         confounder_strength: np.ndarray,
         merged_title: str,
         merged_root: Path,
@@ -291,7 +291,7 @@ def plot(
             plt.close(fig)
 
 
-def mean_std(sweeps: List[jnp.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+def mean_std(sweeps: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
     sweeps_array = np.empty((len(sweeps), len(sweeps[0]) - 1))
     for i, sweep in enumerate(sweeps):
         sweeps_array[i, :] = sweep[:-1]
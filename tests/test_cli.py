@@ -0,0 +1,59 @@
+"""Checks of tta.cli that need neither JAX nor torch."""
+
+from pathlib import Path
+import json
+
+import numpy as np
+import pytest
+
+pytest.importorskip("matplotlib")
+
+from tta.cli import cli
+from tta.common import EM_ITERATION_BINS
+from tta.sweep import to_args
+
+
+def test_plot_only_rerenders_existing_results(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # the results of one run in the format of tta.pipeline.main, with the training split last
+    rng = np.random.default_rng(0)
+    em = ("EM", 1, False, False), False, 32
+    baselines = [(("Null",), False, 32), (("Oracle",), False, 32)]
+    sweep_types = {
+        "mean": "Average probability of class 1",
+        "l1": "Average L1 error of class 1",
+        "auc": "AUC",
+        "auc_Z": "AUC (Z)",
+        "accuracy": "Accuracy",
+        "accuracy_Z": "Accuracy (Z)",
+        "norm": "Euclidean distance",
+        "em_iterations": "EM iterations per batch",
+        "em_converged": "Fraction of batches EM converged on",
+        "em_objective": "EM objective per sample",
+    }
+    all_sweeps = {
+        sweep_type: ({k: rng.random(22) for k in [*baselines, em]}, ylabel)
+        for sweep_type, ylabel in sweep_types.items()
+    }
+    all_sweeps["em_histogram"] = (
+        {em: rng.integers(0, 4, (22, len(EM_ITERATION_BINS)))},
+        "Batches by EM iterations",
+    )
+    (tmp_path / "npz").mkdir()
+    np.savez(tmp_path / "npz" / "synthetic.npz", **all_sweeps)
+
+    grid = json.loads((Path(__file__).parents[1] / "sweeps" / "paper-mnist.json").read_text())
+    point = dict(
+        grid["base"],
+        config_name="synthetic",
+        dataset_subsample_what="none",
+        train_tau=0,
+        calibration_tau=0,
+        calibration_epochs=0,
+        seed=0,
+        plot_only=True,
+    )
+    cli.main(to_args(point), standalone_mode=False)
+
+    for sweep_type in all_sweeps:
+        assert (tmp_path / "plots" / f"synthetic_{sweep_type}.png").exists()
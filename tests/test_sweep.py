@@ -0,0 +1,69 @@
+"""End-to-end checks of tta.sweep on the Synthetic dataset, which needs no data."""
+
+import sys
+
+import pytest
+
+pytest.importorskip("torch")
+
+from tta import compilation
+from tta.cache import cache
+from tta.sweep import run_group
+
+
+BASE = {
+    "dataset_name": "Synthetic",
+    "dataset_target_domain_count": 256,
+    "dataset_source_domain_count": 2048,
+    "dataset_subsample_what": "none",
+    "dataset_use_embedding": True,
+    "dataset_dim": 8,
+    "dataset_feature_noise": 1.0,
+    "dataset_label_noise": 0.0,
+    "train_fit_joint": True,
+    "train_model": "Linear",
+    "train_domains": "1",
+    "train_fraction": 0.9,
+    "train_calibration_fraction": 0.1,
+    "train_batch_size": 32,
+    "train_epochs": 2,
+    "train_decay": 0.1,
+    "train_patience": 5,
+    "train_tau": 0,
+    "train_lr": 1e-3,
+    "calibration_batch_size": 16,
+    "calibration_epochs": 1,
+    "calibration_decay": 0.1,
+    "calibration_patience": 5,
+    "calibration_tau": 0,
+    "calibration_lr": 1e-3,
+    "adapt_prior_strength": [1],
+    "adapt_symmetric_dirichlet": [False],
+    "adapt_fix_marginal": [False],
+    "test_argmax_joint": [False],
+    "test_batch_size": [32],
+    "eval_domains": "0,10,20",
+    "seed": 0,
+    "num_workers": 0,
+    "plot_only": False,
+}
+
+
+def test_group_compiles_train_step_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "root", tmp_path / "cache")
+    # tta.cli tees stdout to the log of every run
+    monkeypatch.setattr(sys, "stdout", sys.stdout)
+    # tta.cli resets the compilations at the start of every run, keep those of the whole group
+    monkeypatch.setattr(compilation, "reset", lambda *args: None)
+    compilation.events.clear()
+
+    # the points train separately, as their checkpoints differ in the learning rate and tau
+    points = [
+        dict(BASE, config_name=f"synthetic_lr{lr}_tau{tau}", train_lr=lr, train_tau=tau)
+        for lr, tau in [(1e-3, 0), (1e-2, 1)]
+    ]
+    assert run_group(points) == [(point["config_name"], True) for point in points]
+
+    compiles = [times for (name, _), times in compilation.events.items() if name == "train_step"]
+    assert sum(len(times) for times in compiles) == 1
@@ -0,0 +1,67 @@
+"""On-device ImageNet-style data augmentation."""
+
+from typing import Any, Tuple
+
+import jax
+import jax.numpy as jnp
+
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+def normalize(X: jnp.ndarray) -> jnp.ndarray:
+    """Map uint8 (..., H, W, C) images to float32 with the ImageNet statistics."""
+    X = X.astype(jnp.float32) / 255
+    return (X - jnp.array(IMAGENET_MEAN)) / jnp.array(IMAGENET_STD)
+
+
+def random_resized_crop(key: Any, image: jnp.ndarray,
+        scale: Tuple[float, float] = (0.08, 1.0),
+        ratio: Tuple[float, float] = (3/4, 4/3)) -> jnp.ndarray:
+    """
+    Crop a patch of random area and aspect ratio out of an (H, W, C) image and
+    resize it back to (H, W), similar to torchvision's RandomResizedCrop.
+    """
+    H, W, _ = image.shape
+    key_area, key_ratio, key_y, key_x = jax.random.split(key, 4)
+
+    area = H * W * jax.random.uniform(key_area, minval=scale[0], maxval=scale[1])
+    log_ratio = jax.random.uniform(key_ratio, minval=jnp.log(ratio[0]), maxval=jnp.log(ratio[1]))
+    aspect_ratio = jnp.exp(log_ratio)
+    h = jnp.clip(jnp.sqrt(area / aspect_ratio), 1, H)
+    w = jnp.clip(jnp.sqrt(area * aspect_ratio), 1, W)
+    top = jax.random.uniform(key_y) * (H - h)
+    left = jax.random.uniform(key_x) * (W - w)
+
+    # maps [top, top + h) x [left, left + w) onto [0, H) x [0, W)
+    crop_scale = jnp.array([H / h, W / w])
+    translation = -jnp.array([top, left]) * crop_scale
+
+    return jax.image.scale_and_translate(
+        image, image.shape, (0, 1), crop_scale, translation, "linear", antialias=True
+    )
+
+
+def random_horizontal_flip(key: Any, image: jnp.ndarray) -> jnp.ndarray:
+    flip = jax.random.bernoulli(key)
+    return jnp.where(flip, image[:, ::-1], image)
+
+
+def augment(key: Any, X: jnp.ndarray) -> jnp.ndarray:
+    """
+    Apply random resized crop and horizontal flip to a batch of (N, H, W, C)
+    images.  uint8 images are normalized first, which commutes with both
+    operations since the normalization is a per-channel affine map.
+    """
+    if X.dtype == jnp.uint8:
+        X = normalize(X)
+
+    def augment_one(key, image):
+        key_crop, key_flip = jax.random.split(key)
+        image = random_resized_crop(key_crop, image)
+        image = random_horizontal_flip(key_flip, image)
+        return image
+
+    keys = jax.random.split(key, X.shape[0])
+    return jax.vmap(augment_one)(keys, X)
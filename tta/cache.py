@@ -0,0 +1,233 @@
+"""
+Content-addressed cache for datasets, checkpoints and compiled executables.
+
+Every entry is a directory `root/namespace/key`, where `key` is the hexdigest
+of whatever produced it, so identical configurations share one entry no matter
+which sweep created it.  An index records the size and last access time of
+each entry, together with the PIDs of the processes using it.  Entries with a
+live reference are never evicted; the rest are evicted in LRU order whenever
+the cache grows beyond its budget.  A process releases its reference once it
+has read an entry into memory, e.g. a checkpoint, and keeps it for as long as
+it reads from an entry, e.g. memory-mapped images or features.
+
+Usage:
+    python -m tta.cache stats
+    python -m tta.cache prune --budget 200G
+"""
+
+from typing import Dict, Iterator, List, Optional, Tuple
+from pathlib import Path
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import re
+import shutil
+import time
+
+import click
+
+
+class CacheManager:
+    # namespaces populated by third-party code, whose files are evicted individually
+    unindexed = ("jit",)
+
+    def __init__(self, root: Path, budget: Optional[int] = None) -> None:
+        self.root = root
+        self.budget = budget
+
+    def namespace(self, namespace: str) -> Path:
+        path = self.root / namespace
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def entry(self, namespace: str, key: str) -> Path:
+        """Directory of the entry, which is created if it does not exist yet."""
+        path = self.namespace(namespace) / key
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def lookup(self, namespace: str, key: str) -> Optional[Path]:
+        """Return the directory of a committed entry, and take a reference to it."""
+        path = self.root / namespace / key
+        with self.index() as index:
+            record = index.get(f"{namespace}/{key}")
+            if record is None or not path.is_dir():
+                return None
+
+            record["last_access"] = time.time()
+            self.acquire(record)
+
+        return path
+
+    def commit(self, namespace: str, key: str) -> Path:
+        """Register the files written to the entry, then enforce the budget."""
+        path = self.root / namespace / key
+        with self.index() as index:
+            record = index.setdefault(f"{namespace}/{key}", {"size": 0, "refs": []})
+            record["size"] = disk_usage(path)
+            record["last_access"] = time.time()
+            self.acquire(record)
+
+            if self.budget is not None:
+                self.evict(index, self.budget)
+
+        return path
+
+    def release(self, namespace: str, key: str) -> None:
+        with self.index() as index:
+            record = index.get(f"{namespace}/{key}")
+            if record is not None:
+                record["refs"] = [pid for pid in record["refs"] if pid != os.getpid()]
+
+    def prune(self, budget: int, dry_run: bool = False) -> List[Tuple[str, int]]:
+        with self.index() as index:
+            return self.evict(index, budget, dry_run)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        stats = {}
+        with self.index() as index:
+            for name, record in self.entries(index):
+                namespace = name.split("/")[0]
+                summary = stats.setdefault(namespace, {"entries": 0, "size": 0, "pinned": 0})
+                summary["entries"] += 1
+                summary["size"] += record["size"]
+                summary["pinned"] += bool(record["refs"])
+
+        return stats
+
+    @contextmanager
+    def index(self) -> Iterator[Dict[str, Dict]]:
+        """Lock the index for a read-modify-write cycle, shared by all processes."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / "index.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            index_path = self.root / "index.json"
+            if index_path.exists():
+                with open(index_path) as f:
+                    index = json.load(f)
+            else:
+                index = {}
+
+            for record in index.values():
+                record["refs"] = [pid for pid in record["refs"] if pid_alive(pid)]
+
+            yield index
+
+            partial_path = index_path.with_suffix(".partial")
+            with open(partial_path, "w") as f:
+                json.dump(index, f, indent=2)
+            partial_path.replace(index_path)
+
+    def acquire(self, record: Dict) -> None:
+        if os.getpid() not in record["refs"]:
+            record["refs"].append(os.getpid())
+
+    def entries(self, index: Dict[str, Dict]) -> List[Tuple[str, Dict]]:
+        """Indexed entries plus the files of unindexed namespaces, in LRU order."""
+        entries = list(index.items())
+        for namespace in self.unindexed:
+            path = self.root / namespace
+            if not path.is_dir():
+                continue
+
+            for file in path.rglob("*"):
+                if file.is_file():
+                    stat = file.stat()
+                    record = {
+                        "size": stat.st_size,
+                        "refs": [],
+                        "last_access": max(stat.st_atime, stat.st_mtime),
+                    }
+                    entries.append((str(file.relative_to(self.root)), record))
+
+        entries.sort(key=lambda item: item[1]["last_access"])
+        return entries
+
+    def evict(self, index: Dict[str, Dict], budget: int, dry_run: bool = False) -> List[Tuple[str, int]]:
+        entries = self.entries(index)
+        total = sum(record["size"] for _, record in entries)
+
+        evicted = []
+        for name, record in entries:
+            if total <= budget:
+                break
+            if record["refs"]:
+                continue
+
+            if not dry_run:
+                path = self.root / name
+                if path.is_dir():
+                    shutil.rmtree(path)
+                elif path.exists():
+                    path.unlink()
+                index.pop(name, None)
+
+            total -= record["size"]
+            evicted.append((name, record["size"]))
+
+        return evicted
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def disk_usage(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+def parse_size(size: str) -> int:
+    matching = re.fullmatch(r"(\d+(?:\.\d*)?)\s*([KMGT]?)B?", size.strip().upper())
+    if matching is None:
+        raise ValueError(f"Cannot parse size {size}")
+
+    number, unit = matching.groups()
+    return int(float(number) * 1024 ** " KMGT".index(unit or " "))
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+cache = CacheManager(Path("cache/"))
+
+
+@click.group()
+@click.option("--root", type=click.Path(path_type=Path), default=cache.root)
+def main(root: Path) -> None:
+    cache.root = root
+
+
+@main.command()
+def stats() -> None:
+    total = 0
+    for namespace, summary in sorted(cache.stats().items()):
+        total += summary["size"]
+        print(f"{namespace:<12} {summary['entries']:>6} entries, {format_size(summary['size']):>8}, {summary['pinned']} pinned")
+    print(f"{'total':<12} {format_size(total):>23}")
+
+
+@main.command()
+@click.option("--budget", type=str, required=True)
+@click.option("--dry_run", is_flag=True)
+def prune(budget: str, dry_run: bool) -> None:
+    evicted = cache.prune(parse_size(budget), dry_run)
+    for name, size in evicted:
+        print(f"{'Would evict' if dry_run else 'Evicted'} {name} ({format_size(size)})")
+    print(f"Freed {format_size(sum(size for _, size in evicted))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from typing import Tuple, Dict, Union, Literal
 
-import jax.numpy as jnp
+import numpy as np
 
 
 AdaptationNull = Tuple[Literal["Null"]]
@@ -11,7 +11,14 @@ Adaptation = Union[AdaptationNull, AdaptationOracle, AdaptationGMTL, AdaptationE
 
 Curves = Dict[
     Tuple[Adaptation, bool, int],
-    jnp.ndarray,
+    np.ndarray,
 ]
 
-Sweeps = Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]
+Sweeps = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+# iterations, converged fraction and objective per split, and the histogram of
+# the iterations per split over EM_ITERATION_BINS
+EMSweeps = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+# lower edges of the histogram bins of EM iterations per batch, the last bin is open
+EM_ITERATION_BINS = 2 ** np.arange(12)
@@ -0,0 +1,108 @@
+"""
+Count and time the compilations of the jitted step functions.
+
+Every step function in tta.train is wrapped with `tracked`, which notices
+when a call grows the compilation cache of the function and records the
+shape signature of its arguments together with the wall time of the call,
+i.e. tracing, lowering and compiling.  tta.cli resets the record at the
+start of each run and prints `report()` at its end.
+
+The signature also holds the values of Python scalars and other static
+arguments, so that e.g. a sweep over a static flag compiles once per value
+under different signatures.  A function compiling twice for the same
+signature means that something else changed, e.g. a weak type or the
+identity of a static function, which is usually a bug.  With `strict`,
+such a recompilation raises.
+
+With `audit`, the host arrays passed to the functions are recorded by
+tta.transfers, which is only imported then, as it patches the internals of
+jax.
+"""
+
+from typing import Any, Callable, Dict, List, Tuple
+from hashlib import sha256
+import time
+
+import jax
+
+
+# (function name, shape signature) -> compile times in seconds
+events: Dict[Tuple[str, str], List[float]] = {}
+strict = False
+audit = False
+
+
+def reset(strict_recompiles: bool = False, audit_transfers: bool = False) -> None:
+    global strict, audit
+    events.clear()
+    strict = strict_recompiles
+    audit = audit_transfers
+
+
+def describe(x: Any) -> str:
+    """The shape and dtype of an array, and the value of anything else, e.g. a static argument."""
+    if hasattr(x, "shape") and hasattr(x, "dtype"):
+        return f"{x.dtype.name}{list(x.shape)}"
+
+    if x is None or isinstance(x, (bool, int, float, complex, str, bytes)):
+        return repr(x)
+
+    # e.g. a function or a module, which jax compares by hash
+    digest = sha256(repr(x).encode()).hexdigest()
+    return f"{type(x).__name__}:{digest[:8]}"
+
+
+def signature(args: Tuple[Any, ...]) -> str:
+    """Shapes and dtypes of the arguments, with large pytrees, e.g. a TrainState, as a digest."""
+    parts = []
+    for arg in args:
+        leaves = jax.tree_util.tree_leaves(arg)
+        if not leaves or len(leaves) == 1 and leaves[0] is arg:
+            parts.append(describe(arg))
+        elif len(leaves) <= 4:
+            parts.append("(" + ", ".join(describe(leaf) for leaf in leaves) + ")")
+        else:
+            digest = sha256(" ".join(describe(leaf) for leaf in leaves).encode()).hexdigest()
+            parts.append(f"{type(arg).__name__}:{digest[:8]}")
+
+    return ", ".join(parts)
+
+
+def tracked(name: str, jitted: Callable) -> Callable:
+    """Record the compilations of `jitted` under `name`."""
+    def wrapper(*args):
+        if audit:
+            from tta import transfers
+
+            transfers.record_arguments(args)
+
+        cache_size = jitted._cache_size()
+        start = time.perf_counter()
+        outputs = jitted(*args)
+        if jitted._cache_size() > cache_size:
+            elapsed = time.perf_counter() - start
+            key = name, signature(args)
+            if key in events and strict:
+                raise RuntimeError(f"{name} recompiled for the same arguments ({key[1]})")
+            events.setdefault(key, []).append(elapsed)
+
+        return outputs
+
+    # e.g. for ahead-of-time lowering
+    wrapper.jitted = jitted
+
+    return wrapper
+
+
+def report() -> str:
+    lines = []
+    names = sorted({name for name, _ in events})
+    for name in names:
+        times = [t for (event_name, _), ts in events.items() if event_name == name for t in ts]
+        lines.append(f"{name}: {len(times)} compilations in {sum(times):.2f}s")
+        for (event_name, shapes), ts in events.items():
+            if event_name == name:
+                recompiled = " (recompiled)" if len(ts) > 1 else ""
+                lines.append(f"    {len(ts)}x {sum(ts):.2f}s{recompiled} {shapes}")
+
+    return "\n".join(lines) if lines else "No compilations"
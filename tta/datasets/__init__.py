@@ -1,10 +1,11 @@
 # Forked from https://github.com/facebookresearch/DomainBed/blob/main/domainbed/datasets.py
 
-from typing import Set, Tuple, List
+from typing import Callable, Iterator, Optional, Set, Tuple, List
+from collections.abc import Sequence
 
 import numpy as np
 import torch
-from torch.utils.data import ConcatDataset, Subset
+from torch.utils.data import ConcatDataset, Subset, TensorDataset
 
 from tta.utils import Dataset, split_dataset
 
@@ -21,7 +22,38 @@ class MultipleDomainDataset:
         self.confounder_strength: np.ndarray = confounder_strength
         self.train_domain: int = train_domain
         self.hexdigest: str = hexdigest
-        self.domains: List[Tuple[Dataset, torch.Tensor]] = []
+        self.device_augmentation: bool = False
+        self.domains: LazyDomains = LazyDomains(self.build_domain, len(confounder_strength))
+
+    def build_domain(self, i: int) -> Tuple[Dataset, torch.Tensor]:
+        """Build the i-th domain, which is called on the first access to self.domains[i]"""
+        raise NotImplementedError
+
+
+class LazyDomains(Sequence):
+    """A list of (domain, joint_M) pairs that materializes each domain on first access."""
+
+    def __init__(self, build: Callable[[int], Tuple[Dataset, torch.Tensor]], length: int) -> None:
+        self.build = build
+        self.cache: List[Optional[Tuple[Dataset, torch.Tensor]]] = [None] * length
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        if self.cache[i] is None:
+            self.cache[i] = self.build(range(len(self))[i])
+
+        return self.cache[i]
+
+    def items(self) -> Iterator[Tuple[int, Tuple[Dataset, torch.Tensor]]]:
+        """Iterate over the domains that have been materialized so far."""
+        for i, domain in enumerate(self.cache):
+            if domain is not None:
+                yield i, domain
 
 
 def split(
@@ -31,6 +63,7 @@ def split(
     train_calibration_fraction: float,
     calibration_domains: Set[int],
     calibration_fraction: float,
+    eval_domains: Optional[Set[int]] = None,
 ) -> Tuple[
     Tuple[Dataset, torch.Tensor],
     Tuple[Dataset, torch.Tensor],
@@ -40,7 +73,18 @@ def split(
     calibration_splits = []
     test_splits = []
 
-    for i, (domain, joint_M) in enumerate(dataset.domains):
+    joint_shape = (dataset.C, dataset.K)
+    if joint_shape != (2, 2):
+        raise NotImplementedError(f"(C, K) = {joint_shape} != (2, 2)")
+
+    for i in range(len(dataset.domains)):
+        if i not in train_domains and i not in calibration_domains \
+                and eval_domains is not None and i not in eval_domains:
+            # Skip the domain without building it, which is reported as NaN
+            test_splits.append((TensorDataset(torch.empty(0)), torch.full(joint_shape, float('nan'))))
+            continue
+
+        domain, joint_M = dataset.domains[i]
         if i in train_domains:
             # For source domains, we split it into train + calibration + test
             train, test = split_dataset(domain, int(len(domain) * train_fraction))
@@ -63,18 +107,14 @@ def split(
             # For target domains, all samples are used as test
             test_splits.append((domain, joint_M))
 
-    joint_shape = dataset.domains[0][1].shape
-    if joint_shape != (2, 2):
-        raise NotImplementedError(f"(C, K) = {joint_shape} != (2, 2)")
-
     train = ConcatDataset(train_splits)
-    joint_M_train = torch.zeros_like(dataset.domains[0][1])
+    joint_M_train = torch.zeros(joint_shape, dtype=torch.float64)
     for _, _, y, z in train:
         joint_M_train[y][z] += 1
     joint_M_train /= torch.sum(joint_M_train)
 
     calibration = ConcatDataset(calibration_splits)
-    joint_M_calibration = torch.zeros_like(dataset.domains[0][1])
+    joint_M_calibration = torch.zeros(joint_shape, dtype=torch.float64)
     for _, _, y, z in calibration:
         joint_M_calibration[y][z] += 1
     joint_M_calibration /= torch.sum(joint_M_calibration)
@@ -9,10 +9,17 @@ from torchvision.transforms import ToTensor
 from PIL import Image
 
 from tta.datasets import MultipleDomainDataset
+from tta.cache import cache
 
 
 class ColoredCOCO(MultipleDomainDataset):
-    def __init__(self, root: Path, annFile: Path, generator: torch.Generator):
+    def __init__(self, root: Path, annFile: Path, train_domains, generator: torch.Generator):
+        if len(train_domains) != 1:
+            raise NotImplementedError(
+                "Training on multiple source distributions is not supported yet."
+            )
+        train_domain = next(iter(train_domains))
+
         self.categories = [
             'boat',
             'airplane',
@@ -41,51 +48,68 @@ class ColoredCOCO(MultipleDomainDataset):
         C = len(self.categories)
         K = len(self.backgrounds)
         confounder_strength = np.array([0.9, 0.8, 0.1])
-        super().__init__(input_shape, C, K, confounder_strength)
 
         m = sha256()
         m.update(str(annFile).encode())
         cache_key = m.hexdigest()
-        cache_file = root / 'cached' / f'{cache_key}.pt'
-        if cache_file.is_file():
-            # NOTE: The torch.Generator state won't be the same if we load from cache
-            print(f'Loading cached datasets from {cache_file}')
-            self.domains = torch.load(cache_file)
-            return
+
+        super().__init__(input_shape, C, K, confounder_strength, train_domain, cache_key)
 
         if root is None:
             raise ValueError('Data directory not specified!')
 
-        from pycocotools.coco import COCO
         self.root = root
-        self.coco = COCO(annFile)
-
-        self.cat_ids = self.coco.getCatIds(catNms=self.categories)
-        self.image_ids_set = set()
-        for cat_id in self.cat_ids:
-            self.image_ids_set.update(self.coco.getImgIds(catIds=cat_id))
-        self.image_ids = list(self.image_ids_set)
-
-        self.generator = generator
-
-        shuffle = torch.randperm(len(self.image_ids), generator=self.generator)
-
+        self.annFile = annFile
+        self.cache_key = cache_key
+
+        # Each domain gets its own generator so that it can be built independently
+        self.seeds = torch.randint(2**62, (len(confounder_strength) + 1,), generator=generator)
+        self.coco = None
+
+    def build_domain(self, i):
+        filename = f'domain{i}.pt'
+        entry = cache.lookup('datasets', self.cache_key)
+        if entry is not None and (entry / filename).is_file():
+            print(f'Loading cached domain {i} from {entry / filename}')
+            domain = torch.load(entry / filename)
+            # the domain is in memory, so the entry may be evicted
+            cache.release('datasets', self.cache_key)
+            return domain
+
+        if self.coco is None:
+            from pycocotools.coco import COCO
+            self.coco = COCO(self.annFile)
+
+            self.cat_ids = self.coco.getCatIds(catNms=self.categories)
+            self.image_ids_set = set()
+            for cat_id in self.cat_ids:
+                self.image_ids_set.update(self.coco.getImgIds(catIds=cat_id))
+            self.image_ids = list(self.image_ids_set)
+
+            generator = torch.Generator().manual_seed(int(self.seeds[-1]))
+            self.shuffle = torch.randperm(len(self.image_ids), generator=generator)
+
+        C, K = self.C, self.K
         independent = np.ones((C, K)) * 1/K
         confounding1 = np.eye(C, K)
         confounding1 = 0.75 * confounding1 + 0.25 * independent
         confounding2 = np.roll(confounding1, shift=1, axis=1)
 
-        for i, strength in enumerate(self.confounder_strength):
-            indices = shuffle[i::len(self.confounder_strength)]
-            prob = torch.from_numpy(strength * confounding1 + (1-strength) * confounding2)
-            domain = self.dataset_transform(indices, prob)
-            self.domains.append((domain, prob))     # FIXME: prob should be joint
+        strength = self.confounder_strength[i]
+        indices = self.shuffle[i::len(self.confounder_strength)]
+        prob = torch.from_numpy(strength * confounding1 + (1-strength) * confounding2)
+        generator = torch.Generator().manual_seed(int(self.seeds[i]))
+        domain = self.dataset_transform(indices, prob, generator)
+
+        cache_file = cache.entry('datasets', self.cache_key) / filename
+        print(f'Saving cached domain {i} to {cache_file}')
+        torch.save((domain, prob), cache_file)     # FIXME: prob should be joint
+        cache.commit('datasets', self.cache_key)
+        cache.release('datasets', self.cache_key)
 
-        cache_file.parent.mkdir(parents=True, exist_ok=True)
-        print(f'Saving cached datasets to {cache_file}')
-        torch.save(self.domains, cache_file)
+        return domain, prob
 
-    def dataset_transform(self, indices: torch.Tensor, prob: torch.Tensor) -> TensorDataset:
+    def dataset_transform(self, indices: torch.Tensor, prob: torch.Tensor, generator: torch.Generator) -> TensorDataset:
         X, Y, Z = [], [], []
         p = torch.cumsum(prob, dim=1)
         to_tensor = ToTensor()
@@ -111,7 +135,7 @@ class ColoredCOCO(MultipleDomainDataset):
                 continue
 
             cat_idx = self.cat_ids.index(ann['category_id'])
-            background_idx = torch.searchsorted(p[cat_idx], torch.rand(1, generator=self.generator))
+            background_idx = torch.searchsorted(p[cat_idx], torch.rand(1, generator=generator))
             background_color = self.backgrounds[background_idx]
 
             mask = 255 * self.coco.annToMask(ann)
@@ -4,11 +4,84 @@ import torch
 from torch.utils.data import TensorDataset
 
 from tta.datasets import MultipleDomainDataset
+from tta.cache import cache
 
 
 class MultipleDomainCXR(MultipleDomainDataset):
 
-    def build(self, generator, datastore, labels, Y_col, Z_col, patient_col, target_domain_count, source_domain_count):
+    def setup(self, root, generator, cache_key, use_embedding, Y_col, Z_col, patient_col,
+            target_domain_count, source_domain_count):
+        if root is None:
+            raise ValueError('Data directory not specified!')
+
+        self.root = root
+        self.cache_key = cache_key
+        self.use_embedding = use_embedding
+        self.Y_col = Y_col
+        self.Z_col = Z_col
+        self.patient_col = patient_col
+        self.target_domain_count = target_domain_count
+        self.source_domain_count = source_domain_count
+
+        # Each domain gets its own generator so that it can be built independently
+        self.seeds = torch.randint(2**62, (len(self.confounder_strength),), generator=generator)
+        self.datastore = None
+
+
+    def load(self):
+        """Return the (datastore, labels) pair, where the labels are binarized."""
+        raise NotImplementedError
+
+
+    def build_domain(self, i):
+        filename = f'domain{i}.pt'
+        entry = cache.lookup('datasets', self.cache_key) if self.use_embedding else None
+        if entry is not None and (entry / filename).is_file():
+            print(f'Loading cached domain {i} from {entry / filename}')
+            domain = torch.load(entry / filename)
+            # the domain is in memory, so the entry may be evicted
+            cache.release('datasets', self.cache_key)
+            return domain
+
+        print(f'Building domain {i}... (this may take a while)')
+        if self.datastore is None:
+            self.datastore, self.labels = self.load()
+            self.sample_source_domain()
+
+        generator = torch.Generator().manual_seed(int(self.seeds[i]))
+        if i == self.train_domain:
+            in_sample, joint_M = self.source_in_sample, self.source_joint_M
+        else:
+            strength = self.confounder_strength[i]
+            joint_M = torch.from_numpy(strength * self.anchor1 + (1-strength) * self.anchor2)
+            count = torch.round(self.target_domain_count * joint_M).long()
+            count = self.fix_count(count, self.target_domain_count)
+            joint_M = count / torch.sum(count)
+
+            print(f"histogram(M) = {count.flatten()}")
+            in_sample, _ = self.sample(self.labels, self.Y_col, self.Z_col, self.patient_col, self.mask, count, None)
+
+        domain = self.materialize(generator, self.datastore, self.labels, self.Y_col, self.Z_col, in_sample)
+
+        if self.use_embedding:
+            cache_file = cache.entry('datasets', self.cache_key) / filename
+            print(f'Saving cached domain {i} to {cache_file}')
+            torch.save((domain, joint_M), cache_file)
+            cache.commit('datasets', self.cache_key)
+            cache.release('datasets', self.cache_key)
+
+        return domain, joint_M
+
+
+    def sample_source_domain(self):
+        """
+        Sample the source domain, and exclude its patients from the pool that
+        the target domains are sampled from.  Only the indices are sampled here,
+        so this is cheap compared to building the domains.
+        """
+        labels, Y_col, Z_col, patient_col = self.labels, self.Y_col, self.Z_col, self.patient_col
+        target_domain_count, source_domain_count = self.target_domain_count, self.source_domain_count
+
         # Pathology:    0 = Negative, 1 = Positive
         # GENDER:       0 = Female, 1 = Male
         labels["M"] = 2 * labels[Y_col] + labels[Z_col]
@@ -34,55 +107,40 @@ class MultipleDomainCXR(MultipleDomainDataset):
         print("anchor2", anchor2)
 
         mask = np.ones(len(labels.index), dtype=bool)
-        domains = [None for _ in self.confounder_strength]
 
         # Sample source domains
-        for i, strength in enumerate(self.confounder_strength):
-            if i != self.train_domain:
-                continue
+        strength = self.confounder_strength[self.train_domain]
+        quota = labels["M"].loc[mask].value_counts().sort_index().values - target_domain_count
+        quota = torch.from_numpy(quota)
+        joint_M = torch.from_numpy(strength * anchor1 + (1-strength) * anchor2)
 
-            quota = labels["M"].loc[mask].value_counts().sort_index().values - target_domain_count
-            quota = torch.from_numpy(quota)
-            joint_M = torch.from_numpy(strength * anchor1 + (1-strength) * anchor2)
+        source_domain_count_max = torch.floor(torch.min(quota/joint_M.flatten())).item()
+        if source_domain_count is None:
+            source_domain_count = source_domain_count_max
+        elif source_domain_count > source_domain_count_max:
+            raise ValueError(f"Insufficient samples for the source domain: {source_domain_count} > {source_domain_count_max}")
 
-            source_domain_count_max = torch.floor(torch.min(quota/joint_M.flatten())).item()
-            if source_domain_count is None:
-                source_domain_count = source_domain_count_max
-            elif source_domain_count > source_domain_count_max:
-                raise ValueError(f"Insufficient samples for the source domain: {source_domain_count} > {source_domain_count_max}")
+        count = torch.round(source_domain_count * joint_M).long()
+        count = self.fix_count(count, source_domain_count)
+        count_flatten = torch.flatten(count)
+        assert torch.all(count_flatten <= quota), f"Insufficient samples for the source domain: {count_flatten} > {quota}"
 
-            count = torch.round(source_domain_count * joint_M).long()
-            count = self.fix_count(count, source_domain_count)
-            count_flatten = torch.flatten(count)
-            assert torch.all(count_flatten <= quota), f"Insufficient samples for the source domain: {count_flatten} > {quota}"
+        joint_M = count / torch.sum(count)
 
-            joint_M = count / torch.sum(count)
-
-            print(f"histogram(M) = {count.flatten()}")
-            reservation = np.ceil(target_domain_count * np.maximum(anchor1, anchor2).flatten())
-            domain, in_sample_patients = self.sample(generator, datastore, labels, Y_col, Z_col, patient_col, mask, count, reservation)
-            mask &= ~labels[patient_col].isin(in_sample_patients)
-            domains[i] = (domain, joint_M)
+        print(f"histogram(M) = {count.flatten()}")
+        reservation = np.ceil(target_domain_count * np.maximum(anchor1, anchor2).flatten())
+        in_sample, in_sample_patients = self.sample(labels, Y_col, Z_col, patient_col, mask, count, reservation)
+        mask &= ~labels[patient_col].isin(in_sample_patients)
 
         remainder = np.sum(mask)
         if remainder < target_domain_count:
             raise ValueError(f"Not enough data for target domains: {remainder} < {target_domain_count}")
 
-        # Sample target domains
-        for i, strength in enumerate(self.confounder_strength):
-            if i == self.train_domain:
-                continue
-
-            joint_M = torch.from_numpy(strength * anchor1 + (1-strength) * anchor2)
-            count = torch.round(target_domain_count * joint_M).long()
-            count = self.fix_count(count, target_domain_count)
-            joint_M = count / torch.sum(count)
-
-            print(f"histogram(M) = {count.flatten()}")
-            domain, _ = self.sample(generator, datastore, labels, Y_col, Z_col, patient_col, mask, count, None)
-            domains[i] = (domain, joint_M)
-
-        return domains
+        self.anchor1 = anchor1
+        self.anchor2 = anchor2
+        self.mask = mask
+        self.source_in_sample = in_sample
+        self.source_joint_M = joint_M
 
 
     def fix_count(self, count, domain_count):
@@ -112,7 +170,7 @@ class MultipleDomainCXR(MultipleDomainDataset):
         return count
 
 
-    def sample(self, generator, datastore, labels, Y_col, Z_col, patient_col, mask, count, reservation):
+    def sample(self, labels, Y_col, Z_col, patient_col, mask, count, reservation):
         random_state = 0
         while True:
             in_sample = set()
@@ -144,6 +202,11 @@ class MultipleDomainCXR(MultipleDomainDataset):
         N = int(torch.sum(count))
         assert len(in_sample) == N, f"Incorrect number of elements: {len(in_sample)} != {N}"
 
+        return in_sample, in_sample_patients
+
+
+    def materialize(self, generator, datastore, labels, Y_col, Z_col, in_sample):
+        N = len(in_sample)
         x = torch.empty((N, *self.input_shape[1:]))
         y_tilde = torch.empty(N, dtype=torch.long)
         y = torch.empty(N, dtype=torch.long)
@@ -156,4 +219,4 @@ class MultipleDomainCXR(MultipleDomainDataset):
             y[perm[i]] = y_tilde[perm[i]] = row[Y_col]
             z_flattened[perm[i]] = row[Z_col]
 
-        return TensorDataset(x, y_tilde, y, z_flattened), in_sample_patients
+        return TensorDataset(x, y_tilde, y, z_flattened)
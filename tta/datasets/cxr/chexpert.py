@@ -1,15 +1,16 @@
 from typing import Optional
 from hashlib import sha256
+import json
 import re
 
 import numpy as np
 import pandas as pd
 from pandas.api.types import CategoricalDtype
-import torch
 from PIL import Image
 import torchvision.transforms as T
 
 from tta.datasets.cxr import MultipleDomainCXR
+from tta.datasets.cxr.embedding import EmbeddingStore
 
 
 class MultipleDomainCheXpert(MultipleDomainCXR):
@@ -23,7 +24,11 @@ class MultipleDomainCheXpert(MultipleDomainCXR):
         train_domain = next(iter(train_domains))
         patient_col = "patient_id"
 
-        if use_embedding:
+        # embeddings extracted by tta.embed take precedence over embeddings.npz
+        embedding_meta = EmbeddingStore.meta(root / "embeddings") if use_embedding else None
+        if embedding_meta is not None:
+            input_shape = (1, embedding_meta["dim"])
+        elif use_embedding:
             input_shape = (1, 1376)
         else:
             input_shape = (1, 224, 224, 3)
@@ -40,6 +45,8 @@ class MultipleDomainCheXpert(MultipleDomainCXR):
         m.update(str(use_embedding).encode())
         m.update(str(target_domain_count).encode())
         m.update(str(source_domain_count).encode())
+        if embedding_meta is not None:
+            m.update(json.dumps(embedding_meta, sort_keys=True).encode())
 
         m.update(str(input_shape).encode())
         m.update(str(C).encode())
@@ -50,24 +57,17 @@ class MultipleDomainCheXpert(MultipleDomainCXR):
 
         super().__init__(input_shape, C, K, confounder_strength, train_domain, hexdigest)
 
-        cache_key = f'{train_domain}_{Y_col}_{Z_col}_{use_embedding}_{target_domain_count}_{source_domain_count}_{hexdigest}'
-        cache_file = root / 'cached' / f'{cache_key}.pt'
-        if cache_file.is_file():
-            # NOTE: The torch.Generator state won't be the same if we load from cache
-            print(f'Loading cached datasets from {cache_file}')
-            self.domains = torch.load(cache_file)
-            return
+        self.setup(root, generator, hexdigest, use_embedding, Y_col, Z_col, patient_col,
+                target_domain_count, source_domain_count)
 
-        print('Building datasets... (this may take a while)')
-        if root is None:
-            raise ValueError('Data directory not specified!')
 
-        self.generator = generator
-        self.use_embedding = use_embedding
-        self.train_domains = train_domains
+    def load(self):
+        root, Y_col, Z_col = self.root, self.Y_col, self.Z_col
 
         labels: pd.DataFrame = pd.read_csv(root / "labels.csv", index_col="image_id")
-        if use_embedding:
+        if self.use_embedding and EmbeddingStore.meta(root / "embeddings") is not None:
+            datastore = EmbeddingStore(root / "embeddings")
+        elif self.use_embedding:
             datastore = np.load(root / "embeddings.npz")
         else:
             datastore = CheXpertImages(root)
@@ -102,12 +102,7 @@ class MultipleDomainCheXpert(MultipleDomainCXR):
             labels = labels.loc[~labels[column].isna()]
             labels[column] = labels[column].cat.codes
 
-        self.domains = self.build(generator, datastore, labels, Y_col, Z_col, patient_col, target_domain_count, source_domain_count)
-
-        if use_embedding:
-            cache_file.parent.mkdir(parents=True, exist_ok=True)
-            print(f'Saving cached datasets to {cache_file}')
-            torch.save(self.domains, cache_file)
+        return datastore, labels
 
 
 class CheXpertImages:
@@ -122,5 +117,5 @@ class CheXpertImages:
 
     def __getitem__(self, key):
         key = re.sub(self.pattern, "CheXpert-v1.0-small/", key)
-        image = Image.open(self.root / key)
+        image = Image.open(self.root / key).convert("RGB")
         return self.transform(image)
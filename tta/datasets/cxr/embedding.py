@@ -0,0 +1,46 @@
+from typing import Dict, Optional
+from pathlib import Path
+import json
+
+import numpy as np
+
+
+class EmbeddingStore:
+    """
+    Sharded embeddings written by `python -m tta.embed`, looked up by image id.
+    Each shard_XXXXX.npy is memory-mapped, and shard_XXXXX.txt lists the ids of
+    its rows.
+    """
+
+    def __init__(self, path: Path):
+        meta = EmbeddingStore.meta(path)
+        if meta is None:
+            raise ValueError(f'No embedding store found at {path}')
+
+        self.path = path
+        self.dim: int = meta['dim']
+        self.shards = []
+        self.index: Dict[str, tuple] = {}
+        for shard_file in sorted(path.glob('shard_?????.npy')):
+            ids = shard_file.with_suffix('.txt').read_text().splitlines()
+            for row, key in enumerate(ids):
+                self.index[key] = len(self.shards), row
+            self.shards.append(np.load(shard_file, mmap_mode='r'))
+
+        if len(self.index) != meta['count']:
+            raise ValueError(
+                f'Embedding store at {path} is incomplete ({len(self.index)} of {meta["count"]}), '
+                'resume it with python -m tta.embed'
+            )
+
+    def __getitem__(self, key):
+        shard, row = self.index[key]
+        return self.shards[shard][row]
+
+    @staticmethod
+    def meta(path: Path) -> Optional[Dict]:
+        meta_file = path / 'meta.json'
+        if not meta_file.is_file():
+            return None
+
+        return json.loads(meta_file.read_text())
@@ -1,12 +1,15 @@
 from typing import Optional
 from hashlib import sha256
+import json
 
 import numpy as np
 import pandas as pd
 from pandas.api.types import CategoricalDtype
-import torch
+from PIL import Image
+import torchvision.transforms as T
 
 from tta.datasets.cxr import MultipleDomainCXR
+from tta.datasets.cxr.embedding import EmbeddingStore
 
 
 class MultipleDomainMIMIC(MultipleDomainCXR):
@@ -24,7 +27,12 @@ class MultipleDomainMIMIC(MultipleDomainCXR):
         train_domain = next(iter(train_domains))
         patient_col = "subject_id"
 
-        input_shape = (1, 1376)
+        # embeddings extracted by tta.embed take precedence over mimic.npz
+        embedding_meta = EmbeddingStore.meta(root / "embeddings")
+        if embedding_meta is not None:
+            input_shape = (1, embedding_meta["dim"])
+        else:
+            input_shape = (1, 1376)
         C = 2
         K = 2
         confounder_strength = np.linspace(0, 1, 21)
@@ -37,6 +45,8 @@ class MultipleDomainMIMIC(MultipleDomainCXR):
         m.update(Z_col.encode())
         m.update(str(target_domain_count).encode())
         m.update(str(source_domain_count).encode())
+        if embedding_meta is not None:
+            m.update(json.dumps(embedding_meta, sort_keys=True).encode())
 
         m.update(str(input_shape).encode())
         m.update(str(C).encode())
@@ -47,25 +57,20 @@ class MultipleDomainMIMIC(MultipleDomainCXR):
 
         super().__init__(input_shape, C, K, confounder_strength, train_domain, hexdigest)
 
-        cache_key = f'{train_domain}_{Y_col}_{Z_col}_{target_domain_count}_{source_domain_count}_{hexdigest}'
-        cache_file = root / 'cached' / f'{cache_key}.pt'
-        if cache_file.is_file():
-            # NOTE: The torch.Generator state won't be the same if we load from cache
-            print(f'Loading cached datasets from {cache_file}')
-            self.domains = torch.load(cache_file)
-            return
+        self.setup(root, generator, hexdigest, use_embedding, Y_col, Z_col, patient_col,
+                target_domain_count, source_domain_count)
 
-        print('Building datasets... (this may take a while)')
-        if root is None:
-            raise ValueError('Data directory not specified!')
 
-        self.generator = generator
-        self.train_domains = train_domains
+    def load(self):
+        root, Y_col, Z_col = self.root, self.Y_col, self.Z_col
 
         labels_raw: pd.DataFrame = pd.read_csv(root / "mimic_labels_raw.csv", index_col="dicom_id")
         mimic_attributes: pd.DataFrame = pd.read_csv(root / "mimic_attributes.csv", index_col="dicom_id")
         labels = labels_raw.join(mimic_attributes, rsuffix="_attr")
-        datastore = np.load(root / "mimic.npz")
+        if EmbeddingStore.meta(root / "embeddings") is not None:
+            datastore = EmbeddingStore(root / "embeddings")
+        else:
+            datastore = np.load(root / "mimic.npz")
 
         #   Pneumonia
         #  0 = negative     - 24303
@@ -104,9 +109,27 @@ class MultipleDomainMIMIC(MultipleDomainCXR):
             labels = labels.loc[~labels[column].isna()]
             labels[column] = labels[column].cat.codes
 
-        self.domains = self.build(generator, datastore, labels, Y_col, Z_col, patient_col, target_domain_count, source_domain_count)
-
-        if use_embedding:
-            cache_file.parent.mkdir(parents=True, exist_ok=True)
-            print(f'Saving cached datasets to {cache_file}')
-            torch.save(self.domains, cache_file)
+        return datastore, labels
+
+
+class MIMICImages:
+    """
+    Images of MIMIC-CXR-JPG, which are stored as
+    files/p<first two digits of subject_id>/p<subject_id>/s<study_id>/<dicom_id>.jpg
+    """
+    def __init__(self, root, labels):
+        self.root = root
+        self.subject_id = labels["subject_id"]
+        self.study_id = labels["study_id"]
+        self.transform = T.Compose([
+            T.Resize((224, 224)),
+            T.ToTensor(),
+            T.Lambda(lambda x: x.permute(1, 2, 0)), # (C, H, W) -> (H, W, C)
+        ])
+
+    def __getitem__(self, key):
+        subject_id = str(self.subject_id.at[key])
+        study_id = str(self.study_id.at[key])
+        path = self.root / "files" / f"p{subject_id[:2]}" / f"p{subject_id}" / f"s{study_id}" / f"{key}.jpg"
+        image = Image.open(path).convert("RGB")
+        return self.transform(image)
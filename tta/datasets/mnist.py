@@ -10,6 +10,7 @@ from torchvision import transforms as T
 from PIL import Image
 
 from tta.datasets import MultipleDomainDataset
+from tta.cache import cache
 
 
 class MultipleDomainMNIST(MultipleDomainDataset):
@@ -55,68 +56,82 @@ class MultipleDomainMNIST(MultipleDomainDataset):
 
         super().__init__(input_shape, C, K, confounder_strength, train_domain, hexdigest)
 
-        cache_key = f'{train_domain}_{apply_rotation}_{feature_noise}_{label_noise}_{hexdigest}'
-        cache_file = root / 'cached' / f'{cache_key}.pt'
-        if cache_file.is_file():
-            # NOTE: The torch.Generator state won't be the same if we load from cache
-            print(f'Loading cached datasets from {cache_file}')
-            self.domains = torch.load(cache_file)
-            return
-
-        print('Building datasets... (this may take a while)')
         if root is None:
             raise ValueError('Data directory not specified!')
 
-        self.generator = generator
+        self.root = root
+        self.cache_key = hexdigest
+        self.apply_rotation = apply_rotation
         self.train_domains = train_domains
         self.feature_noise = feature_noise
         self.label_noise = label_noise
 
-        original_dataset_tr = MNIST(root, train=True, download=True)
-        original_dataset_te = MNIST(root, train=False, download=True)
+        # Each domain gets its own generator so that it can be built independently
+        self.seeds = torch.randint(2**62, (len(confounder_strength) + 1,), generator=generator)
+        self.original = None
+
+    def build_domain(self, i):
+        filename = f'domain{i}.pt'
+        entry = cache.lookup('datasets', self.cache_key)
+        if entry is not None and (entry / filename).is_file():
+            print(f'Loading cached domain {i} from {entry / filename}')
+            domain = torch.load(entry / filename)
+            # the domain is in memory, so the entry may be evicted
+            cache.release('datasets', self.cache_key)
+            return domain
+
+        print(f'Building domain {i}... (this may take a while)')
+        if self.original is None:
+            original_dataset_tr = MNIST(self.root, train=True, download=True)
+            original_dataset_te = MNIST(self.root, train=False, download=True)
 
-        original_images = torch.cat((original_dataset_tr.data,
-                                     original_dataset_te.data))
+            original_images = torch.cat((original_dataset_tr.data,
+                                         original_dataset_te.data))
 
-        original_labels = torch.cat((original_dataset_tr.targets,
-                                     original_dataset_te.targets))
-        original_labels = (original_labels < 5).long()
+            original_labels = torch.cat((original_dataset_tr.targets,
+                                         original_dataset_te.targets))
+            original_labels = (original_labels < 5).long()
 
-        shuffle = torch.randperm(len(original_images), generator=self.generator)
+            generator = torch.Generator().manual_seed(int(self.seeds[-1]))
+            shuffle = torch.randperm(len(original_images), generator=generator)
 
-        original_images = original_images[shuffle]
-        original_labels = original_labels[shuffle]
+            self.original = original_images[shuffle], original_labels[shuffle]
+
+        original_images, original_labels = self.original
 
         # P(Z|Y)
-        if apply_rotation:
+        if self.apply_rotation:
             anchor1 = np.array([[0.5, 0.5, 0.0, 0.0], [0.0, 0.0, 0.5, 0.5]])
             anchor2 = np.array([[0.0, 0.0, 0.5, 0.5], [0.5, 0.5, 0.0, 0.0]])
         else:
             anchor1 = np.array([[1.0, 0.0], [0.0, 1.0]])
             anchor2 = np.array([[0.0, 1.0], [1.0, 0.0]])
 
-        for i, strength in enumerate(self.confounder_strength):
-            offset = 0 if i in train_domains else 1
-            images = original_images[offset::2]
-            labels = original_labels[offset::2]
-            conditional = torch.from_numpy(strength * anchor1 + (1-strength) * anchor2)
-            domain = self.shift(images, labels, conditional)
+        strength = self.confounder_strength[i]
+        offset = 0 if i in self.train_domains else 1
+        images = original_images[offset::2]
+        labels = original_labels[offset::2]
+        conditional = torch.from_numpy(strength * anchor1 + (1-strength) * anchor2)
+        generator = torch.Generator().manual_seed(int(self.seeds[i]))
+        domain = self.shift(images, labels, conditional, generator)
 
-            counter = Counter(labels.numpy())
-            y_count = torch.zeros(C)
-            for label in counter:
-                y_count[label] += counter[label]
-            y_freq = y_count / len(labels)
-            joint_M = y_freq[:, np.newaxis] * conditional
+        counter = Counter(labels.numpy())
+        y_count = torch.zeros(self.C)
+        for label in counter:
+            y_count[label] += counter[label]
+        y_freq = y_count / len(labels)
+        joint_M = y_freq[:, np.newaxis] * conditional
 
-            self.domains.append((domain, joint_M))
+        cache_file = cache.entry('datasets', self.cache_key) / filename
+        print(f'Saving cached domain {i} to {cache_file}')
+        torch.save((domain, joint_M), cache_file)
+        cache.commit('datasets', self.cache_key)
+        cache.release('datasets', self.cache_key)
 
-        cache_file.parent.mkdir(parents=True, exist_ok=True)
-        print(f'Saving cached datasets to {cache_file}')
-        torch.save(self.domains, cache_file)
+        return domain, joint_M
 
 
-    def shift(self, images, y_tilde, conditional):
+    def shift(self, images, y_tilde, conditional, generator):
         lookup_table = torch.cumsum(conditional, dim=1)
         to_tensor = T.ToTensor()
         N = y_tilde.size(0)
@@ -128,10 +143,10 @@ class MultipleDomainMNIST(MultipleDomainDataset):
         else:
             weights = torch.zeros((N, self.C))
             weights[torch.arange(N), y_tilde] = 1
-        y = torch.multinomial(weights, 1, generator=self.generator).squeeze(dim=-1)
+        y = torch.multinomial(weights, 1, generator=generator).squeeze(dim=-1)
 
         # generate Z condition on Y
-        values = torch.rand((N, 1), generator=self.generator)
+        values = torch.rand((N, 1), generator=generator)
         z_idx = torch.searchsorted(lookup_table[y], values).squeeze(dim=-1)
         z = self.Z[z_idx]
         z_flattened = len(self.angles) * z[:, 0] + z[:, 1]
@@ -148,7 +163,7 @@ class MultipleDomainMNIST(MultipleDomainDataset):
             image = to_tensor(image)
             image = image.permute(1, 2, 0)
 
-            noise = self.feature_noise * torch.randn(image.size(), generator=self.generator)
+            noise = self.feature_noise * torch.randn(image.size(), generator=generator)
             image = torch.clamp(image + noise, 0, 1)
 
             x[i] = image
@@ -0,0 +1,130 @@
+from typing import Optional
+from hashlib import sha256
+
+import numpy as np
+import torch
+
+from tta.utils import Dataset
+from tta.datasets import MultipleDomainDataset
+
+
+class MultipleDomainSynthetic(MultipleDomainDataset):
+    """
+    Gaussian mixtures shaped like the CXR datasets, for runs without the data.
+
+    Every sample of the group (Y, Z) is drawn from N(mu(Y_tilde, Z), feature_noise^2 I),
+    where mu(y, z) = (2y - 1) a + (2z - 1) b for orthogonal unit vectors a and
+    b, and Y_tilde is Y flipped with probability label_noise.  The domains
+    shift P(Z|Y) like MNIST, from anti-correlated to correlated, and have
+    exactly round(count * joint_M) samples per group.  The samples are
+    generated on access from their index, so the domains take no memory nor
+    disk, and are not cached.
+    """
+
+    def __init__(self, train_domains, generator, use_embedding: bool, target_domain_count: int,
+            source_domain_count: Optional[int], feature_noise: float, label_noise: float, dim: Optional[int]):
+        if len(train_domains) != 1:
+            raise NotImplementedError(
+                "Training on multiple source distributions is not supported yet."
+            )
+        train_domain = next(iter(train_domains))
+
+        if use_embedding:
+            input_shape = (1, dim or 1376)
+        else:
+            input_shape = (1, dim or 224, dim or 224, 3)
+        C = 2
+        K = 2
+        confounder_strength = np.linspace(0, 1, 21)
+
+        m = sha256()
+        m.update(self.__class__.__name__.encode())
+        m.update(str(sorted(train_domains)).encode())
+        m.update(generator.get_state().numpy().data.hex().encode())
+        m.update(str(use_embedding).encode())
+        m.update(str(target_domain_count).encode())
+        m.update(str(source_domain_count).encode())
+        m.update(str(feature_noise).encode())
+        m.update(str(label_noise).encode())
+
+        m.update(str(input_shape).encode())
+        m.update(str(C).encode())
+        m.update(str(K).encode())
+        m.update(confounder_strength.data.hex().encode())
+        m.update(str(train_domain).encode())
+        hexdigest = m.hexdigest()
+
+        super().__init__(input_shape, C, K, confounder_strength, train_domain, hexdigest)
+
+        if feature_noise <= 0:
+            raise ValueError(f"The classes are separable with {feature_noise = }")
+
+        self.target_domain_count = target_domain_count
+        self.source_domain_count = source_domain_count or target_domain_count
+        self.feature_noise = feature_noise
+        self.label_noise = label_noise
+
+        # Each domain gets its own generator so that it can be built independently
+        self.seeds = torch.randint(2**62, (len(confounder_strength) + 1,), generator=generator)
+
+        # the directions of Y and Z
+        generator = torch.Generator().manual_seed(int(self.seeds[-1]))
+        directions, _ = torch.linalg.qr(torch.randn((int(np.prod(input_shape[1:])), 2), generator=generator))
+        self.a, self.b = directions.T
+
+    def build_domain(self, i):
+        # P(Y, Z)
+        anchor1 = np.array([[0.5, 0.0], [0.0, 0.5]])
+        anchor2 = np.array([[0.0, 0.5], [0.5, 0.0]])
+
+        strength = self.confounder_strength[i]
+        joint_M = torch.from_numpy(strength * anchor1 + (1-strength) * anchor2)
+        domain_count = self.source_domain_count if i == self.train_domain else self.target_domain_count
+        count = self.fix_count(joint_M, domain_count)
+        print(f"histogram(M) = {count.flatten()}")
+
+        generator = torch.Generator().manual_seed(int(self.seeds[i]))
+        M = torch.repeat_interleave(torch.arange(self.C * self.K), count.flatten())
+        M = M[torch.randperm(domain_count, generator=generator)]
+        y, z = M // self.K, M % self.K
+
+        # inject noise to Y
+        flip = torch.rand(domain_count, generator=generator) < self.label_noise
+        y_tilde = torch.where(flip, 1 - y, y)
+
+        seed = int(torch.randint(2**62, (), generator=generator))
+        domain = GaussianMixtureDomain(self, seed, y_tilde, y, z)
+
+        return domain, count / domain_count
+
+    def fix_count(self, joint_M, domain_count):
+        """The counts per group closest to domain_count * joint_M, by largest remainder."""
+        expected = domain_count * joint_M.flatten()
+        count = torch.floor(expected).long()
+        remainder = domain_count - int(torch.sum(count))
+        count[torch.argsort(expected - count, descending=True)[:remainder]] += 1
+
+        return count.reshape(joint_M.shape)
+
+
+class GaussianMixtureDomain(Dataset):
+
+    def __init__(self, dataset: MultipleDomainSynthetic, seed: int, y_tilde: torch.Tensor, y: torch.Tensor,
+            z: torch.Tensor):
+        self.shape = dataset.input_shape[1:]
+        self.a, self.b = dataset.a, dataset.b
+        self.feature_noise = dataset.feature_noise
+        self.seed = seed
+        self.y_tilde = y_tilde
+        self.y = y
+        self.z = z
+
+    def __len__(self):
+        return len(self.y)
+
+    def __getitem__(self, idx):
+        y_tilde, y, z = self.y_tilde[idx], self.y[idx], self.z[idx]
+        generator = torch.Generator().manual_seed(self.seed + idx)
+        mu = (2 * y_tilde - 1) * self.a + (2 * z - 1) * self.b
+        x = mu + self.feature_noise * torch.randn(mu.size(), generator=generator)
+        return x.reshape(self.shape), y_tilde, y, z
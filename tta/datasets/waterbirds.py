@@ -1,21 +1,44 @@
-from collections import Counter
+from pathlib import Path
+from hashlib import sha256
+
 import numpy as np
 import torch
 from torchvision import transforms as T
 
+from tta.utils import Dataset
 from tta.datasets import MultipleDomainDataset
+from tta.cache import cache
 
 
 class MultipleDomainWaterbirds(MultipleDomainDataset):
 
     domain_names = ['train', 'val', 'test']
 
-    def __init__(self, root, generator):
+    def __init__(self, root, train_domains, generator):
+        if len(train_domains) != 1:
+            raise NotImplementedError(
+                "Training on multiple source distributions is not supported yet."
+            )
+        train_domain = next(iter(train_domains))
+
         input_shape = (1, 224, 224, 3)
         C = 2
         K = 2
         confounder_strength = np.array([0, 1, 2])
-        super().__init__(input_shape, C, K, confounder_strength)
+
+        m = sha256()
+        m.update(self.__class__.__name__.encode())
+        m.update(str(sorted(train_domains)).encode())
+        m.update(generator.get_state().numpy().data.hex().encode())
+
+        m.update(str(input_shape).encode())
+        m.update(str(C).encode())
+        m.update(str(K).encode())
+        m.update(confounder_strength.data.hex().encode())
+        m.update(str(train_domain).encode())
+        hexdigest = m.hexdigest()
+
+        super().__init__(input_shape, C, K, confounder_strength, train_domain, hexdigest)
 
         if root is None:
             raise ValueError('Data directory not specified!')
@@ -28,6 +51,11 @@ class MultipleDomainWaterbirds(MultipleDomainDataset):
         # make Z compliant in shape
         self.waterbirds._metadata_array = self.waterbirds._metadata_array[:, 0]
 
+        # ImageNet augmentation (RandomResizedCrop + RandomHorizontalFlip) is
+        # applied by train_step on the device, see tta.augment
+        self.device_augmentation = True
+
+    def build_domain(self, i):
         # P(Z|Y)
         conditionals = [
             np.array([[0.95, 0.05], [0.05, 0.95]]),
@@ -35,36 +63,77 @@ class MultipleDomainWaterbirds(MultipleDomainDataset):
             np.array([[0.5, 0.5], [0.5, 0.5]]),
         ]
 
-        # ImageNet augmentation
-        normalize = T.Normalize(mean=[0.485, 0.456, 0.406],
-                                std=[0.229, 0.224, 0.225])
-        permute = T.Lambda(lambda x: x.permute(1, 2, 0))
-        random_transform = T.Compose([
-            T.RandomResizedCrop(224),
-            T.RandomHorizontalFlip(),
-            T.ToTensor(),
-            normalize,
-            permute,
-        ])
-        deterministic_transform = T.Compose([
-            T.Resize(256),
-            T.CenterCrop(224),
-            T.ToTensor(),
-            normalize,
-            permute,
-        ])
-
-        for env in self.confounder_strength:
-            conditional = torch.from_numpy(conditionals[env])
-            domain_name = self.domain_names[env]
-            transform = random_transform if domain_name == 'train' else deterministic_transform
-            domain = self.waterbirds.get_subset(domain_name, transform=transform)
-
-            counter = Counter(int(label) for _, label, _ in domain)
-            y_count = torch.zeros(C)
-            for label in counter:
-                y_count[label] += counter[label]
-            y_freq = y_count / len(domain)
-            joint_M = y_freq[:, np.newaxis] * conditional
-
-            self.domains.append((domain, joint_M))
+        env = self.confounder_strength[i]
+        conditional = torch.from_numpy(conditionals[env])
+        domain_name = self.domain_names[env]
+        split_id = self.waterbirds.split_dict[domain_name]
+        indices = np.flatnonzero(self.waterbirds.split_array == split_id)
+
+        # Read the label and group statistics from the metadata instead of
+        # decoding every image
+        Y = self.waterbirds.y_array[indices]
+        Z = self.waterbirds.metadata_array[indices]
+        group_count = torch.zeros((self.C, self.K))
+        group_count.index_put_((Y, Z), torch.ones(len(indices)), accumulate=True)
+        print(f"histogram(M) = {group_count.flatten().long()}")
+
+        y_count = torch.sum(group_count, dim=1)
+        y_freq = y_count / len(indices)
+        joint_M = y_freq[:, np.newaxis] * conditional
+
+        # The preprocessed images do not depend on the seed, so they are
+        # shared by every run on the same data directory
+        m = sha256()
+        m.update(str(self.waterbirds.data_dir).encode())
+        m.update('resize256_crop224'.encode())
+        store_key = m.hexdigest()
+
+        cache.lookup('datasets', store_key)
+        store_file = cache.entry('datasets', store_key) / f'{domain_name}.npy'
+        domain = PreprocessedWaterbirdsImages(self.waterbirds, indices, store_file)
+        cache.commit('datasets', store_key)
+
+        return domain, joint_M
+
+
+class PreprocessedWaterbirdsImages(Dataset):
+    """
+    Serve images passed through the deterministic Resize(256) + CenterCrop(224)
+    from a memory-mapped uint8 store, which is built on first use.  The images
+    stay uint8 until they reach the device, where the model normalizes them
+    (see tta.augment.normalize), so that the workers only copy bytes.
+
+    The training crops of tta.augment are sampled from these center crops
+    rather than from the full image, which slightly narrows the training
+    distribution compared with torchvision's RandomResizedCrop.
+    """
+
+    def __init__(self, waterbirds, indices: np.ndarray, store_file: Path):
+        self.waterbirds = waterbirds
+        self.indices = indices
+        self.transform = T.Compose([T.Resize(256), T.CenterCrop(224)])
+
+        if not store_file.is_file():
+            print(f'Building preprocessed images at {store_file}... (this may take a while)')
+            store_file.parent.mkdir(parents=True, exist_ok=True)
+            partial_file = store_file.with_suffix('.partial.npy')
+            store = np.lib.format.open_memmap(
+                partial_file, mode='w+', dtype=np.uint8, shape=(len(indices), 224, 224, 3)
+            )
+            for j, i in enumerate(indices):
+                store[j] = np.asarray(self.transform(self.waterbirds.get_input(i)))
+            store.flush()
+            del store
+            partial_file.rename(store_file)
+
+        self.store = np.load(store_file, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        i = self.indices[idx]
+        x = torch.from_numpy(np.array(self.store[idx]))
+        y = self.waterbirds.y_array[i]
+        z = self.waterbirds.metadata_array[i]
+        return x, y, y, z
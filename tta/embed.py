@@ -0,0 +1,139 @@
+"""
+Extract embeddings of chest X-rays with a pretrained backbone.
+
+The embeddings are written in shards of `--shard_size` images to the embedding
+store read by MultipleDomainCheXpert and MultipleDomainMIMIC (by default
+`<root>/embeddings`).  Finished shards are skipped, so an interrupted
+extraction resumes from the first missing shard.
+
+Usage:
+    python -m tta.embed --dataset_name CheXpert --model ResNet50 \
+        --pretrained_path pretrained/ResNet50_ImageNet1k --num_workers 48
+"""
+
+from typing import List, Optional
+from pathlib import Path
+import json
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pandas as pd
+from torch.utils.data import DataLoader
+import click
+
+from tta.utils import Dataset
+from tta.mesh import replicate
+from tta.train import create_train_state
+from tta.restore import restore_train_state
+from tta.features import feature_dim, compute_features
+from tta.datasets.cxr.chexpert import CheXpertImages
+from tta.datasets.cxr.mimic import MIMICImages
+
+
+class ImageList(Dataset):
+    def __init__(self, images, ids: List[str]):
+        self.images = images
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        return self.images[self.ids[idx]]
+
+
+@click.command()
+@click.option("--dataset_name", type=click.Choice(["CheXpert", "MIMIC"]), required=True)
+@click.option("--root", type=click.Path(path_type=Path), required=False)
+@click.option("--output", type=click.Path(path_type=Path), required=False)
+@click.option("--model", type=str, required=True)
+@click.option("--pretrained_path", type=click.Path(path_type=Path), required=False)
+@click.option("--batch_size", type=int, required=False, default=512)
+@click.option("--shard_size", type=int, required=False, default=16384)
+@click.option("--num_workers", type=int, required=True)
+def main(
+    dataset_name: str,
+    root: Optional[Path],
+    output: Optional[Path],
+    model: str,
+    pretrained_path: Optional[Path],
+    batch_size: int,
+    shard_size: int,
+    num_workers: int,
+) -> None:
+    if not model.startswith("ResNet"):
+        raise ValueError(f"Model {model} does not expose pooled features")
+
+    if dataset_name == "CheXpert":
+        root = root or Path("data/CheXpert")
+        labels = pd.read_csv(root / "labels.csv", index_col="image_id")
+        images = CheXpertImages(root)
+    elif dataset_name == "MIMIC":
+        root = root or Path("data/MIMIC")
+        labels = pd.read_csv(root / "mimic_labels_raw.csv", index_col="dicom_id")
+        images = MIMICImages(root, labels)
+    else:
+        raise ValueError(f"Unknown dataset {dataset_name}")
+
+    output = output or root / "embeddings"
+    output.mkdir(parents=True, exist_ok=True)
+    ids = [str(key) for key in labels.index]
+
+    device_count = jax.device_count()
+    specimen = jnp.empty((1, 224, 224, 3))
+    state = create_train_state(jax.random.PRNGKey(0), 2, 2, model, 0, specimen, device_count)
+    if pretrained_path is not None:
+        state = restore_train_state(state, pretrained_path)
+    state = replicate(state)
+
+    meta = {
+        "dataset_name": dataset_name,
+        "model": model,
+        "pretrained_path": str(pretrained_path),
+        "dim": feature_dim(state),
+        "shard_size": shard_size,
+        "count": len(ids),
+    }
+    meta_file = output / "meta.json"
+    if meta_file.is_file():
+        existing_meta = json.loads(meta_file.read_text())
+        if existing_meta != meta:
+            raise ValueError(f"Cannot resume {output}, which was extracted with {existing_meta}")
+    else:
+        meta_file.write_text(json.dumps(meta, indent=2))
+
+    shard_count = (len(ids) + shard_size - 1) // shard_size
+    for shard in range(shard_count):
+        shard_file = output / f"shard_{shard:05d}.npy"
+        if shard_file.is_file():
+            print(f"Skipping finished shard {shard + 1}/{shard_count}")
+            continue
+
+        print(f"Extracting shard {shard + 1}/{shard_count}")
+        shard_ids = ids[shard * shard_size : (shard + 1) * shard_size]
+        partial_file = shard_file.with_suffix(".partial.npy")
+        embeddings = np.lib.format.open_memmap(
+            partial_file, mode="w+", dtype=np.float32, shape=(len(shard_ids), meta["dim"])
+        )
+
+        loader = DataLoader(
+            ImageList(images, shard_ids),
+            batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+        )
+        offset = 0
+        for X in loader:
+            N = X.shape[0]
+            embeddings[offset : offset + N] = compute_features(state, X, batch_size)
+            offset += N
+
+        embeddings.flush()
+        del embeddings
+        shard_file.with_suffix(".txt").write_text("\n".join(shard_ids) + "\n")
+        partial_file.rename(shard_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Pooled features of a frozen backbone, stored as memory-mapped arrays."""
+
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from tta.utils import Dataset
+from tta.train import TrainState, feature_step
+from tta.mesh import pad_batch
+
+
+class FeatureDataset(Dataset):
+    def __init__(self, features_file: Path, labels_file: Path):
+        self.features = np.load(features_file, mmap_mode='r')
+        self.labels = np.load(labels_file)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        x = torch.from_numpy(np.array(self.features[idx]))
+        y_tilde, y, z = self.labels[idx]
+        return x, y_tilde, y, z
+
+
+def feature_dim(state: TrainState) -> int:
+    """Width of the pre_logits features, i.e. the input width of the classification head."""
+    return state.params['net']['output_projection']['kernel'].shape[-2]
+
+
+def compute_features(state: TrainState, X: torch.Tensor, batch_size: int) -> np.ndarray:
+    """Pooled features of a batch, which is padded to `batch_size` so that feature_step compiles once."""
+    N = X.shape[0]
+    (X,), _ = pad_batch((X,), batch_size)
+
+    feature = np.asarray(feature_step(state, X))
+
+    return feature[:N]
+
+
+def extract_features(state: TrainState, dataset: Dataset, entry: Path, name: str,
+        batch_size: int, num_workers: int) -> FeatureDataset:
+    """
+    Run the backbone over the dataset once and store the pooled features in
+    `entry`, unless they are stored there already.
+    """
+    features_file = entry / f'{name}_features.npy'
+    labels_file = entry / f'{name}_labels.npy'
+    if features_file.is_file():
+        return FeatureDataset(features_file, labels_file)
+
+    print(f'Extracting features of {name} to {features_file}...')
+    D = feature_dim(state)
+    labels = np.empty((len(dataset), 3), dtype=np.int64)
+    partial_file = features_file.with_suffix('.partial.npy')
+    features = np.lib.format.open_memmap(
+        partial_file, mode='w+', dtype=np.float32, shape=(len(dataset), D)
+    )
+
+    loader = DataLoader(
+        dataset,
+        batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+    )
+    offset = 0
+    for X, Y_tilde, Y, Z in loader:
+        N = X.shape[0]
+        features[offset:offset + N] = compute_features(state, X, batch_size)
+        labels[offset:offset + N] = torch.stack((Y_tilde, Y, Z), dim=-1).numpy()
+        offset += N
+
+    features.flush()
+    del features
+    np.save(labels_file, labels)
+    partial_file.rename(features_file)
+
+    return FeatureDataset(features_file, labels_file)
@@ -0,0 +1,212 @@
+"""
+High-water marks of device and host memory per phase of a run.
+
+tta.pipeline wraps its phases (training, calibration, inducing the source
+prior and every adaptation) in `phase`.  While a phase runs, a background
+thread samples the memory every `interval` seconds, and the phase keeps the
+largest values seen since it started:
+
+- live: the bytes of the live JAX arrays on the fullest device,
+- device_peak: the bytes in use reported by the device allocator, which also
+  covers the activations that are not JAX arrays (GPU and TPU only),
+- rss_peak: the resident set size of the process.
+
+Each comes with its growth over the value at the start of the phase, e.g.
+live_growth, i.e. the memory the phase itself needs.  The peak RSS of the
+kernel (VmHWM) is reset at the start of every phase, so rss_peak also covers
+the spikes between two samples.  JAX cannot reset the peak of the device
+allocator, so device_peak is exact when the phase raised the peak of the
+process, and otherwise the largest sample.
+
+On CPU devices the arrays live in the process, so rss_peak is the number to
+size batch sizes and worker counts by.  tta.cli prints `report()` at the end
+of a run and writes the record next to the results (`<name>.memory.json`).
+
+With a profile directory, a pprof device memory profile is written at the end
+of every phase, and whenever the process receives SIGUSR1, e.g.
+`kill -USR1 <pid>` on a run that is about to run out of memory.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import math
+import re
+import signal
+import threading
+
+from tta.cache import format_size
+
+
+# phase name -> quantity -> largest value in bytes
+phases: Dict[str, Dict[str, int]] = {}
+profile_dir: Optional[Path] = None
+profile_count = 0
+interval = 0.05
+GROWTH = {"live": "live_growth", "device_peak": "device_growth", "rss_peak": "rss_growth"}
+
+# the peaks of the running phases, updated by the sampler thread
+active: List[Dict[str, int]] = []
+lock = threading.Lock()
+sampler: Optional[threading.Thread] = None
+stopped = threading.Event()
+
+
+def reset(profile_to: Optional[Path] = None, sample_interval: float = 0.05) -> None:
+    global profile_dir, profile_count, interval
+    phases.clear()
+    profile_dir = profile_to
+    profile_count = 0
+    interval = sample_interval
+    if profile_dir is not None:
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        # signal handlers can only be installed from the main thread
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: dump("signal"))
+
+
+def rss() -> Dict[str, int]:
+    """The current and peak resident set size, from /proc/self/status."""
+    sizes = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                # in kB
+                sizes[key] = int(value.split()[0]) * 1024
+
+    return sizes
+
+
+def reset_rss_peak() -> None:
+    """Reset VmHWM to the current RSS, where the kernel allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def device_stats() -> Dict[str, int]:
+    import jax
+
+    in_use = peak = 0
+    for device in jax.local_devices():
+        stats = device.memory_stats()
+        if stats is not None:
+            in_use = max(in_use, stats.get("bytes_in_use", 0))
+            peak = max(peak, stats.get("peak_bytes_in_use", 0))
+
+    return {"in_use": in_use, "peak": peak}
+
+
+def live() -> int:
+    import jax
+
+    sizes: Dict[Any, int] = defaultdict(int)
+    for array in jax.live_arrays():
+        try:
+            if array.is_deleted():
+                continue
+            shard_bytes = math.prod(array.sharding.shard_shape(array.shape)) * array.dtype.itemsize
+            for device in array.sharding.addressable_devices:
+                sizes[device] += shard_bytes
+        except (RuntimeError, ValueError):
+            # e.g. donated while sampling
+            continue
+
+    return max(sizes.values(), default=0)
+
+
+def sample() -> Dict[str, int]:
+    sizes = rss()
+    return {
+        "live": live(),
+        "device_peak": device_stats()["in_use"],
+        "rss_peak": max(sizes.get("VmRSS", 0), sizes.get("VmHWM", 0)),
+    }
+
+
+def update(peaks: Dict[str, int], values: Dict[str, int]) -> None:
+    for quantity, value in values.items():
+        peaks[quantity] = max(peaks.get(quantity, 0), value)
+
+
+def run_sampler() -> None:
+    while not stopped.wait(interval):
+        values = sample()
+        with lock:
+            for peaks in active:
+                update(peaks, values)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    global sampler
+
+    with lock:
+        # the enclosing phases keep the peak RSS up to the reset
+        if active:
+            values = sample()
+            for outer in active:
+                update(outer, values)
+        reset_rss_peak()
+        start = sample()
+        device_start = device_stats()["peak"]
+        peaks = dict(start)
+        active.append(peaks)
+        if sampler is None:
+            stopped.clear()
+            sampler = threading.Thread(target=run_sampler, name="memory-sampler", daemon=True)
+            sampler.start()
+    try:
+        yield
+    finally:
+        with lock:
+            active.remove(peaks)
+            if not active:
+                stopped.set()
+                done, sampler = sampler, None
+            else:
+                done = None
+        if done is not None:
+            done.join()
+
+        update(peaks, sample())
+        device_end = device_stats()["peak"]
+        if device_end > device_start:
+            # the allocator reached its highest peak so far during the phase
+            update(peaks, {"device_peak": device_end})
+
+        growth = {GROWTH[quantity]: peaks[quantity] - start[quantity] for quantity in start}
+        update(phases.setdefault(name, {}), {**peaks, **growth})
+
+        if profile_dir is not None:
+            dump(name)
+
+
+def dump(name: str) -> None:
+    """Write a device memory profile, e.g. for `go tool pprof`."""
+    global profile_count
+    import jax
+
+    profile_count += 1
+    path = profile_dir / f"{profile_count:03d}_{re.sub(r'[^A-Za-z0-9_.=-]+', '_', name)}.prof"
+    jax.profiler.save_device_memory_profile(str(path))
+    print(f"Wrote device memory profile to {path}")
+
+
+def report() -> str:
+    lines = []
+    for name, peaks in phases.items():
+        lines.append(f"{name}: " + ", ".join(f"{quantity} {format_size(value)}" for quantity, value in peaks.items()))
+
+    return "\n".join(lines) if lines else "No phases"
+
+
+def write(prefix: Path) -> None:
+    path = prefix.with_name(f"{prefix.name}.memory.json")
+    path.write_text(json.dumps(phases, indent=2))
+    print(f"Wrote memory high-water marks to {path}")
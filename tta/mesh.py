@@ -0,0 +1,67 @@
+"""
+Data parallelism over a one-dimensional mesh of all devices.  The step
+functions in tta.train are jitted, every batch is sharded along its sample
+axis, and everything else, e.g. the TrainState, is replicated.
+
+Batches are padded to the batch size of their loader, so that every step
+function sees a single shape and compiles once.  A mask marks the real
+samples, and the step functions leave the padding out of every sum.
+"""
+
+from typing import Any, List, Sequence, Tuple
+from functools import lru_cache
+import os
+
+import numpy as np
+import jax
+from jax.sharding import Mesh, NamedSharding, PartitionSpec
+
+
+def set_host_device_count(count: int) -> None:
+    """
+    Expose `count` devices on the host platform, e.g. one per CPU socket.
+    This only takes effect before JAX initializes its backends.
+    """
+    flags = os.environ.get("XLA_FLAGS", "").split()
+    flags = [flag for flag in flags if not flag.startswith("--xla_force_host_platform_device_count")]
+    flags.append(f"--xla_force_host_platform_device_count={count}")
+    os.environ["XLA_FLAGS"] = " ".join(flags)
+
+
+@lru_cache(maxsize=None)
+def mesh() -> Mesh:
+    return Mesh(np.array(jax.devices()), ("batch",))
+
+
+def replicate(tree: Any) -> Any:
+    return jax.device_put(tree, NamedSharding(mesh(), PartitionSpec()))
+
+
+def shard(tree: Any, axis: int = 0) -> Any:
+    """Split the sample axis `axis` of every array in `tree` across the devices."""
+    spec = PartitionSpec(*(None,) * axis, "batch")
+    return jax.device_put(tree, NamedSharding(mesh(), spec))
+
+
+def pad_samples(arrays: Sequence[Any], size: int) -> Tuple[List[np.ndarray], np.ndarray]:
+    """
+    Pad the sample axis of every array, e.g. a torch tensor from a loader, with
+    zeros to `size` on the host.  Also returns the mask of the real samples.
+    """
+    N = len(arrays[0])
+    if N > size:
+        raise ValueError(f"Batch of {N} samples does not fit into {size}")
+
+    padded = []
+    for array in arrays:
+        array = np.asarray(array)
+        padded.append(np.concatenate((array, np.zeros((size - N, *array.shape[1:]), array.dtype))))
+
+    return padded, np.arange(size) < N
+
+
+def pad_batch(arrays: Sequence[Any], size: int) -> Tuple[List[jax.Array], jax.Array]:
+    """Pad the arrays of a batch and their mask with pad_samples, and shard them."""
+    padded, mask = pad_samples(arrays, size)
+
+    return shard(padded), shard(mask)
@@ -5,6 +5,7 @@ from flax import linen as nn
 from tta.models.linear import Linear
 from tta.models.lenet import LeNet
 from tta.models.resnet import ResNet
+from tta.augment import normalize
 
 
 class AdaptiveNN(nn.Module):
@@ -37,6 +38,10 @@ class AdaptiveNN(nn.Module):
                                           (self.M,))
 
     def raw_logit(self, x, train: bool):
+        # images are kept uint8 until they reach the device
+        if x.dtype == jnp.uint8:
+            x = normalize(x)
+
         logit = self.net(x, train)
 
         return logit
@@ -0,0 +1,1572 @@
+"""
+Everything tta.cli runs besides plotting: building the dataset, training,
+calibrating and estimating the source prior of the members, and adapting
+and evaluating them.  This module imports JAX, torch and scikit-learn, so
+tta.cli only imports it for runs that are not --plot_only.
+"""
+
+from typing import Any, Iterator, Sequence, List, Tuple, Set, Optional, Dict
+from pathlib import Path
+from hashlib import sha256
+from itertools import product
+from pprint import pprint
+import copy
+
+import jax
+import jax.numpy as jnp
+from jax.experimental.compilation_cache.compilation_cache import initialize_cache
+import flax
+from flax.training.checkpoints import save_checkpoint, restore_checkpoint
+import numpy as np
+import torch
+from torch.utils.data import Dataset, ConcatDataset, DataLoader
+from sklearn.metrics import roc_auc_score
+
+from tta.common import Adaptation, Curves, Sweeps, EMSweeps, EM_ITERATION_BINS
+from tta.cache import cache
+from tta.registry import dataset_class
+from tta.mesh import replicate, shard, pad_samples, pad_batch
+from tta.datasets import MultipleDomainDataset, split, subsample
+from tta.train import (
+    TrainState,
+    create_train_state,
+    stack_members,
+    concatenate_members,
+    member_count,
+    has_batch_norm,
+    train_step,
+    train_multi_step,
+    train_member_step,
+    train_member_multi_step,
+    train_epoch,
+    train_lbfgs,
+    validation_step,
+    calibration_step,
+    logit_step,
+    calibration_lbfgs,
+    induce_step,
+    adapt_step,
+    em_telemetry_step,
+    test_step,
+    ensemble_step,
+)
+from tta.restore import restore_train_state
+from tta.features import extract_features
+from tta.utils import MemberBatchSampler
+from tta import timing, memory, transfers
+
+
+jit_cache_initialized = False
+
+
+def initialize_jit_cache() -> None:
+    """Point the persistent compilation cache at the cache directory, once per process."""
+    global jit_cache_initialized
+    if not jit_cache_initialized:
+        initialize_cache(str(cache.namespace("jit")))
+        jit_cache_initialized = True
+
+
+# Datasets built so far, keyed by the arguments of build_dataset.  It is only
+# enabled by tta.sweep, which runs many configurations in the same process.
+dataset_memo: Optional[Dict[Tuple, Tuple[MultipleDomainDataset, torch.Tensor]]] = None
+
+
+def build_dataset(
+    dataset_name: str,
+    dataset_y_column: Optional[str],
+    dataset_z_column: Optional[str],
+    dataset_target_domain_count: Optional[int],
+    dataset_source_domain_count: Optional[int],
+    dataset_use_embedding: Optional[bool],
+    dataset_apply_rotation: Optional[bool],
+    dataset_feature_noise: float,
+    dataset_label_noise: float,
+    dataset_dim: Optional[int],
+    train_domains_set: Set[int],
+    generator: torch.Generator,
+) -> MultipleDomainDataset:
+    if dataset_name == "MNIST":
+        assert dataset_y_column is None
+        assert dataset_z_column is None
+        assert dataset_target_domain_count is None
+        assert dataset_source_domain_count is None
+        assert dataset_use_embedding is None
+        assert dataset_apply_rotation is not None
+        assert dataset_dim is None
+
+        root = Path("data/mnist")
+        dataset = dataset_class("MNIST")(
+            root,
+            train_domains_set,
+            generator,
+            dataset_apply_rotation,
+            dataset_feature_noise,
+            dataset_label_noise,
+        )
+    elif dataset_name == "COCO":
+        assert dataset_y_column is None
+        assert dataset_z_column is None
+        assert dataset_target_domain_count is None
+        assert dataset_source_domain_count is None
+        assert dataset_use_embedding is None
+        assert dataset_apply_rotation is None
+        assert dataset_dim is None
+        assert dataset_feature_noise == 0
+        assert dataset_label_noise == 0
+
+        root = Path("data/COCO/train2017")
+        annFile = Path("data/COCO/annotations/instances_train2017.json")
+        dataset = dataset_class("COCO")(root, annFile, train_domains_set, generator)
+    elif dataset_name == "Waterbirds":
+        assert dataset_y_column is None
+        assert dataset_z_column is None
+        assert dataset_target_domain_count is None
+        assert dataset_source_domain_count is None
+        assert dataset_use_embedding is None
+        assert dataset_apply_rotation is None
+        assert dataset_dim is None
+        assert dataset_feature_noise == 0
+        assert dataset_label_noise == 0
+
+        root = Path("data/")
+        dataset = dataset_class("Waterbirds")(root, train_domains_set, generator)
+    elif dataset_name == "CheXpert":
+        assert dataset_y_column is not None
+        assert dataset_z_column is not None
+        assert dataset_target_domain_count is not None
+        assert dataset_use_embedding is not None
+        assert dataset_apply_rotation is None
+        assert dataset_dim is None
+        assert dataset_feature_noise == 0
+        assert dataset_label_noise == 0
+
+        root = Path("data/CheXpert")
+        dataset = dataset_class("CheXpert")(
+            root,
+            train_domains_set,
+            generator,
+            dataset_y_column,
+            dataset_z_column,
+            dataset_use_embedding,
+            dataset_target_domain_count,
+            dataset_source_domain_count,
+        )
+    elif dataset_name == "MIMIC":
+        assert dataset_y_column is not None
+        assert dataset_z_column is not None
+        assert dataset_target_domain_count is not None
+        assert dataset_use_embedding is True
+        assert dataset_apply_rotation is None
+        assert dataset_dim is None
+        assert dataset_feature_noise == 0
+        assert dataset_label_noise == 0
+
+        root = Path("data/MIMIC")
+        dataset = dataset_class("MIMIC")(
+            root,
+            train_domains_set,
+            generator,
+            dataset_y_column,
+            dataset_z_column,
+            dataset_use_embedding,
+            dataset_target_domain_count,
+            dataset_source_domain_count,
+        )
+    elif dataset_name == "Synthetic":
+        assert dataset_y_column is None
+        assert dataset_z_column is None
+        assert dataset_target_domain_count is not None
+        assert dataset_use_embedding is not None
+        assert dataset_apply_rotation is None
+
+        dataset = dataset_class("Synthetic")(
+            train_domains_set,
+            generator,
+            dataset_use_embedding,
+            dataset_target_domain_count,
+            dataset_source_domain_count,
+            dataset_feature_noise,
+            dataset_label_noise,
+            dataset_dim,
+        )
+    else:
+        raise ValueError(f"Unknown dataset {dataset_name}")
+
+    return dataset
+
+
+def prepare_dataset(
+    dataset_name: str,
+    dataset_y_column: Optional[str],
+    dataset_z_column: Optional[str],
+    dataset_target_domain_count: Optional[int],
+    dataset_source_domain_count: Optional[int],
+    dataset_subsample_what: str,
+    dataset_use_embedding: Optional[bool],
+    dataset_apply_rotation: Optional[bool],
+    dataset_feature_noise: float,
+    dataset_label_noise: float,
+    dataset_dim: Optional[int],
+    train_domains_set: Set[int],
+    train_fraction: float,
+    train_calibration_fraction: float,
+    calibration_domains_set: Set[int],
+    calibration_fraction: float,
+    eval_domains_set: Optional[Set[int]],
+    generator: torch.Generator,
+) -> Tuple[
+    MultipleDomainDataset,
+    Tuple[Dataset, torch.Tensor],
+    Tuple[Dataset, torch.Tensor],
+    List[Tuple[Dataset, torch.Tensor]],
+]:
+    # the arguments of build_dataset, together with the state of the generator it consumes
+    memo_key = (
+        dataset_name,
+        dataset_y_column,
+        dataset_z_column,
+        dataset_target_domain_count,
+        dataset_source_domain_count,
+        dataset_use_embedding,
+        dataset_apply_rotation,
+        dataset_feature_noise,
+        dataset_label_noise,
+        dataset_dim,
+        tuple(sorted(train_domains_set)),
+        generator.get_state().numpy().tobytes(),
+    )
+    if dataset_memo is not None and memo_key in dataset_memo:
+        dataset, generator_state = dataset_memo[memo_key]
+        generator.set_state(generator_state)
+    else:
+        with timing.span("build_dataset", dataset_name=dataset_name):
+            dataset = build_dataset(
+                dataset_name,
+                dataset_y_column,
+                dataset_z_column,
+                dataset_target_domain_count,
+                dataset_source_domain_count,
+                dataset_use_embedding,
+                dataset_apply_rotation,
+                dataset_feature_noise,
+                dataset_label_noise,
+                dataset_dim,
+                train_domains_set,
+                generator,
+            )
+        if dataset_memo is not None:
+            dataset_memo[memo_key] = dataset, generator.get_state()
+
+    # The digest is mutated below, so leave the memoized dataset intact. The
+    # domains, which are built lazily, are still shared.
+    dataset = copy.copy(dataset)
+
+    C, K = dataset.C, dataset.K
+    if C != 2 or K != 2:
+        raise NotImplementedError("Multi-label classification is not supported yet.")
+
+    m = sha256()
+    m.update(dataset.hexdigest.encode())
+    m.update(dataset_subsample_what.encode())
+    dataset.hexdigest = m.hexdigest()
+
+    with timing.span("split"):
+        (train, joint_train), (calibration, joint_calibration), test_splits = split(
+            dataset,
+            train_domains_set,
+            train_fraction,
+            train_calibration_fraction,
+            calibration_domains_set,
+            calibration_fraction,
+            eval_domains_set,
+        )
+    print("domains:", {i: len(domain) for i, (domain, _) in dataset.domains.items()})
+    print("train (before subsampling):", len(train))
+    print(joint_train)
+    print("calibration (before subsampling):", len(calibration))
+    print(joint_calibration)
+
+    if dataset_subsample_what != "none":
+        with timing.span("subsample"):
+            train, joint_train = subsample(train, joint_train, dataset_subsample_what, generator)
+            calibration, joint_calibration = subsample(calibration, joint_calibration, dataset_subsample_what, generator)
+        print("train (after subsampling):", len(train))
+        print(joint_train)
+        print("calibration (after subsampling):", len(calibration))
+        print(joint_calibration)
+
+    (train_domain,) = train_domains_set
+    test_split_train, joint_M_train = test_splits[train_domain]
+    print(f"test_split_train:", len(test_split_train))
+    print(joint_M_train)
+
+    eval_splits = test_splits.copy()
+    eval_splits.append((train, joint_train))
+
+    return (
+        dataset,
+        (train, joint_train),
+        (calibration, joint_calibration),
+        eval_splits,
+    )
+
+
+def freeze_backbone(
+    dataset: MultipleDomainDataset,
+    train: Tuple[Dataset, torch.Tensor],
+    calibration: Tuple[Dataset, torch.Tensor],
+    eval_splits: List[Tuple[Dataset, torch.Tensor]],
+    train_model: str,
+    train_pretrained_path: Optional[Path],
+    split_key: Tuple,
+    batch_size: int,
+    key: Any,
+    num_workers: int,
+) -> Tuple[
+    Tuple[Dataset, torch.Tensor],
+    Tuple[Dataset, torch.Tensor],
+    List[Tuple[Dataset, torch.Tensor]],
+]:
+    """
+    Replace every split with the pooled features of the pretrained backbone,
+    so that only a linear head has to be trained on top of them.
+    """
+    if not train_model.startswith("ResNet") or train_pretrained_path is None:
+        raise ValueError("Freezing the backbone requires a pretrained ResNet")
+
+    device_count = jax.device_count()
+    specimen = jnp.empty(dataset.input_shape)
+    state = create_train_state(key, dataset.C, dataset.K, train_model, 0, specimen, device_count)
+    state = replicate(restore_train_state(state, train_pretrained_path))
+
+    m = sha256()
+    m.update(dataset.hexdigest.encode())
+    m.update(train_model.encode())
+    m.update(str(train_pretrained_path).encode())
+    m.update(str(split_key).encode())
+    hexdigest = m.hexdigest()
+
+    cache.lookup("features", hexdigest)
+    entry = cache.entry("features", hexdigest)
+
+    train_dataset, joint_train = train
+    calibration_dataset, joint_calibration = calibration
+    train_features = extract_features(state, train_dataset, entry, "train", batch_size, num_workers)
+    calibration_features = extract_features(state, calibration_dataset, entry, "calibration", batch_size, num_workers)
+    eval_features = []
+    for i, (eval_, joint_M) in enumerate(eval_splits):
+        if eval_ is train_dataset:
+            eval_features.append((train_features, joint_M))
+        elif len(eval_) == 0:
+            eval_features.append((eval_, joint_M))
+        else:
+            features = extract_features(state, eval_, entry, f"eval{i}", batch_size, num_workers)
+            eval_features.append((features, joint_M))
+
+    cache.commit("features", hexdigest)
+
+    dataset.input_shape = (1, train_features.features.shape[-1])
+    dataset.device_augmentation = False
+    dataset.hexdigest = hexdigest
+
+    return (train_features, joint_train), (calibration_features, joint_calibration), eval_features
+
+
+def main(
+    npz_paths: List[Path],
+    dataset: MultipleDomainDataset,
+    train: ConcatDataset,
+    joint_train: torch.Tensor,
+    calibration: ConcatDataset,
+    joint_calibration: torch.Tensor,
+    eval_splits: List[Tuple[Dataset, torch.Tensor]],
+    train_domains_set: Set[int],
+    calibration_domains_set: Set[int],
+    dataset_label_noise: float,
+    train_fit_joint: bool,
+    train_model: str,
+    train_pretrained_path: Optional[Path],
+    train_batch_size: int,
+    train_epochs: int,
+    train_decay: float,
+    train_patience: int,
+    train_tau: float,
+    train_lr: float,
+    train_scan_steps: int,
+    train_engine: str,
+    train_solver: str,
+    train_l2: float,
+    calibration_batch_size: int,
+    calibration_epochs: int,
+    calibration_decay: float,
+    calibration_patience: int,
+    calibration_tau: float,
+    calibration_lr: float,
+    calibration_solver: str,
+    adapt_skip_null_oracle: bool,
+    adapt_gmtl_alpha: Sequence[float],
+    adapt_prior_strength: Sequence[float],
+    adapt_symmetric_dirichlet: Sequence[bool],
+    adapt_fix_marginal: Sequence[bool],
+    test_argmax_joint: Sequence[bool],
+    test_batch_size: Sequence[int],
+    test_ensemble: bool,
+    members: Optional[TrainState],
+    keys: Any,
+    generator: torch.Generator,
+    num_workers: int,
+) -> List[Dict[str, Tuple[Curves, str]]]:
+    device_count = jax.device_count()
+    assert (
+        train_batch_size % device_count == 0
+    ), f"train_batch_size should be divisible by {device_count}"
+    assert (
+        calibration_batch_size % device_count == 0
+    ), f"calibration_batch_size should be divisible by {device_count}"
+    for batch_size in test_batch_size:
+        assert (
+            batch_size % device_count == 0
+        ), f"test_batch_size should be divisible by {device_count}"
+
+    if members is not None:
+        state = replicate(members)
+    else:
+        state = train_fn(
+            dataset,
+            train,
+            joint_train,
+            calibration,
+            joint_calibration,
+            train_fit_joint,
+            train_model,
+            train_pretrained_path,
+            train_batch_size,
+            train_epochs,
+            train_decay,
+            train_patience,
+            train_tau,
+            train_lr,
+            train_scan_steps,
+            train_engine,
+            train_solver,
+            train_l2,
+            calibration_batch_size,
+            calibration_epochs,
+            calibration_decay,
+            calibration_patience,
+            calibration_tau,
+            calibration_lr,
+            calibration_solver,
+            keys,
+            generator,
+            device_count,
+            num_workers,
+        )
+
+    mean_sweeps, l1_sweeps, auc_sweeps, auc_Z_sweeps, accuracy_sweeps, accuracy_Z_sweeps, norm_sweeps = baseline_fn(
+        state,
+        dataset,
+        eval_splits,
+        dataset_label_noise,
+        train_domains_set,
+        train_batch_size,
+        calibration_domains_set,
+        adapt_skip_null_oracle,
+        adapt_gmtl_alpha,
+        test_ensemble,
+        generator,
+        num_workers,
+    )
+
+    # only EM reports its iterations
+    em_iterations_sweeps = {}
+    em_converged_sweeps = {}
+    em_objective_sweeps = {}
+    em_histogram_sweeps = {}
+    for (
+        prior_strength,
+        symmetric_dirichlet,
+        fix_marginal,
+        argmax_joint,
+        batch_size,
+    ) in product(
+        adapt_prior_strength,
+        adapt_symmetric_dirichlet,
+        adapt_fix_marginal,
+        test_argmax_joint,
+        test_batch_size,
+    ):
+        adaptation = ("EM", prior_strength, symmetric_dirichlet, fix_marginal)
+        state, (
+            mean_sweep,
+            l1_sweep,
+            auc_sweep,
+            auc_Z_sweep,
+            accuracy_sweep,
+            accuracy_Z_sweep,
+            norm_sweep,
+        ), (
+            em_iterations_sweep,
+            em_converged_sweep,
+            em_objective_sweep,
+            em_histogram_sweep,
+        ) = adapt_fn(
+            state,
+            dataset.C,
+            dataset.K,
+            dataset_label_noise,
+            train_domains_set,
+            calibration_domains_set,
+            eval_splits,
+            adaptation,
+            argmax_joint,
+            batch_size,
+            test_ensemble,
+            generator,
+            num_workers,
+        )
+        k = adaptation, argmax_joint, batch_size
+        mean_sweeps[k] = mean_sweep
+        l1_sweeps[k] = l1_sweep
+        auc_sweeps[k] = auc_sweep
+        auc_Z_sweeps[k] = auc_Z_sweep
+        accuracy_sweeps[k] = accuracy_sweep
+        accuracy_Z_sweeps[k] = accuracy_Z_sweep
+        norm_sweeps[k] = norm_sweep
+        em_iterations_sweeps[k] = em_iterations_sweep
+        em_converged_sweeps[k] = em_converged_sweep
+        em_objective_sweeps[k] = em_objective_sweep
+        em_histogram_sweeps[k] = em_histogram_sweep
+
+    all_sweeps = {
+        "mean": (mean_sweeps, "Average probability of class 1"),
+        "l1": (l1_sweeps, "Average L1 error of class 1"),
+        "auc": (auc_sweeps, "AUC"),
+        "auc_Z": (auc_Z_sweeps, "AUC (Z)"),
+        "accuracy": (accuracy_sweeps, "Accuracy"),
+        "accuracy_Z": (accuracy_Z_sweeps, "Accuracy (Z)"),
+        "norm": (norm_sweeps, "Euclidean distance"),
+        "em_iterations": (em_iterations_sweeps, "EM iterations per batch"),
+        "em_converged": (em_converged_sweeps, "Fraction of batches EM converged on"),
+        "em_objective": (em_objective_sweeps, "EM objective per sample"),
+        "em_histogram": (em_histogram_sweeps, "Batches by EM iterations"),
+    }
+    pprint(all_sweeps)
+
+    # every sweep has a leading member axis, ending with the ensemble with
+    # test_ensemble, and every member is saved on its own
+    all_member_sweeps = []
+    for i, npz_path in enumerate(npz_paths):
+        member_sweeps = {
+            sweep_type: ({k: np.asarray(sweep[i]) for k, sweep in sweeps.items()}, ylabel)
+            for sweep_type, (sweeps, ylabel) in all_sweeps.items()
+        }
+        all_member_sweeps.append(member_sweeps)
+
+        if npz_path.exists():
+            all_existing_sweeps = dict(**np.load(npz_path, allow_pickle=True))
+            for sweep_type in member_sweeps.keys():
+                sweeps, ylabel = member_sweeps[sweep_type]
+                # e.g. the EM sweeps, which older results do not have
+                if sweep_type not in all_existing_sweeps:
+                    all_existing_sweeps[sweep_type] = sweeps, ylabel
+                    continue
+
+                existing_sweeps, existing_ylabel = all_existing_sweeps[sweep_type]
+                assert ylabel == existing_ylabel
+
+                existing_sweeps.update(sweeps)
+                all_existing_sweeps[sweep_type] = existing_sweeps, existing_ylabel
+
+            np.savez(npz_path, **all_existing_sweeps)
+
+        else:
+            np.savez(npz_path, **member_sweeps)
+
+    return all_member_sweeps
+
+
+def train_fn(
+    dataset: MultipleDomainDataset,
+    train: ConcatDataset,
+    joint_train: torch.Tensor,
+    calibration: ConcatDataset,
+    joint_calibration: torch.Tensor,
+    train_fit_joint: bool,
+    train_model: str,
+    train_pretrained_path: Optional[Path],
+    train_batch_size: int,
+    train_epochs: int,
+    train_decay: float,
+    train_patience: int,
+    train_tau: float,
+    train_lr: float,
+    train_scan_steps: int,
+    train_engine: str,
+    train_solver: str,
+    train_l2: float,
+    calibration_batch_size: int,
+    calibration_epochs: int,
+    calibration_decay: float,
+    calibration_patience: int,
+    calibration_tau: float,
+    calibration_lr: float,
+    calibration_solver: str,
+    keys: Any,
+    generator: torch.Generator,
+    device_count: int,
+    num_workers: int,
+) -> TrainState:
+    if len(calibration) == 0 and calibration_epochs > 0:
+        raise ValueError("Calibration set may not be empty")
+    if train_solver == "lbfgs" and train_model != "Linear":
+        raise ValueError(f"L-BFGS requires a convex model, not {train_model}")
+
+    C, K = dataset.C, dataset.K
+    # Every member splits its own key exactly like a run with a single member,
+    # and the state of every member is stacked along a leading member axis.
+    split_members = jax.vmap(jax.random.split, out_axes=1)
+    keys_init, keys = split_members(keys)
+    specimen = jnp.empty(dataset.input_shape)
+    states = []
+    for key_init in keys_init:
+        state = create_train_state(
+            key_init,
+            C,
+            K,
+            train_model,
+            train_lr,
+            specimen,
+            device_count,
+        )
+        if train_pretrained_path is not None:
+            state = restore_train_state(state, train_pretrained_path)
+        states.append(state)
+    state = stack_members(states)
+
+    # Every stage is checkpointed under a digest of everything it depends on,
+    # so runs that only differ in later stages share the earlier checkpoints.
+    m = sha256()
+    m.update(dataset.hexdigest.encode())
+    m.update(str((len(train), len(calibration))).encode())
+    m.update(str(train_fit_joint).encode())
+    m.update(train_model.encode())
+    m.update(str(train_pretrained_path).encode())
+    train_key = (train_batch_size, train_epochs, train_decay, train_patience, train_tau, train_lr)
+    m.update(str(train_key).encode())
+    m.update(str((train_engine, train_solver, train_l2)).encode())
+    # the validation loss used for early stopping is computed in calibration batches
+    m.update(str(calibration_batch_size).encode())
+    m.update(str(keys).encode())
+    train_hexdigest = m.hexdigest()
+
+    m.update(b"calibrate")
+    calibration_key = (calibration_batch_size, calibration_epochs, calibration_decay, calibration_patience, calibration_tau, calibration_lr)
+    m.update(str(calibration_key).encode())
+    m.update(calibration_solver.encode())
+    calibration_hexdigest = m.hexdigest()
+
+    m.update(b"prior")
+    prior_hexdigest = m.hexdigest()
+
+    stages = {
+        "train": train_hexdigest,
+        "calibrate": calibration_hexdigest,
+        "prior": prior_hexdigest,
+    }
+    # the checkpoint names only mention the hyperparameters their stage depends on
+    train_prefix = f"{dataset.__class__.__name__}_{dataset.train_domain}_{train_model}_{train_tau}"
+    prefixes = {
+        "train": train_prefix,
+        "calibrate": f"{train_prefix}_{calibration_tau}",
+        "prior": f"{train_prefix}_{calibration_tau}",
+    }
+
+    # Each stage shuffles with its own generator, so that the result does not
+    # depend on which of the earlier stages were restored
+    train_generator, calibration_generator, prior_generator = (
+        torch.Generator().manual_seed(int(seed))
+        for seed in torch.randint(2**62, (len(stages),), generator=generator)
+    )
+
+    stage = None
+    for name in reversed(stages):
+        restored = restore_stage(state, name, stages[name], prefixes[name])
+        if restored is not None:
+            print(f"Restoring {name} checkpoint with prefix = {prefixes[name]}_{name}_{stages[name]}_")
+
+            # HACK: backward compatibility for legacy checkpoints
+            # prior = restored.prior.unfreeze()
+            # print('prior["source"]', prior["source"])
+            # prior["source"] = jnp.ones_like(prior["source"])
+            # prior["source"] = prior["source"] / jnp.sum(prior["source"])
+            # print('prior["source"]', prior["source"])
+            # restored = restored.replace(prior=flax.core.frozen_dict.freeze(prior))
+
+            state, stage = restored, name
+            break
+    else:
+        print(f"Cannot find any checkpoint with {prefixes = }")
+
+    state: TrainState = replicate(state)
+    key_augment, keys = split_members(keys)
+    key_shuffle, keys = split_members(keys)
+    S = member_count(state)
+
+    # The loaders pad their last batch (see tta.mesh.pad_batch), except for
+    # those feeding train-mode steps of a model with BatchNorm: padding would
+    # leak into its batch statistics, so they drop the last partial batch,
+    # which is drawn anew each epoch.  Other models leave the padding out of
+    # every sum, so they keep it.
+    drop_last = has_batch_norm(state)
+    if drop_last and len(train) < train_batch_size:
+        raise ValueError(f"The training split has only {len(train)} samples, fewer than {train_batch_size = }")
+
+    if S == 1:
+        train_loader = DataLoader(
+            train,
+            train_batch_size,
+            shuffle=True,
+            num_workers=num_workers,
+            generator=train_generator,
+            drop_last=drop_last,
+        )
+    else:
+        # every member shuffles with a generator drawn from its own key, like in train_epoch
+        member_seeds = jax.device_get(jax.vmap(lambda key: jax.random.randint(key, (), 0, 2**31 - 1))(key_shuffle))
+        train_loader = DataLoader(
+            train,
+            batch_sampler=MemberBatchSampler(
+                len(train), train_batch_size, [torch.Generator().manual_seed(int(seed)) for seed in member_seeds], drop_last
+            ),
+            num_workers=num_workers,
+        )
+    if len(calibration) or calibration_epochs:
+        validation_loader = DataLoader(
+            calibration,
+            calibration_batch_size,
+            shuffle=True,
+            num_workers=num_workers,
+            generator=train_generator,
+        )
+        calibration_loader = DataLoader(
+            calibration,
+            calibration_batch_size,
+            shuffle=True,
+            num_workers=num_workers,
+            generator=calibration_generator,
+            drop_last=calibration_solver == "sgd" and drop_last,
+        )
+    else:
+        validation_loader = calibration_loader = None
+
+    if stage is None:
+        with timing.span("train"), memory.phase("train"), timing.profiling():
+            print("===> Training")
+            joint_train_jnp = replicate(jnp.asarray(joint_train.flatten().numpy()))
+            train_tau_jnp = replicate(jnp.float32(train_tau))
+            if train_solver == "lbfgs":
+                # train_epochs bounds the number of L-BFGS iterations
+                with timing.span("data"):
+                    X, M, mask = load_in_memory(train, dataset.input_shape, train_batch_size, K, num_workers)
+                with timing.span("step"):
+                    state, (loss, iterations, converged) = train_lbfgs(
+                        state, X, M, mask, K, train_fit_joint, train_tau_jnp, joint_train_jnp,
+                        replicate(jnp.float32(train_l2)), replicate(jnp.int32(train_epochs)),
+                    )
+                with timing.span("sync"):
+                    loss, iterations, converged = jax.device_get((loss, iterations, converged))
+                with jnp.printoptions(precision=4):
+                    print(
+                        f"L-BFGS objective: {loss}, iterations: {iterations}, converged: {converged}"
+                    )
+            elif train_engine == "memory":
+                state = train_memory_fn(
+                    state,
+                    train,
+                    calibration,
+                    dataset.input_shape,
+                    K,
+                    train_fit_joint,
+                    train_batch_size,
+                    train_epochs,
+                    train_decay,
+                    train_patience,
+                    train_tau_jnp,
+                    calibration_batch_size,
+                    joint_train_jnp,
+                    key_shuffle,
+                    key_augment,
+                    dataset.device_augmentation,
+                    num_workers,
+                )
+            else:
+                # each member takes its own batches and stops early on its own
+                epoch_loss_valid_ema = None
+                min_epoch_loss_valid_ema = np.full(S, np.inf)
+                wait = np.zeros(S, dtype=int)
+                active = np.ones(S, dtype=bool)
+                for epoch in range(train_epochs):
+                    with timing.profile_window(epoch), timing.span("train_epoch", epoch=epoch):
+                        epoch_loss = replicate(np.zeros(S, dtype=np.float32))
+                        epoch_hit = replicate(np.zeros((S, C * K), dtype=np.int32))
+                        epoch_total = replicate(np.zeros((S, C * K), dtype=np.int32))
+                        active_jnp = replicate(active)
+                        batches = stack_batches(train_loader, K, train_scan_steps, train_batch_size, S)
+                        for stacked, X, M, mask in timing.spanned(batches):
+                            if S == 1:
+                                step_fn = train_multi_step if stacked else train_step
+                            else:
+                                step_fn = train_member_multi_step if stacked else train_member_step
+                            with timing.span("step"), transfers.hot_loop():
+                                state, (loss, hit, total) = step_fn(
+                                    state, X, M, mask, K, train_fit_joint, train_tau_jnp, joint_train_jnp, key_augment, dataset.device_augmentation, active_jnp
+                                )
+                                epoch_loss += loss
+                                epoch_hit += hit
+                                epoch_total += total
+
+                        with timing.span("sync"):
+                            epoch_loss, epoch_hit, epoch_total = jax.device_get((epoch_loss, epoch_hit, epoch_total))
+
+                        if validation_loader is None:
+                            with jnp.printoptions(precision=3):
+                                print(
+                                    f"Train epoch {epoch + 1}, loss: {epoch_loss}, hit: {epoch_hit}, total: {epoch_total}"
+                                )
+
+                            continue
+
+                        epoch_loss_valid = 0
+                        with timing.span("validation"):
+                            for X, _, Y, Z in timing.spanned(validation_loader):
+                                (X, M), mask = pad_batch((X, Y * K + Z), calibration_batch_size)
+
+                                loss_valid = validation_step(state, X, M, mask, K, train_fit_joint, train_tau_jnp, joint_train_jnp)
+                                epoch_loss_valid += np.asarray(loss_valid)
+
+                        if epoch_loss_valid_ema is None:
+                            epoch_loss_valid_ema = epoch_loss_valid
+                        else:
+                            epoch_loss_valid_ema = (1 - train_decay) * epoch_loss_valid_ema + train_decay * epoch_loss_valid
+
+                        with jnp.printoptions(precision=3):
+                            print(
+                                f"Train epoch {epoch + 1}, loss: {epoch_loss} (val: {epoch_loss_valid}, ema: {epoch_loss_valid_ema}), hit: {epoch_hit}, total: {epoch_total}"
+                            )
+
+                        improved = epoch_loss_valid < min_epoch_loss_valid_ema
+                        wait = np.where(improved, 0, wait + 1)
+                        min_epoch_loss_valid_ema = np.where(improved, epoch_loss_valid_ema, min_epoch_loss_valid_ema)
+
+                        active = stop_early(active, wait, train_patience, f"{train_decay = }, {train_patience = }", min_epoch_loss_valid_ema)
+                        if not active.any():
+                            break
+
+        save_stage(state, "train", train_hexdigest, prefixes["train"])
+
+    if stage in (None, "train"):
+        with timing.span("calibrate"), memory.phase("calibrate"):
+            print("===> Calibrating")
+            joint_calibration_jnp = replicate(jnp.asarray(joint_calibration.flatten().numpy()))
+            calibration_tau_jnp = replicate(jnp.float32(calibration_tau))
+            epoch_loss_ema = None
+            min_epoch_loss_ema = np.full(S, np.inf)
+            wait = np.zeros(S, dtype=int)
+            active = np.ones(S, dtype=bool)
+            if calibration_loader is not None and calibration_solver == "lbfgs" and calibration_epochs > 0:
+                # calibration_epochs bounds the number of L-BFGS iterations
+                with timing.span("logits"):
+                    logit, M, mask = compute_logits(calibration_loader, state, K)
+                with timing.span("step"):
+                    state, (loss, iterations, converged) = calibration_lbfgs(
+                        state, logit, M, mask, K, train_fit_joint, calibration_tau_jnp, joint_calibration_jnp,
+                        replicate(jnp.int32(calibration_epochs)),
+                    )
+                with timing.span("sync"):
+                    loss, iterations, converged = jax.device_get((loss, iterations, converged))
+                with jnp.printoptions(precision=4):
+                    print(
+                        f"L-BFGS objective: {loss}, iterations: {iterations}, converged: {converged}"
+                    )
+            elif calibration_loader is not None:
+                calibration_lr_jnp = replicate(jnp.float32(calibration_lr))
+                for epoch in range(calibration_epochs):
+                    with timing.span("calibration_epoch", epoch=epoch):
+                        epoch_loss = 0
+                        epoch_hit = replicate(np.zeros((S, C * K), dtype=np.int32))
+                        epoch_total = replicate(np.zeros((S, C * K), dtype=np.int32))
+                        active_jnp = replicate(active)
+                        for X, _, Y, Z in timing.spanned(calibration_loader):
+                            (X, M), mask = pad_batch((X, Y * K + Z), calibration_batch_size)
+
+                            with timing.span("step"), transfers.hot_loop():
+                                state, (loss, hit, total) = calibration_step(
+                                    state, X, M, mask, K, train_fit_joint, calibration_tau_jnp, calibration_lr_jnp, joint_calibration_jnp, active_jnp
+                                )
+                                epoch_hit += hit
+                                epoch_total += total
+                            with timing.span("sync"):
+                                epoch_loss += jax.device_get(loss)
+
+                        if epoch_loss_ema is None:
+                            epoch_loss_ema = epoch_loss
+                        else:
+                            epoch_loss_ema = (1 - calibration_decay) * epoch_loss_ema + calibration_decay * epoch_loss
+
+                        with jnp.printoptions(precision=3):
+                            print(
+                                f"Calibration epoch {epoch + 1}, loss: {epoch_loss} (ema: {epoch_loss_ema}), hit: {epoch_hit}, total: {epoch_total}"
+                            )
+
+                        improved = epoch_loss_ema < min_epoch_loss_ema
+                        wait = np.where(improved, 0, wait + 1)
+                        min_epoch_loss_ema = np.where(improved, epoch_loss_ema, min_epoch_loss_ema)
+
+                        active = stop_early(active, wait, calibration_patience, f"{calibration_decay = }, {calibration_patience = }", min_epoch_loss_ema)
+                        if not active.any():
+                            break
+
+        save_stage(state, "calibrate", calibration_hexdigest, prefixes["calibrate"])
+
+    print("---> Temperature =", state.params["T"])
+    print("---> Bias =", state.params["b"])
+
+    if stage != "prior":
+        if train_tau == 0 or calibration_tau == 0:
+            # When doing logit adjustment, the source label distribution should be
+            # uniform, as we effectively trained on an invariant domain. Since
+            # "source" defaults to a uniform distribution, we only need to update
+            # it when tau == 0.
+            with timing.span("source_prior"), memory.phase("induce"):
+                print("===> Estimating Source Label Prior")
+                source_prior_induced = estimate_source_prior(
+                    calibration,
+                    calibration_batch_size,
+                    num_workers,
+                    prior_generator,
+                    C,
+                    K,
+                    state,
+                    "induce",
+                )
+                source_prior_empirical = estimate_source_prior(
+                    train,
+                    train_batch_size,
+                    num_workers,
+                    prior_generator,
+                    C,
+                    K,
+                    state,
+                    "count",
+                )
+
+                print("---> Induced source label prior =", source_prior_induced)
+                print("---> Empirical source label prior =", source_prior_empirical)
+                tvd = jnp.sum(jnp.abs(source_prior_induced - source_prior_empirical), axis=-1) / 2
+                print("---> Total variation distance =", tvd)
+
+                prior = state.prior.unfreeze()
+                prior["source"] = replicate(source_prior_induced)
+                state = state.replace(prior=flax.core.frozen_dict.freeze(prior))
+
+        save_stage(state, "prior", prior_hexdigest, prefixes["prior"])
+
+    return state
+
+
+def restore_stage(state: TrainState, stage: str, hexdigest: str, prefix: str) -> Optional[TrainState]:
+    ckpt_dir = cache.lookup("checkpoints", hexdigest)
+    if ckpt_dir is None:
+        return None
+
+    try:
+        restored = restore_checkpoint(ckpt_dir, state, prefix=f"{prefix}_{stage}_{hexdigest}_")
+    finally:
+        # the state is in memory, so the entry may be evicted, e.g. during a sweep
+        cache.release("checkpoints", hexdigest)
+    return None if restored is state else restored
+
+
+def save_stage(state: TrainState, stage: str, hexdigest: str, prefix: str) -> None:
+    path = save_checkpoint(cache.entry("checkpoints", hexdigest), state, 0, f"{prefix}_{stage}_{hexdigest}_")
+    cache.commit("checkpoints", hexdigest)
+    cache.release("checkpoints", hexdigest)
+    print(f"Saved {stage} checkpoint to {path}")
+
+
+def load_members(
+    paths: Sequence[Path],
+    dataset: MultipleDomainDataset,
+    train_model: str,
+    key: Any,
+) -> TrainState:
+    """
+    Stack the members saved in the prior checkpoints at `paths`, e.g. of the
+    same configuration with different seeds, to evaluate them together.
+    """
+    device_count = jax.device_count()
+    specimen = jnp.empty(dataset.input_shape)
+    target = stack_members([create_train_state(key, dataset.C, dataset.K, train_model, 0, specimen, device_count)])
+
+    states = []
+    for path in paths:
+        print(f"Loading member {len(states)} from {path}")
+        state = restore_checkpoint(path, target)
+        if state is target:
+            raise ValueError(f"Cannot find a checkpoint at {path}")
+        if member_count(state) != 1:
+            raise ValueError(
+                f"{path} holds {member_count(state)} members, evaluate them together with --test_ensemble instead"
+            )
+        states.append(state)
+
+    return concatenate_members(states)
+
+
+def train_memory_fn(
+    state: TrainState,
+    train: Dataset,
+    calibration: Dataset,
+    input_shape: Tuple[int, ...],
+    K: int,
+    train_fit_joint: bool,
+    train_batch_size: int,
+    train_epochs: int,
+    train_decay: float,
+    train_patience: int,
+    train_tau: jnp.ndarray,
+    calibration_batch_size: int,
+    joint_train_jnp: jnp.ndarray,
+    key_shuffle: Any,
+    key_augment: Any,
+    augment: bool,
+    num_workers: int,
+) -> TrainState:
+    """
+    Upload the training and calibration splits to the devices once, and run
+    each epoch in a single call of train_epoch.  Only the epoch summaries are
+    read back to the host.
+    """
+    with timing.span("data"):
+        X, M, mask = load_in_memory(train, input_shape, train_batch_size, K, num_workers)
+        X_valid, M_valid, mask_valid = load_in_memory(calibration, input_shape, calibration_batch_size, K, num_workers)
+
+    S = member_count(state)
+    stopping = replicate((jnp.full(S, jnp.nan), jnp.full(S, jnp.inf), jnp.zeros(S, dtype=int)))
+    active = np.ones(S, dtype=bool)
+    train_decay_jnp = replicate(jnp.float32(train_decay))
+    for epoch in range(train_epochs):
+        with timing.profile_window(epoch), timing.span("train_epoch", epoch=epoch):
+            with timing.span("step"), transfers.hot_loop():
+                state, stopping, summary = train_epoch(
+                    state,
+                    X,
+                    M,
+                    mask,
+                    X_valid,
+                    M_valid,
+                    mask_valid,
+                    K,
+                    train_fit_joint,
+                    train_tau,
+                    joint_train_jnp,
+                    key_shuffle,
+                    key_augment,
+                    stopping,
+                    augment,
+                    train_batch_size,
+                    calibration_batch_size,
+                    has_batch_norm(state),
+                    train_decay_jnp,
+                    replicate(active),
+                )
+            with timing.span("sync"):
+                epoch_loss, epoch_hit, epoch_total, epoch_loss_valid = jax.device_get(summary)
+
+        if len(calibration) == 0:
+            with jnp.printoptions(precision=3):
+                print(
+                    f"Train epoch {epoch + 1}, loss: {epoch_loss}, hit: {epoch_hit}, total: {epoch_total}"
+                )
+
+            continue
+
+        epoch_loss_valid_ema, min_epoch_loss_valid_ema, wait = stopping
+        with jnp.printoptions(precision=3):
+            print(
+                f"Train epoch {epoch + 1}, loss: {epoch_loss} (val: {epoch_loss_valid}, ema: {epoch_loss_valid_ema}), hit: {epoch_hit}, total: {epoch_total}"
+            )
+
+        active = stop_early(active, np.asarray(wait), train_patience, f"{train_decay = }, {train_patience = }", np.asarray(min_epoch_loss_valid_ema))
+        if not active.any():
+            break
+
+    return state
+
+
+def stop_early(
+    active: np.ndarray,
+    wait: np.ndarray,
+    patience: int,
+    settings: str,
+    min_ema: np.ndarray,
+) -> np.ndarray:
+    """Deactivate the members that have waited longer than `patience`, and report them."""
+    stopped = active & (wait > patience)
+    for i in np.flatnonzero(stopped):
+        member = f" (member {i})" if len(active) > 1 else ""
+        print(f"Early stopping{member}! {settings}, min_ema = {min_ema[i]}")
+
+    return active & ~stopped
+
+
+def load_in_memory(
+    dataset: Dataset,
+    input_shape: Tuple[int, ...],
+    batch_size: int,
+    K: int,
+    num_workers: int,
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    """
+    Materialize a split padded to a multiple of `batch_size`, and shard it
+    across the devices together with the mask of the real samples.
+    """
+    loader = DataLoader(
+        dataset,
+        batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+    )
+    X_all = []
+    M_all = [np.empty((0,), dtype=np.int32)]
+    for X, _, Y, Z in loader:
+        X_all.append(X.numpy())
+        M_all.append((Y * K + Z).numpy().astype(np.int32))
+
+    # keeps the dtype of the samples, e.g. uint8 images
+    X = np.concatenate(X_all) if X_all else np.empty((0, *input_shape[1:]), dtype=np.float32)
+    M = np.concatenate(M_all)
+    (X, M), mask = pad_batch((X, M), -len(X) // batch_size * -batch_size)
+
+    return X, M, mask
+
+
+def compute_logits(
+    loader: DataLoader,
+    state: TrainState,
+    K: int,
+) -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    """
+    Run the backbone of every member over a split once, keeping the raw logits
+    on the devices.  The logits have a member axis before the batch axis, and
+    the mask marks the logits of real samples.
+    """
+    logits, Ms, masks = [], [], []
+    for X, _, Y, Z in loader:
+        (X, M), mask = pad_batch((X, Y * K + Z), loader.batch_size)
+        logits.append(logit_step(state, X))
+        Ms.append(M)
+        masks.append(mask)
+
+    return jnp.concatenate(logits, axis=1), jnp.concatenate(Ms), jnp.concatenate(masks)
+
+
+def stack_batches(
+    loader: DataLoader,
+    K: int,
+    scan_steps: int,
+    batch_size: int,
+    members: int = 1,
+) -> Iterator[Tuple[bool, jnp.ndarray, jnp.ndarray, jnp.ndarray]]:
+    """
+    Pad and shard each batch across the devices, and stack every `scan_steps`
+    consecutive batches along a new step axis so that they can be consumed by
+    train_multi_step in a single dispatch.  Batches that do not fill a stack
+    at the end of an epoch are yielded individually.
+
+    With several `members`, the loader yields the batches of all members
+    concatenated (see tta.utils.MemberBatchSampler), which are split along a
+    new leading member axis for train_member_step and train_member_multi_step.
+    """
+    pending: List[Tuple[torch.Tensor, torch.Tensor]] = []
+
+    def pad(batch: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[List[np.ndarray], np.ndarray]:
+        if members == 1:
+            return pad_samples(batch, batch_size)
+
+        # pad the last partial batch of every member on its own, so that
+        # split_members keeps the samples of each member together
+        chunks = [pad_samples(chunk, batch_size) for chunk in zip(*(np.split(np.asarray(array), members) for array in batch))]
+        padded = [np.concatenate(arrays) for arrays in zip(*(padded for padded, _ in chunks))]
+        return padded, np.concatenate([mask for _, mask in chunks])
+
+    def split_members(arrays: List[np.ndarray]) -> List[np.ndarray]:
+        if members == 1:
+            return arrays
+
+        return [array.reshape(members, batch_size, *array.shape[1:]) for array in arrays]
+
+    def flush():
+        # the sample axis follows the member and step axes
+        axis = (members > 1) + (scan_steps > 1 and len(pending) == scan_steps)
+        if scan_steps > 1 and len(pending) == scan_steps:
+            batches = [pad(batch) for batch in pending]
+            (X, M), mask = jax.tree_util.tree_map(lambda *steps: np.stack(steps, axis=axis - 1), *[
+                (split_members(padded), split_members([mask])[0]) for padded, mask in batches
+            ])
+            yield (True, *shard((X, M, mask), axis=axis))
+        else:
+            for batch in pending:
+                padded, mask = pad(batch)
+                yield (False, *shard((*split_members(padded), *split_members([mask])), axis=axis))
+        pending.clear()
+
+    for X, _, Y, Z in loader:
+        M = Y * K + Z
+
+        pending.append((X, M))
+        if len(pending) == scan_steps:
+            yield from flush()
+
+    yield from flush()
+
+
+def estimate_source_prior(
+    dataset: Dataset,
+    batch_size: int,
+    num_workers: int,
+    generator: torch.Generator,
+    C: int,
+    K: int,
+    state: TrainState,
+    method: str,
+) -> jnp.ndarray:
+    loader = DataLoader(
+        dataset,
+        batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        generator=generator,
+    )
+    if method == "count":
+        source_prior = np.zeros((C * K))
+        I = np.identity(C * K)
+        for _, _, Y, Z in timing.spanned(loader):
+            M = Y * K + Z
+            source_prior += np.sum(I[M], axis=0)
+
+        source_prior = jnp.array(source_prior / np.sum(source_prior))
+
+    elif method == "induce":
+        N = 0
+        source_prior = replicate(np.zeros(C * K, dtype=np.float32))
+        for X, _, _, _ in timing.spanned(loader):
+            N += X.shape[0]
+            (X,), mask = pad_batch((X,), batch_size)
+            with timing.span("step"), transfers.hot_loop():
+                source_prior = source_prior + induce_step(state, X, mask)
+
+        with timing.span("sync"):
+            source_prior = jax.block_until_ready(source_prior / N)
+
+    else:
+        raise ValueError(f"Unknown source label prior estimation method {method}")
+
+    return source_prior
+
+
+def baseline_fn(
+    state: TrainState,
+    dataset: MultipleDomainDataset,
+    eval_splits: List[Tuple[Dataset, torch.Tensor]],
+    dataset_label_noise: float,
+    train_domains_set: Set[int],
+    train_batch_size: int,
+    calibration_domains_set: Set[int],
+    adapt_skip_null_oracle: bool,
+    adapt_gmtl_alpha: Sequence[float],
+    test_ensemble: bool,
+    generator: torch.Generator,
+    num_workers: int,
+):
+    print("===> Adapting & Evaluating")
+
+    mean_sweeps = {}
+    l1_sweeps = {}
+    auc_sweeps = {}
+    auc_Z_sweeps = {}
+    accuracy_sweeps = {}
+    accuracy_Z_sweeps = {}
+    norm_sweeps = {}
+
+    adaptations: List[Adaptation]
+    if adapt_skip_null_oracle:
+        adaptations = []
+    else:
+        adaptations = [("Null",), ("Oracle",)]
+
+    adaptations.extend(("GMTL", alpha) for alpha in adapt_gmtl_alpha)
+    for adaptation in adaptations:
+        argmax_joint = False
+        batch_size = train_batch_size   # batch size does not matter since we are not adapting on data
+        state, (mean, l1, auc, auc_Z, accuracy, accuracy_Z, norm), _ = adapt_fn(
+            state,
+            dataset.C,
+            dataset.K,
+            dataset_label_noise,
+            train_domains_set,
+            calibration_domains_set,
+            eval_splits,
+            adaptation,
+            argmax_joint,
+            batch_size,
+            test_ensemble,
+            generator,
+            num_workers,
+        )
+        mean_sweeps[adaptation, argmax_joint, batch_size] = mean
+        l1_sweeps[adaptation, argmax_joint, batch_size] = l1
+        auc_sweeps[adaptation, argmax_joint, batch_size] = auc
+        auc_Z_sweeps[adaptation, argmax_joint, batch_size] = auc_Z
+        accuracy_sweeps[adaptation, argmax_joint, batch_size] = accuracy
+        accuracy_Z_sweeps[adaptation, argmax_joint, batch_size] = accuracy_Z
+        norm_sweeps[adaptation, argmax_joint, batch_size] = norm
+
+    return mean_sweeps, l1_sweeps, auc_sweeps, auc_Z_sweeps, accuracy_sweeps, accuracy_Z_sweeps, norm_sweeps
+
+
+def adapt_fn(
+    state: TrainState,
+    C: int,
+    K: int,
+    dataset_label_noise: float,
+    train_domains_set: Set[int],
+    calibration_domains_set: Set[int],
+    eval_splits: Sequence[Tuple[Dataset, torch.Tensor]],
+    adaptation: Adaptation,
+    argmax_joint: bool,
+    batch_size: int,
+    ensemble: bool,
+    generator: torch.Generator,
+    num_workers: int,
+) -> Tuple[TrainState, Sweeps, Optional[EMSweeps]]:
+    label = f"{adaptation = }, {argmax_joint = }, {batch_size = }"
+    print(f"---> {label}")
+
+    # Every sweep has a leading member axis, and all members see the same
+    # batches.  With `ensemble`, the last row is the ensemble of the members.
+    S = member_count(state)
+    R = S + 1 if ensemble else S
+    mean_sweep = jnp.empty((R, len(eval_splits)))
+    l1_sweep = jnp.empty((R, len(eval_splits)))
+    auc_sweep = jnp.empty((R, len(eval_splits)))
+    auc_Z_sweep = jnp.empty((R, len(eval_splits)))
+    accuracy_sweep = jnp.empty((R, len(eval_splits)))
+    accuracy_Z_sweep = jnp.empty((R, len(eval_splits)))
+    norm_sweep = jnp.empty((R, len(eval_splits)))
+    # the ensemble row of the EM sweeps pools the batches of the members
+    em_iterations_sweep = np.full((R, len(eval_splits)), np.nan)
+    em_converged_sweep = np.full((R, len(eval_splits)), np.nan)
+    em_objective_sweep = np.full((R, len(eval_splits)), np.nan)
+    em_histogram_sweep = np.zeros((R, len(eval_splits), len(EM_ITERATION_BINS)), dtype=int)
+    if adaptation[0] == "EM":
+        # uploaded once for all batches
+        prior_strength = replicate(adaptation[1])
+    with memory.phase(f"adapt ({label})"):
+        for i, (eval_, joint_M) in enumerate(eval_splits):
+            # happens on the source domain when train_fraction = 1.0
+            if len(eval_) == 0:
+                mean_sweep = mean_sweep.at[:, i].set(jnp.nan)
+                l1_sweep = l1_sweep.at[:, i].set(jnp.nan)
+                auc_sweep = auc_sweep.at[:, i].set(jnp.nan)
+                auc_Z_sweep = auc_Z_sweep.at[:, i].set(jnp.nan)
+                accuracy_sweep = accuracy_sweep.at[:, i].set(jnp.nan)
+                accuracy_Z_sweep = accuracy_Z_sweep.at[:, i].set(jnp.nan)
+                norm_sweep = norm_sweep.at[:, i].set(jnp.nan)
+                continue
+
+            seen = (
+                "  (seen)"
+                if i in train_domains_set.union(calibration_domains_set)
+                else " (train)"
+                if i == len(eval_splits) - 1
+                else "(unseen)"
+            )
+
+            joint_M = jnp.array(joint_M)
+            flip_prob = jnp.array(
+                [
+                    [1 - dataset_label_noise, dataset_label_noise],
+                    [dataset_label_noise, 1 - dataset_label_noise],
+                ]
+            )
+            joint = flip_prob[:, :, jnp.newaxis] * joint_M  # P(Y_tilde, Y, Z)
+            prob = joint / jnp.sum(joint, axis=1, keepdims=True)
+            prob = prob[:, 1, :]  # P(Y=1|Y_tilde, Z)
+
+            # using shuffle=True so that Y contains multiple classes, otherwise AUC is not defined
+            # the batches are padded, and the metrics are kept on the host for the real samples only
+            with timing.span("adapt_split", adaptation=str(adaptation), split=i):
+                mean = l1 = hits = hits_Z = norm = 0
+                # summed on the devices, and fetched once per split
+                em_telemetry = replicate((
+                    np.zeros(S, dtype=int),
+                    np.zeros(S, dtype=int),
+                    np.zeros(S),
+                    np.zeros((S, len(EM_ITERATION_BINS)), dtype=int),
+                ))
+                batch_count = 0
+                epoch_Y = np.empty(len(eval_))
+                epoch_score = np.empty((R, len(eval_)))
+                epoch_Z = np.empty(len(eval_))
+                epoch_score_Z = np.empty((R, len(eval_)))
+                offset = 0
+
+                eval_loader = DataLoader(
+                    eval_,
+                    batch_size,
+                    shuffle=True,
+                    num_workers=num_workers,
+                    generator=generator,
+                )
+                for X, Y_tilde, Y, Z in timing.spanned(eval_loader):
+                    N = X.shape[0]
+                    Y_tilde, Y_host, Z_host = Y_tilde.numpy(), Y.numpy(), Z.numpy()
+                    (X, Y, Z), mask = pad_batch((X, Y, Z), batch_size)
+
+                    epoch_Y[offset : offset + N] = Y_host
+                    epoch_Z[offset : offset + N] = Z_host
+
+                    if adaptation[0] == "Null":
+                        prior = state.prior.unfreeze()
+                        prior["target"] = prior["source"]
+                        state = state.replace(prior=flax.core.frozen_dict.freeze(prior))
+                    elif adaptation[0] == "Oracle":
+                        prior = state.prior.unfreeze()
+                        prior["target"] = replicate(jnp.broadcast_to(joint_M.flatten(), (S, C * K)))
+                        state = state.replace(prior=flax.core.frozen_dict.freeze(prior))
+                    elif adaptation[0] == "GMTL":
+                        _, alpha = adaptation
+                        prior = state.prior.unfreeze()
+                        target = prior["source"]**(1-alpha)
+                        target = target / jnp.sum(-1, keepdims=True)
+                        prior["target"] = target
+                        state = state.replace(prior=flax.core.frozen_dict.freeze(prior))
+                    elif adaptation[0] == "EM":
+                        _, _, symmetric_dirichlet, fix_marginal = adaptation
+                        with timing.span("em"), transfers.hot_loop():
+                            state, (objective, iterations, converged) = adapt_step(
+                                state,
+                                X,
+                                mask,
+                                prior_strength,
+                                symmetric_dirichlet,
+                                fix_marginal,
+                                C,
+                                K,
+                            )
+                            em_telemetry = em_telemetry_step(em_telemetry, objective, iterations, converged)
+                    else:
+                        raise ValueError(f"Unknown adaptation scheme {adaptation}")
+
+                    with timing.span("inference"), transfers.hot_loop():
+                        (score, hit), (score_Z, hit_Z), prob_joint = test_step(state, X, Y, Z, mask, argmax_joint)
+                        if ensemble:
+                            ensemble_hit, ensemble_hit_Z = ensemble_step(prob_joint, Y, Z, mask, argmax_joint)
+                            hit, hit_Z = jnp.append(hit, ensemble_hit), jnp.append(hit_Z, ensemble_hit_Z)
+                        score, score_Z, hit, hit_Z, prior = jax.device_get((score, score_Z, hit, hit_Z, state.prior["target"]))
+                        score, score_Z = score[:, :N], score_Z[:, :N]
+                        prior = prior.reshape((S, C, K))
+
+                    with timing.span("metrics"):
+                        if ensemble:
+                            # The ensemble averages the adapted probabilities of the
+                            # members, and predicts from them like every member
+                            # does, see ensemble_step.
+                            ensemble_score = np.mean(score, axis=0, keepdims=True)
+                            ensemble_score_Z = np.mean(score_Z, axis=0, keepdims=True)
+                            score = np.concatenate((score, ensemble_score))
+                            score_Z = np.concatenate((score_Z, ensemble_score_Z))
+                            prior = np.concatenate((prior, np.mean(prior, axis=0, keepdims=True)))
+
+                        # score is indexed by (member, sample)
+                        mean += np.sum(score, axis=-1)
+                        l1 += np.sum(np.abs(score - np.asarray(prob)[Y_tilde, Z_host]), axis=-1)
+                        epoch_score[:, offset : offset + N] = score
+                        epoch_score_Z[:, offset : offset + N] = score_Z
+                        hits += hit
+                        hits_Z += hit_Z
+                        norm += N * np.linalg.norm(prior - np.asarray(joint_M), axis=(-2, -1))
+
+                    offset += N
+                    batch_count += 1
+
+            mean = mean / len(eval_)
+            l1 = l1 / len(eval_)
+            with timing.span("auc", split=i):
+                auc = jnp.array([roc_auc_score(epoch_Y, member_score) for member_score in epoch_score])
+                auc_Z = jnp.array([roc_auc_score(epoch_Z, member_score_Z) for member_score_Z in epoch_score_Z])
+            accuracy = hits / len(eval_)
+            accuracy_Z = hits_Z / len(eval_)
+            norm = norm / len(eval_)
+
+            with jnp.printoptions(precision=4):
+                print(
+                    f"[{label}] Environment {i:>2} {seen} mean {mean}, L1 {l1}, AUC {auc} ({auc_Z}), Accuracy {accuracy} ({accuracy_Z}), Norm {norm}"
+                )
+
+            if adaptation[0] == "EM":
+                em_iterations, em_converged, em_objective, em_histogram = jax.device_get(em_telemetry)
+                if ensemble:
+                    em_iterations = np.append(em_iterations, np.sum(em_iterations))
+                    em_converged = np.append(em_converged, np.sum(em_converged))
+                    em_objective = np.append(em_objective, np.sum(em_objective))
+                    em_histogram = np.concatenate((em_histogram, np.sum(em_histogram, axis=0, keepdims=True)))
+                    batch_counts = np.append(np.full(S, batch_count), S * batch_count)
+                    sample_counts = np.append(np.full(S, len(eval_)), S * len(eval_))
+                else:
+                    batch_counts = np.full(S, batch_count)
+                    sample_counts = np.full(S, len(eval_))
+
+                em_iterations_sweep[:, i] = em_iterations / batch_counts
+                em_converged_sweep[:, i] = em_converged / batch_counts
+                em_objective_sweep[:, i] = em_objective / sample_counts
+                em_histogram_sweep[:, i] = em_histogram
+                with np.printoptions(precision=4):
+                    print(
+                        f"[{label}] Environment {i:>2} {seen} EM iterations {em_iterations_sweep[:, i]}, converged {em_converged_sweep[:, i]}, objective {em_objective_sweep[:, i]}"
+                    )
+
+            # note that foo_sweep.at[:, -1] is the training foo
+            mean_sweep = mean_sweep.at[:, i].set(mean)
+            l1_sweep = l1_sweep.at[:, i].set(l1)
+            auc_sweep = auc_sweep.at[:, i].set(auc)
+            auc_Z_sweep = auc_Z_sweep.at[:, i].set(auc_Z)
+            accuracy_sweep = accuracy_sweep.at[:, i].set(accuracy)
+            accuracy_Z_sweep = accuracy_Z_sweep.at[:, i].set(accuracy_Z)
+            norm_sweep = norm_sweep.at[:, i].set(norm)
+
+    print(
+        f"[{label}] Average response {jnp.nanmean(mean_sweep[:, :-1], axis=-1)}, "
+        f"Average L1 {jnp.nanmean(l1_sweep[:, :-1], axis=-1)}, "
+        f"Average AUC {jnp.nanmean(auc_sweep[:, :-1], axis=-1)} ({jnp.nanmean(auc_Z_sweep[:, :-1], axis=-1)}), "
+        f"Accuracy {jnp.nanmean(accuracy_sweep[:, :-1], axis=-1)} ({jnp.nanmean(accuracy_Z_sweep[:, :-1], axis=-1)}), "
+        f"Norm {jnp.nanmean(norm_sweep[:, :-1], axis=-1)}"
+    )
+
+    return state, (
+        mean_sweep,
+        l1_sweep,
+        auc_sweep,
+        auc_Z_sweep,
+        accuracy_sweep,
+        accuracy_Z_sweep,
+        norm_sweep,
+    ), (
+        em_iterations_sweep,
+        em_converged_sweep,
+        em_objective_sweep,
+        em_histogram_sweep,
+    ) if adaptation[0] == "EM" else None
@@ -0,0 +1,27 @@
+"""
+The datasets tta.cli can build, by name.  Their modules pull in torch,
+torchvision and the like, e.g. pycocotools for COCO, so a dataset module is
+only imported once that dataset is built.
+"""
+
+from typing import Type
+import importlib
+
+
+DATASETS = {
+    "MNIST": "tta.datasets.mnist:MultipleDomainMNIST",
+    "COCO": "tta.datasets.coco:ColoredCOCO",
+    "Waterbirds": "tta.datasets.waterbirds:MultipleDomainWaterbirds",
+    "CheXpert": "tta.datasets.cxr.chexpert:MultipleDomainCheXpert",
+    "MIMIC": "tta.datasets.cxr.mimic:MultipleDomainMIMIC",
+    "Synthetic": "tta.datasets.synthetic:MultipleDomainSynthetic",
+}
+
+
+def dataset_class(dataset_name: str) -> Type:
+    if dataset_name not in DATASETS:
+        raise ValueError(f"Unknown dataset {dataset_name}")
+
+    module_name, class_name = DATASETS[dataset_name].split(":")
+
+    return getattr(importlib.import_module(module_name), class_name)
@@ -0,0 +1,114 @@
+"""Jittable full-batch solvers for smooth convex objectives."""
+
+from typing import Callable, Tuple
+
+import jax
+import jax.numpy as jnp
+
+
+def lbfgs(fun: Callable[[jnp.ndarray], jnp.ndarray], x0: jnp.ndarray,
+        max_iter: int = 100, history: int = 10, tol: float = 1e-6) \
+                -> Tuple[jnp.ndarray, Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]]:
+    """
+    Minimize `fun` over a flat parameter vector with limited-memory BFGS and a
+    backtracking Armijo line search, entirely inside jax.lax control flow.
+
+    Returns the minimizer together with (objective, iterations, converged).
+    The iteration stops once the largest gradient entry falls below `tol`, the
+    relative decrease of the objective falls below `tol`, or no step along the
+    search direction decreases the objective.
+
+    `fun` has to be the objective over the full batch, e.g. a sum over arrays
+    sharded by jax.jit, so that its gradient is the global one.  A per-device
+    objective summed with jax.lax.psum must not be passed instead: the
+    transpose of psum scales every device's gradient by the device count.
+    """
+    value_and_grad = jax.value_and_grad(fun)
+    f0, g0 = value_and_grad(x0)
+    n = x0.shape[0]
+
+    def direction(g, S, Y, rho, k):
+        # two-loop recursion, newest pair first; unused slots have rho = 0
+        q = g
+        alphas = []
+        for i in range(history):
+            j = (k - 1 - i) % history
+            alpha = rho[j] * jnp.dot(S[j], q)
+            q = q - alpha * Y[j]
+            alphas.append(alpha)
+
+        j = (k - 1) % history
+        yy = jnp.dot(Y[j], Y[j])
+        gamma = jnp.where(rho[j] > 0, jnp.dot(S[j], Y[j]) / jnp.where(yy > 0, yy, 1), 1)
+        r = gamma * q
+        for i in reversed(range(history)):
+            j = (k - 1 - i) % history
+            beta = rho[j] * jnp.dot(Y[j], r)
+            r = r + S[j] * (alphas[i] - beta)
+
+        return -r
+
+    def cond_fun(val):
+        *_, iteration, converged, stalled = val
+        return (iteration < max_iter) & ~converged & ~stalled
+
+    def body_fun(val):
+        x, f, g, S, Y, rho, k, iteration, _, _ = val
+
+        d = direction(g, S, Y, rho, k)
+        gd = jnp.dot(g, d)
+        d = jnp.where(gd < 0, d, -g)
+        gd = jnp.where(gd < 0, gd, -jnp.dot(g, g))
+
+        # the first step has no curvature information to scale it
+        t0 = jnp.where(k == 0, 1 / jnp.maximum(1, jnp.linalg.norm(g)), 1.0)
+        f_t, g_t = value_and_grad(x + t0 * d)
+
+        def ls_cond_fun(ls_val):
+            t, f_t, _, ls_iteration = ls_val
+            return ~(f_t <= f + 1e-4 * t * gd) & (ls_iteration < 30)
+
+        def ls_body_fun(ls_val):
+            t, _, _, ls_iteration = ls_val
+            t = t / 2
+            f_t, g_t = value_and_grad(x + t * d)
+            return t, f_t, g_t, ls_iteration + 1
+
+        t, f_t, g_t, _ = jax.lax.while_loop(ls_cond_fun, ls_body_fun, (t0, f_t, g_t, 0))
+        accepted = f_t <= f + 1e-4 * t * gd
+
+        s = t * d
+        y = g_t - g
+        sy = jnp.dot(s, y)
+        update = accepted & (sy > 1e-10)
+        slot = k % history
+        S = jnp.where(update, S.at[slot].set(s), S)
+        Y = jnp.where(update, Y.at[slot].set(y), Y)
+        rho = jnp.where(update, rho.at[slot].set(1 / jnp.where(update, sy, 1)), rho)
+        k = jnp.where(update, k + 1, k)
+
+        x_new = jnp.where(accepted, x + s, x)
+        f_new = jnp.where(accepted, f_t, f)
+        g_new = jnp.where(accepted, g_t, g)
+
+        small_gradient = jnp.max(jnp.abs(g_new)) <= tol
+        small_decrease = f - f_new <= tol * jnp.maximum(1, jnp.abs(f))
+        converged = small_gradient | (accepted & small_decrease)
+
+        return x_new, f_new, g_new, S, Y, rho, k, iteration + 1, converged, ~accepted
+
+    init_val = (
+        x0,
+        f0,
+        g0,
+        jnp.zeros((history, n), dtype=x0.dtype),
+        jnp.zeros((history, n), dtype=x0.dtype),
+        jnp.zeros(history, dtype=x0.dtype),
+        0,
+        0,
+        jnp.max(jnp.abs(g0)) <= tol,
+        False,
+    )
+    x, f, _, _, _, _, _, iteration, converged, _ = jax.lax.while_loop(cond_fun, body_fun, init_val)
+
+    return x, (f, iteration, converged)
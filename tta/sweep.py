@@ -0,0 +1,179 @@
+"""
+Run a grid of tta.cli configurations in long-lived worker processes.
+
+The grid is a JSON file of the form
+
+    {
+        "config_name": "mnist_sub{dataset_subsample_what}_tau{train_tau}_seed{seed}",
+        "base": {"dataset_name": "MNIST", "test_batch_size": [64, 512], ...},
+        "grid": {"dataset_subsample_what": ["none", "groups"], "train_tau": [0, 1], "seed": [2022, 2023]}
+    }
+
+where every key is a tta.cli option.  Each point of the grid is the base
+options updated with one combination of the grid options, and `config_name`
+is formatted with the options of the point.  A grid value that is an object
+sets several options together, e.g. "tau": [{"train_tau": 0, "calibration_tau": 0}, ...].
+A list in "base" is passed as a repeated option, and a flag is passed when its
+value is true.
+
+Points sharing a dataset and seed are run one after another in the same worker,
+so that the dataset is built once and the compiled step functions are reused.
+Points whose results already exist under npz/ are skipped.  The DataLoader
+workers of every point are capped to an equal share of the CPUs, so that the
+sweep workers do not oversubscribe the host.  A point with
+"train_seed_count" writes one result per member, so its config_name keeps a
+literal {seed} placeholder for tta.cli, written as {{seed}} in the grid.
+
+Usage:
+    python -m tta.sweep --grid sweeps/paper-mnist.json --workers 4
+"""
+
+from typing import Any, Dict, List, Tuple
+from pathlib import Path
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+import json
+import traceback
+
+import click
+
+
+# the options determining the dataset built by tta.pipeline.build_dataset
+DATASET_OPTIONS = (
+    "dataset_name",
+    "dataset_y_column",
+    "dataset_z_column",
+    "dataset_target_domain_count",
+    "dataset_source_domain_count",
+    "dataset_use_embedding",
+    "dataset_apply_rotation",
+    "dataset_feature_noise",
+    "dataset_label_noise",
+    "dataset_dim",
+    "train_domains",
+    "seed",
+)
+
+
+def expand(grid: Dict[str, Any]) -> List[Dict[str, Any]]:
+    names = list(grid["grid"].keys())
+    points = []
+    for values in product(*grid["grid"].values()):
+        point = dict(grid["base"])
+        for name, value in zip(names, values):
+            if isinstance(value, dict):
+                point.update(value)
+            else:
+                point[name] = value
+        point["config_name"] = grid["config_name"].format(**point)
+        points.append(point)
+
+    return points
+
+
+def to_args(point: Dict[str, Any]) -> List[str]:
+    from tta.cli import cli
+
+    flags = {param.name for param in cli.params if getattr(param, "is_flag", False)}
+    args = []
+    for name, value in point.items():
+        option = f"--{name}"
+        if name in flags:
+            if value:
+                args.append(option)
+        elif isinstance(value, list):
+            for item in value:
+                args.extend((option, str(item)))
+        elif value is not None:
+            args.extend((option, str(value)))
+
+    return args
+
+
+def init_worker() -> None:
+    from tta.pipeline import initialize_jit_cache
+    from tta.visualize import latexify
+
+    initialize_jit_cache()
+    latexify(width_scale_factor=2, fig_height=2)
+
+
+def run_group(points: List[Dict[str, Any]]) -> List[Tuple[str, bool]]:
+    import tta.cli
+    import tta.pipeline
+
+    # a group shares one dataset, so only keep the datasets of the current group
+    tta.pipeline.dataset_memo = {}
+
+    results = []
+    for point in points:
+        try:
+            tta.cli.cli.main(to_args(point), standalone_mode=False)
+            results.append((point["config_name"], True))
+        except Exception:
+            traceback.print_exc()
+            results.append((point["config_name"], False))
+
+    return results
+
+
+@click.command()
+@click.option("--grid", "grid_path", type=click.Path(exists=True, path_type=Path), required=True)
+@click.option("--workers", type=int, required=False, default=1)
+def main(grid_path: Path, workers: int) -> None:
+    with open(grid_path) as f:
+        grid = json.load(f)
+
+    from tta.cli import member_config_names
+
+    npz_root = Path("npz/")
+    points = expand(grid)
+    pending = [
+        point
+        for point in points
+        if not all(
+            (npz_root / f"{name}.npz").exists()
+            for name in member_config_names(
+                point["config_name"],
+                point["seed"],
+                point.get("train_seed_count", 1),
+                len(point.get("test_checkpoint") or []),
+                bool(point.get("test_ensemble")),
+            )
+        )
+    ]
+    print(f"{len(points) - len(pending)} of {len(points)} points are done already")
+
+    groups: Dict[Tuple, List[Dict[str, Any]]] = {}
+    for point in pending:
+        group_key = tuple(str(point.get(name)) for name in DATASET_OPTIONS)
+        groups.setdefault(group_key, []).append(point)
+
+    # every sweep worker gets an equal share of the CPUs for its DataLoader workers
+    loader_workers = max(0, (os.cpu_count() or 1) // workers - 1)
+    for point in pending:
+        if point.get("num_workers", 0) > loader_workers:
+            point["num_workers"] = loader_workers
+    print(f"Capped DataLoader workers to {loader_workers} per sweep worker")
+
+    # spawn, as forking a process that has initialized JAX is not safe.  The
+    # workers of a ProcessPoolExecutor are not daemonic, unlike those of a
+    # multiprocessing.Pool, so that they can start DataLoader workers.
+    context = multiprocessing.get_context("spawn")
+    failed = []
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker) as executor:
+        futures = [executor.submit(run_group, points) for points in groups.values()]
+        for future in as_completed(futures):
+            for config_name, succeeded in future.result():
+                print(f"{'Finished' if succeeded else 'Failed'} {config_name}")
+                if not succeeded:
+                    failed.append(config_name)
+
+    if failed:
+        raise SystemExit(f"{len(failed)} points failed: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Hierarchical wall-clock spans of a run.
+
+tta.pipeline wraps its phases in `span`, e.g. every training epoch with its
+data wait, device step and host sync.  At the end of a run tta.cli writes the
+spans next to the npz results as a Chrome trace (`<name>.trace.json`, open it
+in chrome://tracing or https://ui.perfetto.dev), and as a summary of the total,
+mean and maximum time of every path of nested spans (`<name>.timing.json`).
+
+The step functions are dispatched asynchronously, so a "step" span measures
+the dispatch, and the device time shows up in the span that reads the results
+back, e.g. "sync" at the end of an epoch.
+
+With a profile directory, `profile_window` additionally captures a few
+training epochs with jax.profiler, skipping the first one that compiles.
+The training loops run inside `profiling`, which stops a trace still open
+when they exit, e.g. on early stopping or with fewer epochs than the window.
+"""
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import os
+import time
+
+
+events: List[Dict[str, Any]] = []
+stack: List[str] = []
+profile_dir: Optional[Path] = None
+profile_start_epoch = 1
+profile_epochs = 1
+tracing = False
+
+
+def reset(profile_to: Optional[Path] = None, start_epoch: int = 1, epochs: int = 1) -> None:
+    global profile_dir, profile_start_epoch, profile_epochs
+    stop_profile()
+    events.clear()
+    stack.clear()
+    profile_dir = profile_to
+    profile_start_epoch = start_epoch
+    profile_epochs = epochs
+
+
+@contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    stack.append(name)
+    path = "/".join(stack)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        stack.pop()
+        events.append({
+            "name": name,
+            "cat": path,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": 0,
+            "args": args,
+        })
+
+
+def spanned(iterable: Iterable, name: str = "data") -> Iterator:
+    """Iterate, timing the wait for every item, e.g. the next batch of a loader."""
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@contextmanager
+def profile_window(epoch: int) -> Iterator[None]:
+    """Capture the training epochs in the profile window with jax.profiler."""
+    global tracing
+    import jax
+
+    first = epoch == profile_start_epoch
+    last = epoch == profile_start_epoch + profile_epochs - 1
+    if profile_dir is not None and first:
+        print(f"Capturing {profile_epochs} epochs to {profile_dir}")
+        jax.profiler.start_trace(str(profile_dir))
+        tracing = True
+    try:
+        yield
+    finally:
+        if last:
+            stop_profile()
+
+
+def stop_profile() -> None:
+    global tracing
+    import jax
+
+    if tracing:
+        tracing = False
+        jax.profiler.stop_trace()
+
+
+@contextmanager
+def profiling() -> Iterator[None]:
+    """Stop the trace of `profile_window` when a training loop exits before the window ends."""
+    try:
+        yield
+    finally:
+        stop_profile()
+
+
+def summary() -> Dict[str, Dict[str, float]]:
+    durations: Dict[str, List[float]] = {}
+    for event in events:
+        durations.setdefault(event["cat"], []).append(event["dur"] / 1e6)
+
+    return {
+        path: {"count": len(ds), "total": sum(ds), "mean": sum(ds) / len(ds), "max": max(ds)}
+        for path, ds in sorted(durations.items())
+    }
+
+
+def write(prefix: Path) -> None:
+    """Write the spans to `<prefix>.trace.json` and their summary to `<prefix>.timing.json`."""
+    trace_path = prefix.with_name(f"{prefix.name}.trace.json")
+    summary_path = prefix.with_name(f"{prefix.name}.timing.json")
+    trace_path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+    summary_path.write_text(json.dumps(summary(), indent=2))
+    print(f"Wrote timing spans to {trace_path} and {summary_path}")
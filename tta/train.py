@@ -1,14 +1,19 @@
-from typing import Any, Callable, Tuple
-from functools import partial
+from typing import Any, Callable, Sequence, Tuple
+from functools import lru_cache, partial
 
 import jax
 import jax.numpy as jnp
 import flax
 from flax.training import train_state
 from flax.struct import field
+from jax.flatten_util import ravel_pytree
 import optax
 
 from tta.models import AdaptiveNN
+from tta.augment import augment as random_augment
+from tta.solver import lbfgs
+from tta.compilation import tracked
+from tta.common import EM_ITERATION_BINS
 
 
 class TrainState(train_state.TrainState):
@@ -18,37 +23,143 @@ class TrainState(train_state.TrainState):
     prior: flax.core.FrozenDict[str, jnp.ndarray]
 
 
+@lru_cache(maxsize=None)
+def model_fns(C: int, K: int, model: str) -> Tuple[AdaptiveNN, Callable, Callable, Callable]:
+    """
+    The network and its apply functions, shared by every state of the same
+    model.  They are static fields of TrainState, which jit compares by
+    identity, so fresh ones would recompile every step function.
+    """
+    net = AdaptiveNN(C=C, K=K, model=model)
+    return (
+        net,
+        partial(net.apply, method=net.adapted_prob),
+        partial(net.apply, method=net.raw_logit),
+        partial(net.apply, method=net.calibrated_logit),
+    )
+
+
+@lru_cache(maxsize=None)
+def optimizer() -> optax.GradientTransformation:
+    """AdamW with the learning rate in its state, so that it is traced, see create_train_state."""
+    return optax.inject_hyperparams(optax.adamw)(learning_rate=0.0)
+
+
 def create_train_state(key: Any, C: int, K: int, model: str,
         learning_rate: float, specimen: jnp.ndarray, device_count: int) -> TrainState:
-    net = AdaptiveNN(C=C, K=K, model=model)
+    net, apply_fn, raw_fn, calibrated_fn = model_fns(C, K, model)
 
     variables = net.init(key, specimen, True, method=net.adapted_prob)
     variables, params = variables.pop('params')
     if 'batch_stats' in variables:
         variables, batch_stats = variables.pop('batch_stats')
     else:
-        batch_stats = {'dummy': jnp.empty(device_count)}
+        batch_stats = flax.core.freeze({'dummy': jnp.empty(device_count)})
     variables, prior = variables.pop('prior')
     assert not variables
 
-    tx = optax.adamw(learning_rate)
     state = TrainState.create(
-            apply_fn=partial(net.apply, method=net.adapted_prob),
+            apply_fn=apply_fn,
             params=params,
-            tx=tx,
-            raw_fn=partial(net.apply, method=net.raw_logit),
-            calibrated_fn=partial(net.apply, method=net.calibrated_logit),
+            tx=optimizer(),
+            raw_fn=raw_fn,
+            calibrated_fn=calibrated_fn,
             batch_stats=batch_stats,
             prior=prior,
     )
+    hyperparams = dict(state.opt_state.hyperparams, learning_rate=jnp.asarray(learning_rate, dtype=jnp.float32))
+    state = state.replace(opt_state=state.opt_state._replace(hyperparams=hyperparams))
 
     return state
 
 
-@partial(jax.pmap, axis_name='batch', static_broadcasted_argnums=(3, 4, 5), donate_argnums=(0,))
-def train_step(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, K: int,
-        train_fit_joint: bool, tau: float, joint: jnp.ndarray) \
+def stack_members(states: Sequence[TrainState]) -> TrainState:
+    """
+    Stack the states of several ensemble members along a new leading member
+    axis, which every step function below maps over.
+    """
+    return concatenate_members([jax.tree_util.tree_map(lambda x: jnp.asarray(x)[jnp.newaxis], state) for state in states])
+
+
+def concatenate_members(states: Sequence[TrainState]) -> TrainState:
+    """Concatenate states that already have a member axis along it."""
+    _, treedef = jax.tree_util.tree_flatten(states[0])
+    # the static fields, e.g. apply_fn, are taken from the first state
+    member_leaves = [jax.tree_util.tree_leaves(state) for state in states]
+    leaves = [jnp.concatenate(member_leaf) for member_leaf in zip(*member_leaves)]
+
+    return jax.tree_util.tree_unflatten(treedef, leaves)
+
+
+def member_count(state: TrainState) -> int:
+    return state.step.shape[-1]
+
+
+def has_batch_norm(state: TrainState) -> bool:
+    """Whether the model has BatchNorm, i.e. batch statistics other than the placeholder of create_train_state."""
+    return 'dummy' not in state.batch_stats
+
+
+def over_members(fn: Callable, member_argnums: Tuple[int, ...], masked: bool = False) -> Callable:
+    """
+    Map `fn` over the leading member axis of the arguments in `member_argnums`,
+    sharing the other arguments, e.g. the batch, among all members.
+
+    With `masked`, the mapped function takes an extra trailing argument with
+    one boolean per member, and the members for which it is False keep the
+    state they were called with.  This is how members stop early on their own.
+    """
+    def mapped_fn(*args):
+        if masked:
+            *args, active = args
+
+        def member_fn(*member_args):
+            member_fn_args = list(args)
+            for i, member_arg in zip(member_argnums, member_args):
+                member_fn_args[i] = member_arg
+
+            return fn(*member_fn_args)
+
+        outputs = jax.vmap(member_fn)(*(args[i] for i in member_argnums))
+        if masked:
+            state, *rest = outputs
+            state = jax.tree_util.tree_map(
+                lambda new, old: jnp.where(active.reshape(-1, *(1,) * (new.ndim - 1)), new, old),
+                state,
+                args[0],
+            )
+            outputs = (state, *rest)
+
+        return outputs
+
+    return mapped_fn
+
+
+def cross_entropy(logit: jnp.ndarray, M: jnp.ndarray, K: int, train_fit_joint: bool) -> jnp.ndarray:
+    if train_fit_joint:
+        loss = optax.softmax_cross_entropy_with_integer_labels(logit, M)
+    else:
+        logit_YZ = logit.reshape((-1, logit.shape[-1] // K, K))
+        logit_Y = jax.nn.logsumexp(logit_YZ, axis=-1)
+        logit_Z = jax.nn.logsumexp(logit_YZ, axis=-2)
+        loss_Y = optax.softmax_cross_entropy_with_integer_labels(logit_Y, M // K)
+        loss_Z = optax.softmax_cross_entropy_with_integer_labels(logit_Z, M % K)
+        loss = loss_Y + loss_Z
+
+    return loss
+
+
+def train_step_fn(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, mask: jnp.ndarray, K: int,
+        train_fit_joint: bool, tau: float, joint: jnp.ndarray, key: Any, augment: bool) \
                 -> Tuple[TrainState, Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]]:
+    """
+    Take a gradient step on a batch padded to a fixed size, in which `mask`
+    marks the real samples.  The padding does not contribute to the loss or
+    the metrics.
+    """
+    if augment:
+        X = random_augment(jax.random.fold_in(key, state.step), X)
+
     @partial(jax.value_and_grad, has_aux=True)
     def loss_fn(params):
         variables = {
@@ -61,26 +172,14 @@ def train_step(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, K: int,
         )
         logit = logit + tau * jnp.log(joint)
 
-        if train_fit_joint:
-            loss = optax.softmax_cross_entropy_with_integer_labels(logit, M)
-        else:
-            logit_YZ = logit.reshape((-1, logit.shape[-1] // K, K))
-            logit_Y = jax.nn.logsumexp(logit_YZ, axis=-1)
-            logit_Z = jax.nn.logsumexp(logit_YZ, axis=-2)
-            loss_Y = optax.softmax_cross_entropy_with_integer_labels(logit_Y, M // K)
-            loss_Z = optax.softmax_cross_entropy_with_integer_labels(logit_Z, M % K)
-            loss = loss_Y + loss_Z
-        mask = jnp.arange(logit.shape[-1])[..., jnp.newaxis] == M
-        hit = jnp.sum(mask * (jnp.argmax(logit, -1) == M), axis=-1)
-        total = jnp.sum(mask, axis=-1)
-
-        return loss.sum(), (new_model_state, hit, total)
+        loss = cross_entropy(logit, M, K, train_fit_joint)
+        class_mask = (jnp.arange(logit.shape[-1])[..., jnp.newaxis] == M) & mask
+        hit = jnp.sum(class_mask * (jnp.argmax(logit, -1) == M), axis=-1)
+        total = jnp.sum(class_mask, axis=-1)
+
+        return jnp.sum(loss * mask), (new_model_state, hit, total)
 
     (loss, (new_model_state, hit, total)), grads = loss_fn(state.params)
-    loss = jax.lax.psum(loss, axis_name='batch')
-    hit = jax.lax.psum(hit, axis_name='batch')
-    total = jax.lax.psum(total, axis_name='batch')
-    grads = jax.lax.psum(grads, axis_name='batch')
 
     state = state.apply_gradients(
         grads=grads,
@@ -90,8 +189,42 @@ def train_step(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, K: int,
     return state, (loss, hit, total)
 
 
-@partial(jax.pmap, axis_name='batch', static_broadcasted_argnums=(3, 4, 5))
-def validation_step(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, K: int,
+# tau, learning rates and the like are traced, so that a sweep over them reuses one executable
+train_step: Callable = tracked("train_step", jax.jit(
+    over_members(train_step_fn, (0, 8), masked=True), static_argnums=(4, 5, 9), donate_argnums=(0,)
+))
+
+
+def train_multi_step_fn(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, mask: jnp.ndarray, K: int,
+        train_fit_joint: bool, tau: float, joint: jnp.ndarray, key: Any, augment: bool) \
+                -> Tuple[TrainState, Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]]:
+    """
+    Run one train step per leading entry of X, M and mask within a single
+    dispatch.  The metrics are summed over the steps.
+    """
+    def body_fun(state, batch):
+        X, M, mask = batch
+        return train_step_fn(state, X, M, mask, K, train_fit_joint, tau, joint, key, augment)
+
+    state, (loss, hit, total) = jax.lax.scan(body_fun, state, (X, M, mask))
+
+    return state, (loss.sum(axis=0), hit.sum(axis=0), total.sum(axis=0))
+
+
+train_multi_step: Callable = tracked("train_multi_step", jax.jit(
+    over_members(train_multi_step_fn, (0, 8), masked=True), static_argnums=(4, 5, 9), donate_argnums=(0,)
+))
+
+# every member takes its own batches, stacked along the leading member axis of X, M and mask
+train_member_step: Callable = tracked("train_member_step", jax.jit(
+    over_members(train_step_fn, (0, 1, 2, 3, 8), masked=True), static_argnums=(4, 5, 9), donate_argnums=(0,)
+))
+train_member_multi_step: Callable = tracked("train_member_multi_step", jax.jit(
+    over_members(train_multi_step_fn, (0, 1, 2, 3, 8), masked=True), static_argnums=(4, 5, 9), donate_argnums=(0,)
+))
+
+
+def validation_step_fn(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, mask: jnp.ndarray, K: int,
         train_fit_joint: bool, tau: float, joint: jnp.ndarray) -> jnp.ndarray:
     variables = {
         'params': state.params,
@@ -101,24 +234,117 @@ def validation_step(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, K: int,
     logit = state.raw_fn(variables, X, False)
     logit = logit + tau * jnp.log(joint)
 
-    if train_fit_joint:
-        loss = optax.softmax_cross_entropy_with_integer_labels(logit, M)
-    else:
-        logit_YZ = logit.reshape((-1, logit.shape[-1] // K, K))
-        logit_Y = jax.nn.logsumexp(logit_YZ, axis=-1)
-        logit_Z = jax.nn.logsumexp(logit_YZ, axis=-2)
-        loss_Y = optax.softmax_cross_entropy_with_integer_labels(logit_Y, M // K)
-        loss_Z = optax.softmax_cross_entropy_with_integer_labels(logit_Z, M % K)
-        loss = loss_Y + loss_Z
+    loss = cross_entropy(logit, M, K, train_fit_joint)
+
+    return jnp.sum(loss * mask)
+
+
+validation_step: Callable = tracked("validation_step", jax.jit(over_members(validation_step_fn, (0,)), static_argnums=(4, 5)))
+
+
+def train_epoch_fn(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, mask: jnp.ndarray,
+        X_valid: jnp.ndarray, M_valid: jnp.ndarray, mask_valid: jnp.ndarray, K: int, train_fit_joint: bool, tau: float, joint: jnp.ndarray, key_shuffle: Any, key_augment: Any,
+        stopping: Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray], augment: bool, batch_size: int,
+        valid_batch_size: int, drop_last: bool, decay: float) \
+                -> Tuple[TrainState, Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray],
+                         Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]]:
+    """
+    Run a whole epoch on a split that already resides on the devices: shuffle
+    it, take a train step for every minibatch, compute the validation loss,
+    and update the early stopping state (ema, min_ema, wait).  Both splits are
+    padded to a multiple of their batch size, see tta.pipeline.load_in_memory.
+    With `drop_last`, the last minibatch is skipped unless it is full, like
+    the loaders of models with BatchNorm skip their last partial batch.
+    """
+    N = X.shape[0]
+    steps = N // batch_size
+    permutation = jax.random.permutation(jax.random.fold_in(key_shuffle, state.step), N)
+    # move the padding behind the real samples, keeping their shuffled order
+    permutation = permutation[jnp.argsort(jnp.where(mask[permutation], 0, N) + jnp.arange(N))]
+    permutation = permutation[:steps * batch_size].reshape(steps, batch_size)
+
+    def train_body_fun(state, indices):
+        new_state, outputs = train_step_fn(
+            state, X[indices], M[indices], mask[indices], K, train_fit_joint, tau, joint, key_augment, augment
+        )
+        if not drop_last:
+            return new_state, outputs
 
-    loss = loss.sum()
-    loss = jax.lax.psum(loss, axis_name='batch')
+        # the padding would leak into the batch statistics of BatchNorm
+        full = jnp.all(mask[indices])
+        new_state = jax.tree_util.tree_map(lambda new, old: jnp.where(full, new, old), new_state, state)
+        outputs = jax.tree_util.tree_map(lambda x: jnp.where(full, x, jnp.zeros_like(x)), outputs)
+        return new_state, outputs
 
-    return loss
+    state, (loss, hit, total) = jax.lax.scan(train_body_fun, state, permutation)
+    loss, hit, total = loss.sum(axis=0), hit.sum(axis=0), total.sum(axis=0)
+
+    def valid_body_fun(loss_valid, batch):
+        X, M, mask = batch
+        return loss_valid + validation_step_fn(state, X, M, mask, K, train_fit_joint, tau, joint), None
+
+    valid_steps = X_valid.shape[0] // valid_batch_size
+    loss_valid, _ = jax.lax.scan(valid_body_fun, jnp.zeros(()), (
+        X_valid.reshape(valid_steps, valid_batch_size, *X_valid.shape[1:]),
+        M_valid.reshape(valid_steps, valid_batch_size),
+        mask_valid.reshape(valid_steps, valid_batch_size),
+    ))
+
+    ema, min_ema, wait = stopping
+    ema = jnp.where(jnp.isnan(ema), loss_valid, (1 - decay) * ema + decay * loss_valid)
+    improved = loss_valid < min_ema
+    wait = jnp.where(improved, 0, wait + 1)
+    min_ema = jnp.where(improved, ema, min_ema)
+
+    return state, (ema, min_ema, wait), (loss, hit, total, loss_valid)
+
+
+# every member shuffles and augments with its own keys
+train_epoch: Callable = tracked("train_epoch", jax.jit(
+    over_members(train_epoch_fn, (0, 11, 12, 13), masked=True),
+    static_argnums=(7, 8, 14, 15, 16, 17), donate_argnums=(0,)
+))
+
+
+def train_lbfgs_fn(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, mask: jnp.ndarray, K: int,
+        train_fit_joint: bool, tau: float, joint: jnp.ndarray, l2: float, max_iter: int) \
+                -> Tuple[TrainState, Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]]:
+    """
+    Fit the parameters of a convex head to the full batch with L-BFGS.  The
+    objective is the mean cross entropy plus an optional L2 penalty on the
+    parameters of the head.
+    """
+    N = jnp.sum(mask)
+    flat_params, unravel = ravel_pytree(state.params['net'])
+
+    def objective(flat_params):
+        params = state.params.unfreeze()
+        params['net'] = unravel(flat_params)
+        variables = {
+            'params': params,
+            'batch_stats': state.batch_stats,
+            'prior': state.prior
+        }
+        logit = state.raw_fn(variables, X, False)
+        logit = logit + tau * jnp.log(joint)
+        # X is sharded over the devices, and the sum is over the whole batch
+        loss = jnp.sum(cross_entropy(logit, M, K, train_fit_joint) * mask) / N
+
+        return loss + l2 / 2 * jnp.sum(flat_params**2)
+
+    flat_params, (loss, iterations, converged) = lbfgs(objective, flat_params, max_iter)
+
+    params = state.params.unfreeze()
+    params['net'] = unravel(flat_params)
+    state = state.replace(params=flax.core.frozen_dict.freeze(params))
+
+    return state, (loss, iterations, converged)
 
 
-@partial(jax.pmap, axis_name='batch', static_broadcasted_argnums=(3, 4, 5, 6), donate_argnums=(0,))
-def calibration_step(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, K: int,
+train_lbfgs: Callable = tracked("train_lbfgs", jax.jit(over_members(train_lbfgs_fn, (0,)), static_argnums=(4, 5)))
+
+
+def calibration_step_fn(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, mask: jnp.ndarray, K: int,
         train_fit_joint: bool, tau: float, learning_rate: float, joint: jnp.ndarray) \
                 -> Tuple[TrainState, Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]]:
     @partial(jax.value_and_grad, has_aux=True)
@@ -133,26 +359,14 @@ def calibration_step(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, K: int,
         )
         logit = logit + tau * jnp.log(joint)
 
-        if train_fit_joint:
-            loss = optax.softmax_cross_entropy_with_integer_labels(logit, M)
-        else:
-            logit_YZ = logit.reshape((-1, logit.shape[-1] // K, K))
-            logit_Y = jax.nn.logsumexp(logit_YZ, axis=-1)
-            logit_Z = jax.nn.logsumexp(logit_YZ, axis=-2)
-            loss_Y = optax.softmax_cross_entropy_with_integer_labels(logit_Y, M // K)
-            loss_Z = optax.softmax_cross_entropy_with_integer_labels(logit_Z, M % K)
-            loss = loss_Y + loss_Z
-        mask = jnp.arange(logit.shape[-1])[..., jnp.newaxis] == M
-        hit = jnp.sum(mask * (jnp.argmax(logit, -1) == M), axis=-1)
-        total = jnp.sum(mask, axis=-1)
-
-        return loss.sum(), (new_model_state, hit, total)
+        loss = cross_entropy(logit, M, K, train_fit_joint)
+        class_mask = (jnp.arange(logit.shape[-1])[..., jnp.newaxis] == M) & mask
+        hit = jnp.sum(class_mask * (jnp.argmax(logit, -1) == M), axis=-1)
+        total = jnp.sum(class_mask, axis=-1)
+
+        return jnp.sum(loss * mask), (new_model_state, hit, total)
 
     (loss, (new_model_state, hit, total)), grads = loss_fn(state.params)
-    loss = jax.lax.psum(loss, axis_name='batch')
-    hit = jax.lax.psum(hit, axis_name='batch')
-    total = jax.lax.psum(total, axis_name='batch')
-    grads = jax.lax.psum(grads, axis_name='batch')
 
     new_params = jax.tree_util.tree_map(lambda p, g: p - learning_rate * g, state.params, grads)
     state = state.replace(
@@ -163,11 +377,80 @@ def calibration_step(state: TrainState, X: jnp.ndarray, M: jnp.ndarray, K: int,
     return state, (loss, hit, total)
 
 
-cross_replica_mean: Callable = jax.pmap(lambda x: jax.lax.pmean(x, 'batch'), 'batch')
+calibration_step: Callable = tracked("calibration_step", jax.jit(
+    over_members(calibration_step_fn, (0,), masked=True), static_argnums=(4, 5), donate_argnums=(0,)
+))
+
+
+def logit_step_fn(state: TrainState, X: jnp.ndarray) -> jnp.ndarray:
+    variables = {
+        'params': state.params,
+        'batch_stats': state.batch_stats,
+        'prior': state.prior
+    }
+    logit = state.raw_fn(variables, X, False)
+
+    return logit
+
+
+logit_step: Callable = tracked("logit_step", jax.jit(over_members(logit_step_fn, (0,))))
+
+
+def feature_step_fn(state: TrainState, X: jnp.ndarray) -> jnp.ndarray:
+    variables = {
+        'params': state.params,
+        'batch_stats': state.batch_stats,
+        'prior': state.prior
+    }
+    _, intermediates = state.raw_fn(
+        variables, X, False,
+        capture_intermediates=lambda module, _: module.name == 'pre_logits',
+        mutable=['intermediates'],
+    )
+    (feature,) = intermediates['intermediates']['net']['pre_logits']['__call__']
+
+    return feature
+
+
+feature_step: Callable = tracked("feature_step", jax.jit(feature_step_fn))
+
+
+def calibration_lbfgs_fn(state: TrainState, logit: jnp.ndarray, M: jnp.ndarray, mask: jnp.ndarray, K: int,
+        train_fit_joint: bool, tau: float, joint: jnp.ndarray, max_iter: int) \
+                -> Tuple[TrainState, Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]]:
+    """
+    Fit the temperature T and bias b to precomputed raw logits with L-BFGS,
+    minimizing the mean cross entropy over the full calibration set.
+    """
+    N = jnp.sum(mask)
+    flat_params, unravel = ravel_pytree({'T': state.params['T'], 'b': state.params['b']})
+
+    def objective(flat_params):
+        params = unravel(flat_params)
+        # same as AdaptiveNN.calibrated_logit
+        calibrated_logit = logit / params['T'] + params['b']
+        calibrated_logit = calibrated_logit + tau * jnp.log(joint)
+        loss = cross_entropy(calibrated_logit, M, K, train_fit_joint)
+
+        # the logits are sharded over the devices, and the sum is over the whole calibration set
+        return jnp.sum(loss * mask) / N
+
+    flat_params, (loss, iterations, converged) = lbfgs(objective, flat_params, max_iter)
+
+    params = state.params.unfreeze()
+    params.update(unravel(flat_params))
+    state = state.replace(params=flax.core.frozen_dict.freeze(params))
+
+    return state, (loss, iterations, converged)
+
+
+# the raw logits differ among the members as well
+calibration_lbfgs: Callable = tracked(
+    "calibration_lbfgs", jax.jit(over_members(calibration_lbfgs_fn, (0, 1)), static_argnums=(4, 5))
+)
 
 
-@partial(jax.pmap, axis_name='batch')
-def induce_step(state: TrainState, X: jnp.ndarray) -> jnp.ndarray:
+def induce_step_fn(state: TrainState, X: jnp.ndarray, mask: jnp.ndarray) -> jnp.ndarray:
     variables = {
         'params': state.params,
         'batch_stats': state.batch_stats,
@@ -175,15 +458,25 @@ def induce_step(state: TrainState, X: jnp.ndarray) -> jnp.ndarray:
     }
     logit = state.calibrated_fn(variables, X, False)
     prob = jax.nn.softmax(logit)
-    prob_sum = jax.lax.psum(jnp.sum(prob, axis=0), axis_name='batch')
+    prob_sum = jnp.sum(prob * mask[:, jnp.newaxis], axis=0)
 
     return prob_sum
 
 
-# @partial(jax.pmap, axis_name='batch', static_broadcasted_argnums=(3, 4, 5, 6), donate_argnums=(0,))
-@partial(jax.pmap, axis_name='batch', static_broadcasted_argnums=(3, 4, 5, 6))
-def adapt_step(state: TrainState, X: jnp.ndarray, prior_strength: float,
-        symmetric_dirichlet: bool, fix_marginal: bool, C: int, K: int) -> TrainState:
+induce_step: Callable = tracked("induce_step", jax.jit(over_members(induce_step_fn, (0,))))
+
+
+def adapt_step_fn(state: TrainState, X: jnp.ndarray, mask: jnp.ndarray, prior_strength: float,
+        symmetric_dirichlet: bool, fix_marginal: bool, C: int, K: int) \
+                -> Tuple[TrainState, Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray]]:
+    """
+    Estimate the target prior on the batch with EM, and report the final
+    objective, the number of EM iterations and whether EM converged.
+
+    EM stops as soon as the objective no longer increases.  That is a fixed
+    point up to rounding, unless the objective dropped or became NaN, e.g.
+    for a Dirichlet prior with pseudocounts below zero.
+    """
     M = C * K
     source_prior = state.prior['source']
     if symmetric_dirichlet:
@@ -202,14 +495,14 @@ def adapt_step(state: TrainState, X: jnp.ndarray, prior_strength: float,
 
     init_target_prior = source_prior
     init_objective = jnp.sum((alpha - 1) * jnp.log(source_prior))
-    init_val = init_target_prior, init_objective, init_objective - 1
+    init_val = init_target_prior, init_objective, init_objective - 1, 0
 
     def cond_fun(val):
-        _, objective, prev_objective = val
+        _, objective, prev_objective, _ = val
         return objective > prev_objective
 
     def body_fun(val):
-        target_prior, prev_objective, _ = val
+        target_prior, prev_objective, _, iterations = val
 
         # E step
         target_prob = target_prior * prob / source_prior
@@ -217,20 +510,21 @@ def adapt_step(state: TrainState, X: jnp.ndarray, prior_strength: float,
         target_prob = target_prob / normalizer
 
         # M step
-        target_prob_count = jax.lax.psum(jnp.sum(target_prob, axis=0), axis_name='batch')
+        target_prob_count = jnp.sum(target_prob * mask[:, jnp.newaxis], axis=0)
         target_prior_count = target_prob_count + (alpha - 1)    # add pseudocount
         target_prior = target_prior_count / jnp.sum(target_prior_count)
 
         # Objective
         log_w = jnp.log(target_prior) - jnp.log(source_prior)
         mle_objective_i = jax.nn.logsumexp(log_w, axis=-1, b=prob)
-        mle_objective = jax.lax.psum(jnp.sum(mle_objective_i), axis_name='batch')
+        mle_objective = jnp.sum(mle_objective_i * mask)
         regularizer = jnp.sum((alpha - 1) * jnp.log(target_prior))
         objective = mle_objective + regularizer
 
-        return target_prior, objective, prev_objective
+        return target_prior, objective, prev_objective, iterations + 1
 
-    target_prior, _, _ = jax.lax.while_loop(cond_fun, body_fun, init_val)
+    target_prior, objective, prev_objective, iterations = jax.lax.while_loop(cond_fun, body_fun, init_val)
+    converged = jnp.isfinite(objective) & (objective >= prev_objective - 1e-5 * jnp.abs(prev_objective))
 
     if fix_marginal:
         # Make sure the marginal distribution of Y does not change
@@ -245,12 +539,43 @@ def adapt_step(state: TrainState, X: jnp.ndarray, prior_strength: float,
     prior['target'] = target_prior
     state = state.replace(prior=flax.core.frozen_dict.freeze(prior))
 
-    return state
+    return state, (objective, iterations, converged)
+
+
+adapt_step: Callable = tracked("adapt_step", jax.jit(over_members(adapt_step_fn, (0,)), static_argnums=(4, 5, 6, 7)))
+
+
+def em_telemetry_step_fn(telemetry: Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray],
+        objective: jnp.ndarray, iterations: jnp.ndarray, converged: jnp.ndarray) \
+                -> Tuple[jnp.ndarray, jnp.ndarray, jnp.ndarray, jnp.ndarray]:
+    """
+    Add the objective, iterations and convergence of adapt_step on a batch to
+    their sums over the split, and the iterations to their histogram over
+    EM_ITERATION_BINS, all on the device.
+    """
+    em_iterations, em_converged, em_objective, em_histogram = telemetry
+    bins = jnp.digitize(iterations, EM_ITERATION_BINS) - 1
+    em_histogram = em_histogram + jax.nn.one_hot(bins, len(EM_ITERATION_BINS), dtype=em_histogram.dtype)
+
+    return em_iterations + iterations, em_converged + converged, em_objective + objective, em_histogram
 
- 
-@partial(jax.pmap, axis_name='batch', static_broadcasted_argnums=(4,))
-def test_step(state: TrainState, image: jnp.ndarray, Y: jnp.ndarray, Z: jnp.ndarray, argmax_joint: bool) \
-        -> Tuple[Tuple[jnp.ndarray, jnp.ndarray], Tuple[jnp.ndarray, jnp.ndarray]]:
+
+em_telemetry_step: Callable = tracked("em_telemetry_step", jax.jit(em_telemetry_step_fn))
+
+
+def predict(prob_joint: jnp.ndarray, argmax_joint: bool) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    """Predict Y and Z from P(Y, Z | X) of shape (N, C, K), by the joint or by the marginals."""
+    N, C, K = prob_joint.shape
+    if argmax_joint:
+        prediction_M = jnp.argmax(prob_joint.reshape((N, C * K)), axis=-1)
+        return prediction_M // K, prediction_M % K
+
+    return jnp.argmax(jnp.sum(prob_joint, axis=-1), axis=-1), jnp.argmax(jnp.sum(prob_joint, axis=-2), axis=-1)
+
+
+def test_step_fn(state: TrainState, image: jnp.ndarray, Y: jnp.ndarray, Z: jnp.ndarray, mask: jnp.ndarray,
+        argmax_joint: bool) \
+        -> Tuple[Tuple[jnp.ndarray, jnp.ndarray], Tuple[jnp.ndarray, jnp.ndarray], jnp.ndarray]:
     variables = {
         'params': state.params,
         'batch_stats': state.batch_stats,
@@ -264,19 +589,28 @@ def test_step(state: TrainState, image: jnp.ndarray, Y: jnp.ndarray, Z: jnp.ndar
 
     prob_Y = jnp.sum(prob_joint, axis=-1)
     prob_Z = jnp.sum(prob_joint, axis=-2)
-
-    if argmax_joint:
-        prediction_M = jnp.argmax(prob_joint)
-        prediction_Y = prediction_M // 2
-        prediction_Z = prediction_M % 2
-    else:
-        prediction_Y = jnp.argmax(prob_Y, axis=-1)
-        prediction_Z = jnp.argmax(prob_Z, axis=-1)
+    prediction_Y, prediction_Z = predict(prob_joint, argmax_joint)
 
     score_Y = prob_Y[:, 1]   # assumes binary label
     score_Z = prob_Z[:, 1]   # assumes binary label
 
-    hit_Y = jax.lax.psum(jnp.sum(prediction_Y == Y), axis_name='batch')
-    hit_Z = jax.lax.psum(jnp.sum(prediction_Z == Z), axis_name='batch')
+    hit_Y = jnp.sum((prediction_Y == Y) & mask)
+    hit_Z = jnp.sum((prediction_Z == Z) & mask)
+
+    return (score_Y, hit_Y), (score_Z, hit_Z), prob_joint
+
+
+test_step: Callable = tracked("test_step", jax.jit(over_members(test_step_fn, (0,)), static_argnums=(5,)))
+
+
+def ensemble_step_fn(prob_joint: jnp.ndarray, Y: jnp.ndarray, Z: jnp.ndarray, mask: jnp.ndarray,
+        argmax_joint: bool) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    """The hits of the ensemble averaging P(Y, Z | X) of the members, with the decision rule of test_step."""
+    prediction_Y, prediction_Z = predict(jnp.mean(prob_joint, axis=0), argmax_joint)
+    hit_Y = jnp.sum((prediction_Y == Y) & mask)
+    hit_Z = jnp.sum((prediction_Z == Z) & mask)
+
+    return hit_Y, hit_Z
+
 
-    return (score_Y, hit_Y), (score_Z, hit_Z)
+ensemble_step: Callable = tracked("ensemble_step", jax.jit(ensemble_step_fn, static_argnums=(4,)))
@@ -0,0 +1,183 @@
+"""
+Audit the transfers between the host and the devices.
+
+With `audit`, the transfers JAX makes on behalf of Python code are counted
+with their bytes, per call site in tta and per timing span (see tta.timing):
+
+- host to device: jax.device_put, e.g. by tta.mesh.replicate and shard,
+  jnp.array and jnp.asarray of host data, and host arrays passed to the step
+  functions tracked by tta.compilation,
+- device to host: reading a jax.Array on the host, e.g. with np.asarray,
+  jax.device_get, float() or printing it,
+- device to device: jax.device_put of a jax.Array, e.g. replicating a state.
+
+tta.cli prints the call sites moving the most bytes at the end of a run and
+writes all of them next to the results (`<name>.transfers.json`).
+
+Python scalars mixed with arrays, e.g. `0 + loss` or `x[0]`, are transferred
+without going through Python, so they are not counted.  `hot_loop` catches
+them instead: with `strict`, the code it declares as a hot loop fails on any
+implicit transfer, explicit ones like `replicate` and `jax.device_get` still
+being allowed.
+"""
+
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import sys
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from tta import timing
+from tta.cache import format_size
+
+
+# (timing span, direction, call site) -> [count, bytes]
+events: Dict[Tuple[str, str, str], List[int]] = {}
+audit = False
+strict = False
+
+# the functions patched while auditing, and their originals
+originals: Dict[Tuple[Any, str], Any] = {}
+# from the internals of jax, which are only imported while auditing
+trace_state_clean: Optional[Callable[[], bool]] = None
+
+# frames in these files are attributed to their caller
+SKIPPED_FILES = ("tta/transfers.py", "tta/mesh.py", "tta/compilation.py", "tta/timing.py")
+
+
+def reset(audit_transfers: bool = False, strict_transfers: bool = False) -> None:
+    global audit, strict
+    events.clear()
+    strict = strict_transfers
+    if audit_transfers and not audit:
+        install()
+    elif audit and not audit_transfers:
+        uninstall()
+    audit = audit_transfers
+
+
+def call_site() -> str:
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if "/tta/" in filename and not filename.endswith(SKIPPED_FILES):
+            return f"{filename[filename.rindex('/tta/') + 1:]}:{frame.f_lineno} ({frame.f_code.co_name})"
+        frame = frame.f_back
+
+    return "<outside tta>"
+
+
+def record(direction: str, size: int) -> None:
+    # e.g. constants of a step function being traced
+    if not trace_state_clean():
+        return
+
+    key = "/".join(timing.stack) or "-", direction, call_site()
+    count_bytes = events.setdefault(key, [0, 0])
+    count_bytes[0] += 1
+    count_bytes[1] += size
+
+
+def host_bytes(leaves: List[Any]) -> int:
+    return sum(np.asarray(leaf).nbytes for leaf in leaves if not isinstance(leaf, jax.Array))
+
+
+def record_arguments(args: Tuple[Any, ...]) -> None:
+    """Record the host arrays passed to a step function, which it transfers to the devices."""
+    leaves = [leaf for leaf in jax.tree_util.tree_leaves(args) if isinstance(leaf, (np.ndarray, np.generic))]
+    if leaves:
+        record("host_to_device", host_bytes(leaves))
+
+
+def install() -> None:
+    global trace_state_clean
+    from jax._src.array import ArrayImpl
+
+    try:
+        from jax._src.core import trace_state_clean
+    except ImportError:
+        # older jax, e.g. the 0.4.1 of Pipfile.lock, defines it in jax.core
+        from jax.core import trace_state_clean
+
+    def patch(owner: Any, name: str, make: Callable[[Any], Any]) -> None:
+        original = owner.__dict__[name] if isinstance(owner, type) else getattr(owner, name)
+        originals[owner, name] = original
+        setattr(owner, name, make(original))
+
+    def device_put(original):
+        def wrapper(x, *args, **kwargs):
+            leaves = jax.tree_util.tree_leaves(x)
+            size = host_bytes(leaves)
+            if size:
+                record("host_to_device", size)
+            size = sum(leaf.nbytes for leaf in leaves if isinstance(leaf, jax.Array))
+            if size:
+                record("device_to_device", size)
+            return original(x, *args, **kwargs)
+        return wrapper
+
+    def array(original):
+        def wrapper(x, *args, **kwargs):
+            if not isinstance(x, jax.Array):
+                record("host_to_device", host_bytes(jax.tree_util.tree_leaves(x)))
+            return original(x, *args, **kwargs)
+        return wrapper
+
+    def value(original):
+        def getter(self):
+            # the host copy is cached after the first read
+            if self._npy_value is None:
+                record("device_to_host", self.nbytes)
+            return original.fget(self)
+        return property(getter)
+
+    patch(jax, "device_put", device_put)
+    patch(jnp, "array", array)
+    patch(jnp, "asarray", array)
+    patch(ArrayImpl, "_value", value)
+
+
+def uninstall() -> None:
+    for (owner, name), original in originals.items():
+        setattr(owner, name, original)
+    originals.clear()
+
+
+@contextmanager
+def hot_loop() -> Iterator[None]:
+    """With `strict`, fail on implicit transfers, e.g. of Python scalars."""
+    if not strict:
+        yield
+        return
+
+    with jax.transfer_guard("disallow"):
+        yield
+
+
+def report(top: int = 20) -> str:
+    ranked = sorted(events.items(), key=lambda item: item[1][1], reverse=True)
+    lines = [
+        f"{count:>7}x {format_size(size):>10} {direction:<16} {site} [{span}]"
+        for (span, direction, site), (count, size) in ranked[:top]
+    ]
+    if len(ranked) > top:
+        lines.append(f"... and {len(ranked) - top} more call sites")
+    for direction in ("host_to_device", "device_to_host", "device_to_device"):
+        count = sum(c for (_, d, _), (c, _) in events.items() if d == direction)
+        size = sum(s for (_, d, _), (_, s) in events.items() if d == direction)
+        lines.append(f"{direction}: {count} transfers, {format_size(size)}")
+
+    return "\n".join(lines)
+
+
+def write(prefix: Path) -> None:
+    path = prefix.with_name(f"{prefix.name}.transfers.json")
+    path.write_text(json.dumps([
+        {"span": span, "direction": direction, "site": site, "count": count, "bytes": size}
+        for (span, direction, site), (count, size) in sorted(events.items(), key=lambda item: item[1][1], reverse=True)
+    ], indent=2))
+    print(f"Wrote transfers to {path}")
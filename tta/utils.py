@@ -1,8 +1,8 @@
-from typing import Tuple
+from typing import Iterator, List, Sequence, Tuple
 import sys
 
 import torch
-from torch.utils.data import Dataset, random_split
+from torch.utils.data import Dataset, Sampler, random_split
 
 
 class Dataset(Dataset):
@@ -10,9 +10,41 @@ class Dataset(Dataset):
         raise NotImplementedError
 
 
+class MemberBatchSampler(Sampler):
+    """
+    Yield the batches of several ensemble members concatenated, every member
+    shuffling the dataset with its own generator.  With `drop_last`, the last
+    partial batch of every member is dropped.
+    """
+
+    def __init__(self, size: int, batch_size: int, generators: Sequence[torch.Generator], drop_last: bool = True):
+        self.size = size
+        self.batch_size = batch_size
+        self.generators = generators
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return self.size // self.batch_size
+
+        return -(-self.size // self.batch_size)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        permutations = [torch.randperm(self.size, generator=generator) for generator in self.generators]
+        for step in range(len(self)):
+            batch = slice(step * self.batch_size, (step + 1) * self.batch_size)
+            yield torch.cat([permutation[batch] for permutation in permutations]).tolist()
+
+
 class Tee:
     def __init__(self, fname, mode="w"):
-        self.stdout = sys.stdout
+        stdout = sys.stdout
+        if isinstance(stdout, Tee):
+            # do not nest when one process logs several runs, e.g. in tta.sweep
+            stdout.file.close()
+            stdout = stdout.stdout
+
+        self.stdout = stdout
         self.file = open(fname, mode)
 
     def write(self, message):
@@ -4,6 +4,8 @@ from pathlib import Path
 import numpy as np
 import matplotlib.pyplot as plt
 
+from tta.common import Curves, EM_ITERATION_BINS
+
 
 def plot(
     npz_path: Path,
@@ -13,13 +15,19 @@ def plot(
     plot_title: str,
     plot_root: Path,
     config_name: str,
-    y_lim: Optional[Tuple],
+    y_lim: Optional[Tuple] = None,
 ):
     print(f"Reading from {npz_path}")
     all_sweeps = np.load(npz_path, allow_pickle=True)
 
     for sweep_type, (sweeps, ylabel) in all_sweeps.items():
         ylabel = ylabel.replace("Average AUC", "AUC")
+        if sweep_type == "em_histogram":
+            if sweeps:
+                plot_histograms(sweeps, confounder_strength, ylabel, plot_title, plot_root / f"{config_name}_{sweep_type}")
+
+            continue
+
         fig, ax = plt.subplots(figsize=(12, 6))
 
         if sweep_type == "accuracy":
@@ -129,8 +137,10 @@ def plot(
                     linestyle="dotted", linewidth=3)
 
         # plt.ylim((0, 1))
-        if sweep_type in {"mean", "l1", "norm"}:
+        if sweep_type in {"mean", "l1", "norm", "em_converged"}:
             plt.ylim((0, 1))
+        elif sweep_type in {"em_iterations", "em_objective"}:
+            pass
         elif y_lim is not None:
             plt.ylim(y_lim)
         else:
@@ -154,6 +164,38 @@ def plot(
         plt.close(fig)
 
 
+def plot_histograms(
+    sweeps: Curves,
+    confounder_strength: np.ndarray,
+    ylabel: str,
+    plot_title: str,
+    plot_path: Path,
+):
+    """Plot the histograms of EM iterations per domain, one panel per EM configuration."""
+    keys = sorted(sweeps.keys())
+    fig, axes = plt.subplots(len(keys), 1, figsize=(12, 4 * len(keys)), squeeze=False)
+    bin_labels = [f"{low}-{high - 1}" for low, high in zip(EM_ITERATION_BINS, EM_ITERATION_BINS[1:])]
+    bin_labels.append(f"{EM_ITERATION_BINS[-1]}+")
+    for ax, key in zip(axes[:, 0], keys):
+        (_, prior_str, _, _), _, batch_size = key
+        histogram = sweeps[key][:-1]    # the last split is the training split
+        ax.imshow(histogram.T, origin="lower", aspect="auto", cmap="Oranges", interpolation="nearest")
+        ax.set_xticks(np.arange(len(histogram)))
+        ax.set_xticklabels([f"{strength:.2f}" for strength in confounder_strength[:len(histogram)]], rotation=90)
+        ax.set_yticks(np.arange(len(bin_labels)))
+        ax.set_yticklabels(bin_labels)
+        ax.set_xlabel("Shift parameter")
+        ax.set_ylabel("EM iterations")
+        ax.set_title(f"[TTLSA] N = {batch_size}, prior strength = {prior_str}")
+
+    fig.suptitle(f"{plot_title}: {ylabel}")
+    fig.tight_layout()
+    for suffix in ("png", "pdf"):
+        plt.savefig(plot_path.with_name(f"{plot_path.name}.{suffix}"), bbox_inches='tight', dpi=300)
+
+    plt.close(fig)
+
+
 def bayes_accuracy(
     dataset_label_noise: float, confounder_strength: Union[float, np.ndarray]
 ) -> np.ndarray:
@@ -0,0 +1,169 @@
+"""
+Compile the step functions of a configuration ahead of time into the
+persistent compilation cache, so that a later tta.cli run or tta.sweep
+worker with the same model, input shape and batch sizes starts with a hot
+cache instead of stalling on the first batch of every stage.
+
+The arguments are built with the same helpers as tta.cli (stacked members,
+replicated states and hyperparameters, padded and sharded batches), so the
+lowered programs are exactly the ones a run dispatches.  The options mirror
+those of tta.cli, and repeated options are warmed up for every value.
+
+Usage:
+    python -m tta.warmup --train_model LeNet --input_shape 28,28,3 \
+        --train_batch_size 64 --calibration_batch_size 64 \
+        --test_batch_size 64 --test_batch_size 512
+"""
+
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import click
+
+from tta.mesh import set_host_device_count, replicate, shard, pad_samples, pad_batch
+from tta.train import (
+    create_train_state, stack_members, train_step, train_multi_step, train_member_step, train_member_multi_step, validation_step,
+    calibration_step, induce_step, adapt_step, test_step
+)
+
+
+def compile_ahead(name: str, step: Callable, *args: Any) -> float:
+    """Lower and compile a tracked step function for `args`, and report the time it took."""
+    start = time.perf_counter()
+    step.jitted.lower(*args).compile()
+    elapsed = time.perf_counter() - start
+    print(f"Compiled {name} in {elapsed:.2f}s")
+
+    return elapsed
+
+
+@click.command()
+@click.option("--train_model", type=str, required=True)
+@click.option("--input_shape", type=str, required=True, help="shape of one sample, e.g. 28,28,3")
+@click.option("--train_fit_joint", type=bool, required=False, default=True)
+@click.option("--train_lr", type=float, required=True)
+@click.option("--train_batch_size", type=int, required=True)
+@click.option("--train_scan_steps", type=int, required=False, default=1)
+@click.option("--train_seed_count", type=int, required=False, default=1)
+@click.option("--augment", is_flag=True, help="for datasets augmenting on the device, e.g. Waterbirds")
+@click.option("--calibration_batch_size", type=int, required=True)
+@click.option("--adapt_symmetric_dirichlet", type=bool, required=False, multiple=True, default=[False])
+@click.option("--adapt_fix_marginal", type=bool, required=False, multiple=True, default=[False])
+@click.option("--test_argmax_joint", type=bool, required=False, multiple=True, default=[False])
+@click.option("--test_batch_size", type=int, required=True, multiple=True)
+@click.option("--host_device_count", type=int, required=False)
+def main(
+    train_model: str,
+    input_shape: str,
+    train_fit_joint: bool,
+    train_lr: float,
+    train_batch_size: int,
+    train_scan_steps: int,
+    train_seed_count: int,
+    augment: bool,
+    calibration_batch_size: int,
+    adapt_symmetric_dirichlet: Sequence[bool],
+    adapt_fix_marginal: Sequence[bool],
+    test_argmax_joint: Sequence[bool],
+    test_batch_size: Sequence[int],
+    host_device_count: Optional[int],
+) -> None:
+    if host_device_count is not None:
+        set_host_device_count(host_device_count)
+
+    C, K = 2, 2
+    sample_shape = tuple(int(d) for d in input_shape.split(","))
+    device_count = jax.device_count()
+    for batch_size in (train_batch_size, calibration_batch_size, *test_batch_size):
+        if batch_size % device_count:
+            raise ValueError(f"Batch size {batch_size} is not divisible by {device_count} devices")
+
+    # same as tta.pipeline.train_fn
+    split_members = jax.vmap(jax.random.split, out_axes=1)
+    keys = jnp.stack([jax.random.PRNGKey(i) for i in range(train_seed_count)])
+    keys_init, keys = split_members(keys)
+    specimen = jnp.empty((1, *sample_shape))
+    state = stack_members([
+        create_train_state(key_init, C, K, train_model, train_lr, specimen, device_count)
+        for key_init in keys_init
+    ])
+    state = replicate(state)
+    key_augment, _ = split_members(keys)
+    active = replicate(jnp.ones(train_seed_count, dtype=bool))
+    # converted from a host array like in tta.pipeline, as a weak type would lower differently
+    joint = replicate(jnp.asarray(np.full(C * K, 1 / (C * K))))
+    tau = replicate(jnp.float32(0))
+    lr = replicate(jnp.float32(0))
+
+    x_dtype = np.uint8 if augment else np.float32
+
+    def batch(size: int) -> Tuple[List[Any], Any]:
+        # the loaders yield float32 samples, or uint8 images for the datasets augmenting on the device, and int64 labels
+        X = np.zeros((size, *sample_shape), dtype=x_dtype)
+        Y = np.zeros(size, dtype=np.int64)
+        return pad_batch((X, Y * K + Y, Y, Y), size)
+
+    timings = {}
+    # with several members, the loader engine gives every member its own batches
+    # along a leading member axis, see tta.pipeline.stack_batches
+    S = train_seed_count
+    padded, mask_host = pad_samples(
+        (np.zeros((S * train_batch_size, *sample_shape), dtype=x_dtype), np.zeros(S * train_batch_size, dtype=np.int64)),
+        S * train_batch_size,
+    )
+    train_arrays = [array.reshape(S, train_batch_size, *array.shape[1:]) if S > 1 else array for array in (*padded, mask_host)]
+    member_axis = int(S > 1)
+    if S > 1:
+        (step_name, step), (multi_step_name, multi_step) = ("train_member_step", train_member_step), ("train_member_multi_step", train_member_multi_step)
+    else:
+        (step_name, step), (multi_step_name, multi_step) = ("train_step", train_step), ("train_multi_step", train_multi_step)
+    X, M, mask = shard(tuple(train_arrays), axis=member_axis)
+    timings[step_name] = compile_ahead(
+        step_name, step,
+        state, X, M, mask, K, train_fit_joint, tau, joint, key_augment, augment, active,
+    )
+    if train_scan_steps > 1:
+        X_steps, M_steps, mask_steps = shard(
+            tuple(np.stack([array] * train_scan_steps, axis=member_axis) for array in train_arrays), axis=member_axis + 1
+        )
+        timings[multi_step_name] = compile_ahead(
+            multi_step_name, multi_step,
+            state, X_steps, M_steps, mask_steps, K, train_fit_joint, tau, joint, key_augment, augment, active,
+        )
+
+    (X, M, _, _), mask = batch(calibration_batch_size)
+    timings["validation_step"] = compile_ahead(
+        "validation_step", validation_step, state, X, M, mask, K, train_fit_joint, tau, joint,
+    )
+    timings["calibration_step"] = compile_ahead(
+        "calibration_step", calibration_step, state, X, M, mask, K, train_fit_joint, tau, lr, joint, active,
+    )
+    timings["induce_step"] = compile_ahead("induce_step", induce_step, state, X, mask)
+
+    for batch_size in test_batch_size:
+        (X, _, Y, Z), mask = batch(batch_size)
+        for symmetric_dirichlet in adapt_symmetric_dirichlet:
+            for fix_marginal in adapt_fix_marginal:
+                timings[f"adapt_step[{batch_size}, {symmetric_dirichlet}, {fix_marginal}]"] = compile_ahead(
+                    f"adapt_step ({batch_size = }, {symmetric_dirichlet = }, {fix_marginal = })", adapt_step,
+                    state, X, mask, replicate(1.0), symmetric_dirichlet, fix_marginal, C, K,
+                )
+        for argmax_joint in test_argmax_joint:
+            timings[f"test_step[{batch_size}, {argmax_joint}]"] = compile_ahead(
+                f"test_step ({batch_size = }, {argmax_joint = })", test_step,
+                state, X, Y, Z, mask, argmax_joint,
+            )
+
+    print(f"Compiled {len(timings)} programs in {sum(timings.values()):.2f}s")
+
+
+if __name__ == "__main__":
+    from jax.experimental.compilation_cache.compilation_cache import initialize_cache
+
+    from tta.cache import cache
+
+    initialize_cache(str(cache.namespace("jit")))
+    main()